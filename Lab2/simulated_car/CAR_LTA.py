@@ -1,56 +1,60 @@
-import pygame
+import argparse
 import math
+import os
+import sys
+import time
+
+# Headless batch mode: no window, no frame cap, scripted inputs
+HEADLESS = "--headless" in sys.argv
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from detection_logger import DetectionLogger, to_text
+from dirty_renderer import DirtyRenderer
+from frame_profiler import FrameProfiler, start_cprofile
+from input_recording import InputRecorder, key_inputs
+from lane_geometry import GeometrySensor
+from lane_sensor import SENSOR_ANGLE, SENSOR_RANGE, CoherentConeSensor, ConeSensor
+from road_assets import RoadAssets
+from road_generator import TILE_WIDTH, GeneratedWorld
+from road_world import GeneratedTiles, RoadWorld, route
+from sim_engine import (ACCELERATION, DT, FA, FRICTION, HEIGHT, INCREMENT, J, L, LTA_CORRECTION, M,
+                        MAX_SPEED, MAX_STEER_ANGLE, SAFE_DISTANCE_THRESHOLD, START, WIDTH,
+                        Simulation, b, c_s, inputs_from_names, tau_s)
+from sprite_cache import RotationCache
 
 # Initialize Pygame
 pygame.init()
 
-# Screen dimensions
-WIDTH, HEIGHT = 1000, 600
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Car Simulation")
-
 # Load road images
 road_images = ["road1.png", "road2.png", "road3.png"]
-current_road = 0
-road = pygame.image.load(road_images[current_road])
-
-# Open a file to save detected positions
-file = open("detected_positions.txt", "w")
+road_assets = RoadAssets(road_images)  # Loaded and converted ahead of the road changes
+road_world = None  # RoadWorld of the endless road (ROAD_WORLD), made when first driven
+road_world_source = None  # (ROAD_WORLD, GENERATED_WORLD) road_world was made for
 
 # Load car image
 car = pygame.image.load("car.png")
 car_width, car_height = car.get_width(), car.get_height()
-car_x, car_y = 50, HEIGHT // 2 + 23  # Starting position of the car
-car_angle = 0
-car_speed = 0
-
-# Constants
-L = 2.5  # Wheelbase in meters (adjust this based on your car)
-ACCELERATION = 1
-MAX_SPEED = 10
-INCREMENT = 0.1
-SENSOR_RANGE = 450  # 30 meters in pixels
-SENSOR_ANGLE = 20  # Sensor cone angle (degrees)
-DT = 0.1  # Time step for simulation
-a = L * 2 / 3
-b = 1 / 3 * L
-MAX_V = 5  # Maximum velocity
-MAX_STEER_ANGLE = 30  # Maximum steering angle in degrees
-M = 1200  # Mass of the car in kg
-J = 2000  # Moment of inertia about
-FA, FD = -10, 0  # Friction, driving force
-tau_s, c_s = 1, 1  # constants for steering
-FRICTION = 0.98  # Friction coefficient (reduce speed by 2% per update)
-STEERING_ANGLE = 0  # Initial steering angle
-SAFE_DISTANCE_THRESHOLD = 25
-
-# Colors for sensor line detection
-LINE_COLORS = [
-    (250, 253, 253),  # #fafdfd
-    (206, 213, 205),  # #ced5cd
-    (140, 136, 129),  # #8c8881
-    (229, 230, 229),  # #e5e6e5
-]
+car_sprites = RotationCache(car)  # The car at every heading, rendered once
+
+# Constants. The screen (WIDTH, HEIGHT, START), the car model (DT, L, b, M, J,
+# FA, tau_s, c_s, ...) and the LTA come from sim_engine, the sensor cone from
+# lane_sensor: one definition of each, read by new_simulation() from this
+# module, where lta_sweep.py sets them
+FPS = 60  # Rendered frames per second
+TIME_WARPS = [0.25, 0.5, 1, 2, 5, 10, 20, 50]  # Simulated seconds per wall clock second ('+' / '-')
+MAX_FRAME_TIME = 0.25  # Wall clock time (s) counted for one frame at most, e.g. after a stall
+MAX_SUBSTEPS = 60  # Physics steps per rendered frame at most
+MAX_FRAME_SKIP = 5  # Frames in a row not drawn while the physics catches up
+LTA_DISTANCE_FIELD = False  # LTA checks the road's distance field instead of the sensor detections
+LTA_MPC = False  # LTA picks its correction from rollouts of the car model (mpc_lta.py)
+LANE_GEOMETRY = False  # Sensor rays intersect the lane line outlines instead of sampling pixels
+COHERENT_SENSOR = False  # Sensor rays search near their last hit before marching in full
+ROAD_WORLD = 0  # Tiles of the endless road (road_world.py) driven instead of the three roads, 0 = off
+GENERATED_WORLD = None  # Path of a world of road_generator.py the endless road is cut from, None = road images
+CAMERA_X = WIDTH // 4  # Screen x of the car on the endless road, the camera scrolls with it
 
 # Game state variables
 running = True
@@ -70,203 +74,242 @@ Press Enter to select an option.
 - Help: Show this help information.
 Press 'q' to return to the home screen.
 Press 's' to toggle the sensor.
+Press '+' / '-' to speed up / slow down time.
+Press 'p' to show where the frame time goes.
 """
 
-# State variables: [x, y, car_angle, v_u, phi, u_2 ]
-state = [car_x, car_y, math.radians(car_angle), 0, 0, 0]
-
 # Initialize variables to manage unsafe message display
 unsafe_start_time = None
 display_unsafe_message = False
-current_u2_LTA = 0
+profiler = FrameProfiler(keep_samples=False)  # Time spent in each phase of a frame, every frame with --frame-stats
+show_profiler = False  # Profiler overlay ('p')
 
 
 ########## FUNCTIONS ##########
 
-## FUNCTIONS FOR CAR MOVEMENT
-
-# Helper function: Runge-Kutta integration
-def runge_kutta(f, state, dt):
-    # print("inside runge kutta fucntion", state)
-    k1 = f(state)
-    # print("k1:",k1)
-    k2 = f([s + dt * 0.5 * k for s, k in zip(state, k1)])
-    # print("k2:",k2)
-    k3 = f([s + dt * 0.5 * k for s, k in zip(state, k2)])
-    # print("k3:",k3)
-    k4 = f([s + dt * k for s, k in zip(state, k3)])
-    # print("k4:",k4)
-    return [s + dt / 6 * (k1i + 2 * k2i + 2 * k3i + k4i) for
-            s, k1i, k2i, k3i, k4i in zip(state, k1, k2, k3, k4)]
-
-
-# Dynamics model for the car
-def car_dynamics(state):
-    x, y, theta, v_u, phi, u_2 = state
-    global FA, FD # Access global variables
-    global unsafe_start_time, display_unsafe_message
-
-    # Clamp steering angle
-    phi = max(-math.radians(MAX_STEER_ANGLE), min(math.radians(MAX_STEER_ANGLE), phi))
-
-    # Precomputed values
-    cos_phi = math.cos(phi)
-    tan_phi = math.tan(phi)
-    gamma = (cos_phi ** 2) * (L**2 * M + (M * (b)**2 + J) * (tan_phi ** 2))
-
-    # Equations of motion (from Equation 2.23 in the PDF)
-    #Unsafe approximation to the up line
-    if not calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[0] and calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[1] == 1:
-        unsafe_start_time = pygame.time.get_ticks()
-        display_unsafe_message = True
-        u_2_LTA = 0.8
-        dx = v_u * ( math.cos(theta) -b/L *math.tan(theta)*math.sin(theta))
-        dy = v_u *( math.sin(theta) +b/L *math.tan(theta)*math.cos(theta))
-        dtheta = v_u * tan_phi / L
-        dphi = (1 / tau_s) * (phi + c_s * (u_2 + u_2_LTA))  # Steering dynamics
-        dv_u = (v_u*(b**2*M+J)*tan_phi * dphi + L**2 * cos_phi**2) / gamma * (FD+FA)
-        state[4] = 0
-        state[5] = 0
-
-    #Unsafe approximation to the down line
-    elif not calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[0] and calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[1] == 0:
-        unsafe_start_time = pygame.time.get_ticks()
-        display_unsafe_message = True
-        u_2_LTA = -0.8
-        dx = v_u * ( math.cos(theta) -b/L *math.tan(theta)*math.sin(theta))
-        dy = v_u *( math.sin(theta) +b/L *math.tan(theta)*math.cos(theta))
-        dtheta = v_u * tan_phi / L
-        dphi = (1 / tau_s) * (phi + c_s * (u_2 + u_2_LTA))  # Steering dynamics
-        dv_u = (v_u*(b**2*M+J)*tan_phi * dphi + L**2 * cos_phi**2) / gamma * (FD+FA)
-        state[4] = 0
-        state[5] = 0
-
-    #Safe
-    else:
-        u_2_LTA = 0
-        dx = v_u * ( math.cos(theta) -b/L *math.tan(theta)*math.sin(theta))
-        dy = v_u *( math.sin(theta) +b/L *math.tan(theta)*math.cos(theta))
-        dtheta = v_u * tan_phi / L
-        dphi = (1 / tau_s) * (phi + c_s * u_2)  # Steering dynamics
-        dv_u = (v_u*(b**2*M+J)*tan_phi * dphi + L**2 * cos_phi**2) / gamma * (FD+FA)
-        state[4] = 0
-        state[5] = 0
-    return [dx, dy, dtheta, dv_u, dphi, 0, u_2_LTA]
-
-# Derivatives function for the car's motion
-def car_derivatives(state):
-    """
-    Compute the car's derivatives based on its current state.
-    state: [x, y, angle]
-    """
-    global STEERING_ANGLE
-    global unsafe_start_time, display_unsafe_message
-    x, y, angle = state
-    dx = car_speed * math.cos(angle)
-    dy = car_speed * math.sin(angle)
-
-    #Unsafe approximation to the up line
-    if not calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[0] and calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[1] == 1:
-        unsafe_start_time = pygame.time.get_ticks()
-        display_unsafe_message = True
-        u_2_LTA = 0.8
-        dtheta = (car_speed / L) * math.tan(math.radians(STEERING_ANGLE + u_2_LTA))
-    
-    #Unsafe approximation to the down line
-    elif not calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[0] and calculate_safe_distance(x, y, detected_lines, SAFE_DISTANCE_THRESHOLD)[1] == 0:
-        unsafe_start_time = pygame.time.get_ticks()
-        display_unsafe_message = True
-        u_2_LTA = -0.8
-        dtheta = (car_speed / L) * math.tan(math.radians(STEERING_ANGLE + u_2_LTA))
-    else:
-        dtheta = (car_speed / L) * math.tan(math.radians(STEERING_ANGLE))
-    
-    return [dx, dy, dtheta]
-
-# Calculate the minimum distance to the nearest detected line and determine if it's safe, or needs LTS intervention
-def calculate_safe_distance(car_x, car_y, detected_lines, safe_threshold):
-    min_distance = float('inf')
-    min_y = None
-    for line_x, line_y in detected_lines:
-        distance = math.sqrt((line_x - car_x)**2 + (line_y - car_y)**2)
-        if distance < min_distance:
-            min_distance = distance
-            min_y = line_y
-
-    if not min_y == None:
-        # Up line
-        if min_y < car_y:
-            line_id = 1
-            is_safe = min_distance > safe_threshold
-            return is_safe, line_id
-        
-        if min_y > car_y:
-            line_id = 0
-            is_safe = min_distance > safe_threshold
-            return is_safe, line_id
-    else:
-        return True, 0
-
-def joystick_mode(keys, car_x, car_y):
-    if keys[pygame.K_UP]:
-        car_y = max(0, car_y - 5)
-    if keys[pygame.K_DOWN]:
-        car_y = min(HEIGHT, car_y + 5)
-    if keys[pygame.K_LEFT]:
-        car_x = max(0, car_x - 5)
-    if keys[pygame.K_RIGHT]:
-        car_x = min(WIDTH, car_x + 5)
-    return car_x, car_y
-
-
-def dynamic_mode(keys, state):
-    global FD  # Access global variable
-
-    if keys[pygame.K_UP]:
-        if state[5] > -5:
-            state[5] -= 0.1  # Steer left
-    elif keys[pygame.K_DOWN]:
-        if state[5] < 5:
-            state[5] += 0.1  # Steer right
-    else:
-        state[5] = 0
-
-    if keys[pygame.K_LEFT]:
-        FD = max(FD - 100, -10000)  # Decrease driving force (Newtons)
-    elif keys[pygame.K_RIGHT]:
-        FD = min(FD + 100, 10000)  # Increase driving force (Newtons)
-    else:
-        FD = 0
-
-    # Update state using Runge-Kutta integration
-    state = runge_kutta(car_dynamics, state, DT)
-    return state
+## CAR SIMULATION
 
-
-def kinematics_mode(keys, car_x, car_y, car_angle, car_speed):
-    global STEERING_ANGLE  # Access global variable
-    # Steering angle input
-    if keys[pygame.K_DOWN]:  # Move forward
-        STEERING_ANGLE += INCREMENT
-    elif keys[pygame.K_UP]:  # Move backward
-        STEERING_ANGLE -= INCREMENT
+def new_sensor():
+    """The sensor cone, cast over the lane mask of the road or over its lane line outlines."""
+    if LANE_GEOMETRY:
+        sensor_class = GeometrySensor
     else:
-        STEERING_ANGLE = 0  # No steering change
+        sensor_class = CoherentConeSensor if COHERENT_SENSOR else ConeSensor
+    return sensor_class(SENSOR_RANGE, SENSOR_ANGLE, angle_step=4)
 
-    # Speed control (accelerate or decelerate)
-    if keys[pygame.K_LEFT]:  # Turn left (counter-clockwise)
-        car_speed = min(car_speed - ACCELERATION, MAX_SPEED)
-    elif keys[pygame.K_RIGHT]:  # Turn right (clockwise)
-        car_speed = max(car_speed + ACCELERATION, -MAX_SPEED)
 
-    # Apply road friction to car speed
-    car_speed *= FRICTION
+def current_roads():
+    """
+    The roads driven: the three road images, or the tiles of the endless road
+    (road images, or cut from the generated world).
+    """
+    global road_world, road_world_source
+    if not ROAD_WORLD:
+        return road_assets
+    if road_world is None or road_world_source != (ROAD_WORLD, GENERATED_WORLD):
+        if road_world is not None:
+            road_world.shutdown()
+        road_world = RoadWorld(GeneratedTiles(GENERATED_WORLD, ROAD_WORLD) if GENERATED_WORLD
+                               else route(ROAD_WORLD))
+        road_world_source = (ROAD_WORLD, GENERATED_WORLD)
+    return road_world
+
+
+def new_simulation(mode="dynamic"):
+    """
+    The car (physics, sensor and LTA) with the constants above, read again on
+    every call so they can be changed first (see lta_sweep.py).
+    """
+    roads = current_roads()
+    roads.distance_fields = LTA_DISTANCE_FIELD or LTA_MPC
+    lta = "mpc" if LTA_MPC else "field" if LTA_DISTANCE_FIELD else "sensor"
+    return Simulation(roads, mode, lta=lta,
+                      sensor=new_sensor(), profiler=profiler, dt=DT, L=L, b=b, M=M, J=J,
+                      FA=FA, tau_s=tau_s, c_s=c_s, max_steer_angle=MAX_STEER_ANGLE,
+                      acceleration=ACCELERATION, max_speed=MAX_SPEED, increment=INCREMENT,
+                      friction=FRICTION, safe_distance=SAFE_DISTANCE_THRESHOLD,
+                      lta_correction=LTA_CORRECTION, width=WIDTH, height=HEIGHT,
+                      start=roads.assets.start if GENERATED_WORLD and ROAD_WORLD else START,
+                      continuous=bool(ROAD_WORLD))
+
+
+simulation = new_simulation()
+
+
+## HEADLESS BATCH MODE
+
+# Inputs used by --headless when no --script is given: speed up, drift
+# towards the centre line, then towards the bottom line, then coast
+DEFAULT_SCRIPT = [
+    (30, ["RIGHT"]),
+    (15, ["RIGHT", "UP"]),
+    (30, ["RIGHT"]),
+    (15, ["RIGHT", "DOWN"]),
+    (60, []),
+]
 
-    # Update car state using the new Runge-Kutta function
-    car_x, car_y, car_angle = runge_kutta(car_derivatives,
-                                          [car_x, car_y, car_angle], DT)
 
-    return car_x, car_y, car_angle, car_speed
+def load_script(path):
+    """
+    Read an input script: one "<steps> [KEY ...]" entry per line, where KEY is
+    a pygame key name without the K_ prefix (UP, DOWN, LEFT, RIGHT).
+    Everything after a '#' is a comment.
+    """
+    script = []
+    with open(path) as script_file:
+        for line in script_file:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                script.append((int(fields[0]), fields[1:]))
+    return script
+
+
+def scripted_inputs(script):
+    """Yield the inputs of every step (see sim_engine.inputs())."""
+    for steps, key_names in script:
+        step_inputs = inputs_from_names(key_names)
+        for _ in range(steps):
+            yield step_inputs
+
+
+def reset_simulation():
+    """Put the car back at the start of the first road, at rest."""
+    global simulation, unsafe_start_time, display_unsafe_message
+    simulation = new_simulation()
+    unsafe_start_time = None
+    display_unsafe_message = False
+
+
+def simulation_state():
+    """Everything the next steps depend on, to start a replay from (JSON friendly)."""
+    return {**simulation.get_state(), "LTA_DISTANCE_FIELD": LTA_DISTANCE_FIELD,
+            "LTA_MPC": LTA_MPC, "LANE_GEOMETRY": LANE_GEOMETRY, "COHERENT_SENSOR": COHERENT_SENSOR,
+            "ROAD_WORLD": ROAD_WORLD, "GENERATED_WORLD": GENERATED_WORLD}
+
+
+def restore_simulation(start):
+    """Go back to a state given by simulation_state()."""
+    global simulation, LTA_DISTANCE_FIELD, LTA_MPC, LANE_GEOMETRY, COHERENT_SENSOR, ROAD_WORLD, \
+        GENERATED_WORLD
+    LTA_DISTANCE_FIELD = start["LTA_DISTANCE_FIELD"]
+    LTA_MPC = start.get("LTA_MPC", False)  # Not in older recordings
+    LANE_GEOMETRY = start.get("LANE_GEOMETRY", False)  # Not in older recordings
+    COHERENT_SENSOR = start.get("COHERENT_SENSOR", False)
+    ROAD_WORLD = start.get("ROAD_WORLD", 0)
+    GENERATED_WORLD = start.get("GENERATED_WORLD")
+    simulation = new_simulation()
+    simulation.set_state(start)
+
+
+def simulate(mode, script, max_steps=None):
+    """
+    Drive the car in "dynamic" or "kinematics" mode on scripted inputs as fast
+    as possible (no window, no frame cap). Returns the trajectory, one
+    (time, x, y, angle, LTA intervention, road index) tuple per step.
+    """
+    simulation.mode = mode
+    trajectory = []
+    steps = 0
+    # The phases of the steps are only timed for --frame-stats, afresh for every run
+    timed = profiler if profiler.keep_samples else None
+    simulation.profiler = timed
+    if timed:
+        timed.reset()
+
+    for step_inputs in scripted_inputs(script):
+        if max_steps is not None and steps >= max_steps:
+            break
+
+        if timed:
+            timed.start_frame()
+        if not simulation.step(step_inputs):
+            break
+        if timed:
+            timed.end_frame()
+
+        steps += 1
+        trajectory.append((steps * DT, simulation.x, simulation.y, simulation.angle,
+                           simulation.lta_active, simulation.road_index))
+
+    return trajectory
+
+
+def replay(recording):
+    """Replay an InputRecorder recording from its start state: the (x, y, angle) after every step."""
+    reset_simulation()
+    restore_simulation(recording["start"])
+    trajectory = simulate(recording["mode"], recording["script"])
+    return [(x, y, angle) for _, x, y, angle, _, _ in trajectory]
+
+
+def run_headless(mode, script, trajectory_path, max_steps=None):
+    """Run simulate(), report the steps per second and save the trajectory."""
+    start = time.perf_counter()
+    trajectory = simulate(mode, script, max_steps)
+    elapsed = time.perf_counter() - start
+    if simulation.finished:
+        print("End of map, congrats!")
+    print(f"{len(trajectory)} steps in {elapsed:.3f} s "
+          f"({len(trajectory) / max(elapsed, 1e-9):.0f} steps/s)")
+    if isinstance(simulation.sensor, CoherentConeSensor):
+        stats = simulation.sensor.stats()
+        print(f"sensor: {stats['samples_per_cast']:.0f} samples per cast, "
+              f"warm start hit rate {stats['warm_hit_rate']:.1%}")
+    if simulation.controller is not None:
+        stats = simulation.controller.stats()
+        print(f"MPC: {stats['ticks']} ticks, {stats['median_ms']:.2f} ms median, "
+              f"{stats['p99_ms']:.2f} ms p99, {stats['max_ms']:.2f} ms max, "
+              f"{stats['over_budget']} over the {simulation.controller.budget * 1e3:g} ms budget")
+
+    # Same layout as detected_positions.txt (x, y from the bottom, time),
+    # followed by the car angle and whether the LTA intervened
+    with open(trajectory_path, "w") as trajectory_file:
+        for sim_time, x, y, angle, lta, _ in trajectory:
+            trajectory_file.write(f"{x:.2f} \t {HEIGHT - y:.2f} \t {sim_time:.2f}"
+                                  f" \t {angle:.4f} \t {int(lta)}\n")
+    return trajectory
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Car simulation with LTA")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window or frame cap on scripted inputs")
+    parser.add_argument("--mode", choices=["dynamic", "kinematics"],
+                        default="dynamic", help="car model used by --headless")
+    parser.add_argument("--script", help="input script for --headless")
+    parser.add_argument("--steps", type=int,
+                        help="stop --headless after this many steps")
+    parser.add_argument("--trajectory", default="trajectory.txt",
+                        help="file the --headless trajectory is written to")
+    parser.add_argument("--distance-field", action="store_true",
+                        help="LTA uses the road's precomputed distance field "
+                             "instead of the sensor detections")
+    parser.add_argument("--mpc", action="store_true",
+                        help="LTA picks its correction every step from rollouts of the car "
+                             "model over the road's distance field (mpc_lta.py)")
+    parser.add_argument("--lane-geometry", action="store_true",
+                        help="the sensor intersects its rays with the lane lines extracted "
+                             "as outlines (lane_geometry.py) instead of sampling pixels")
+    parser.add_argument("--coherent-sensor", action="store_true",
+                        help="the sensor samples its rays only a little past their hits of the last "
+                             "step before marching the rest (lane_sensor.CoherentConeSensor)")
+    parser.add_argument("--world", type=int, default=0, metavar="TILES",
+                        help="drive an endless road of TILES road tiles (road_world.py), "
+                             "loaded as the car gets to them, with a scrolling camera")
+    parser.add_argument("--generated", metavar="PATH",
+                        help=f"cut the tiles of --world (all of them by default) from the world "
+                             f"generated by road_generator.py at PATH, with --height {HEIGHT}")
+    parser.add_argument("--text-detections", action="store_true",
+                        help="also convert the detection log to detected_positions.txt on exit")
+    parser.add_argument("--frame-stats", metavar="PATH",
+                        help="write the time of every frame phase (p50/p95/p99) to PATH "
+                             "on exit, as JSON if it ends in .json, otherwise CSV")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="run under cProfile and write the stats to PATH")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record the inputs of every drive to PATH (JSON), to replay "
+                             "them with input_recording.py; a new drive overwrites it")
+    return parser.parse_args()
 
 
 # Fonts
@@ -333,173 +376,264 @@ def draw_home_screen(selected):
     pygame.display.flip()
 
 
-# Game loop
-while running:
-    if in_home_screen:
-        draw_home_screen(selected_option)
-
-        if not hasattr(draw_home_screen, "snapshot"):
-            draw_home_screen.snapshot = screen.copy()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected_option = (
-                                                  selected_option - 1) % 4  # Update to 4 options
-                elif event.key == pygame.K_DOWN:
-                    selected_option = (
-                                                  selected_option + 1) % 4  # Update to 4 options
-                elif event.key == pygame.K_RETURN:
-                    if selected_option == 3:  # Help option
-                        mode = "help"
-                    else:
-                        mode = ["joystick", "dynamic", "kinematics"][
-                            selected_option]
-                    in_home_screen = False
-                elif event.key == pygame.K_RIGHT and in_home_screen:
-                    selected_option = 3  # Select the Help option
-                elif event.key == pygame.K_LEFT and selected_option == 3:
-                    selected_option = 0  # Select the first option
-    else:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_q:
-                    in_home_screen = True
-                    car_x, car_y = 50, HEIGHT // 2 + 23
-                    car_angle = 0
-                    car_speed = 0
-                    state = [car_x, car_y, math.radians(car_angle), 0, 0, 0]
-                    del draw_home_screen.snapshot
-                elif event.key == pygame.K_s:
-                    # Toggle the sensor state
-                    sensor_active = not sensor_active
-
-        keys = pygame.key.get_pressed()
-
-        # Check for end of road (when car reaches the right edge of the current road)
-        road_width = road.get_width()  # Get the width of the current road image
-        if car_x >= road_width:  # Reached the right edge of the screen
-            current_road += 1
-            if current_road < len(road_images):
-                road = pygame.image.load(road_images[current_road])
-                if mode == "dynamic":
-                    state[0] = 0  # Reset car position to the left edge
-                car_x = 0  # Reset car position to the left edge
+if __name__ == "__main__":
+    args = parse_args()
+    profiler.keep_samples = bool(args.frame_stats)
+    if args.profile:
+        start_cprofile(args.profile)
+    if (args.distance_field or args.mpc or args.lane_geometry or args.coherent_sensor or args.world
+            or args.generated):
+        LTA_DISTANCE_FIELD = args.distance_field
+        LTA_MPC = args.mpc
+        LANE_GEOMETRY = args.lane_geometry
+        COHERENT_SENSOR = args.coherent_sensor
+        ROAD_WORLD = args.world
+        if args.generated:
+            generated = GeneratedWorld(args.generated)
+            if generated.height != HEIGHT:
+                sys.exit(f"{args.generated} is {generated.height} pixels high, not {HEIGHT}: "
+                         f"generate it with --height {HEIGHT}")
+            GENERATED_WORLD = args.generated
+            ROAD_WORLD = args.world or generated.width // TILE_WIDTH
+        reset_simulation()
+
+    if args.headless:
+        run_headless(args.mode,
+                     load_script(args.script) if args.script else DEFAULT_SCRIPT,
+                     args.trajectory, args.steps)
+        if args.frame_stats:
+            profiler.write(args.frame_stats)
+        pygame.quit()
+        sys.exit()
+
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Car Simulation")
+
+    # Load the roads again, converted to the display pixel format
+    simulation.roads.clear()
+    simulation.reset()
+
+    # Only the parts of the screen that change are redrawn and updated
+    renderer = DirtyRenderer(screen)
+
+    # Log the detected positions (binary, written by a background thread)
+    detection_log = DetectionLogger("detected_positions.bin")
+
+    # Fixed-timestep loop: the physics advances DT at a time, as many steps as
+    # the (time warped) wall clock time allows, independently of the frame rate
+    clock = pygame.time.Clock()
+    accumulator = 0.0  # Simulated time not stepped yet
+    warp_index = TIME_WARPS.index(1)
+    skipped_frames = 0
+    previous_pose = (simulation.x, simulation.y, simulation.angle)  # Car before the last physics step, drawn in between
+    recorder = None  # InputRecorder of the current drive (--record)
+
+    # Game loop
+    while running:
+        if in_home_screen:
+            draw_home_screen(selected_option)
+
+            if not hasattr(draw_home_screen, "snapshot"):
+                draw_home_screen.snapshot = screen.copy()
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_UP:
+                        selected_option = (
+                                                      selected_option - 1) % 4  # Update to 4 options
+                    elif event.key == pygame.K_DOWN:
+                        selected_option = (
+                                                      selected_option + 1) % 4  # Update to 4 options
+                    elif event.key == pygame.K_RETURN:
+                        if selected_option == 3:  # Help option
+                            mode = "help"
+                        else:
+                            mode = ["joystick", "dynamic", "kinematics"][
+                                selected_option]
+                        in_home_screen = False
+                        renderer.invalidate()  # The home screen covers the road
+                        if mode != "help":
+                            simulation.mode = mode
+                        if args.record and mode != "help":
+                            recorder = InputRecorder("CAR_LTA", mode, simulation_state(), DT)
+                    elif event.key == pygame.K_RIGHT and in_home_screen:
+                        selected_option = 3  # Select the Help option
+                    elif event.key == pygame.K_LEFT and selected_option == 3:
+                        selected_option = 0  # Select the first option
+        else:
+            profiler.start_frame()
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_q:
+                        in_home_screen = True
+                        simulation.reset(simulation.road_index)  # The car starts over on this road
+                        accumulator = 0.0
+                        previous_pose = (simulation.x, simulation.y, simulation.angle)
+                        del draw_home_screen.snapshot
+                        if recorder:
+                            recorder.save(args.record)
+                            recorder = None
+                    elif event.key == pygame.K_s:
+                        # Toggle the sensor state
+                        sensor_active = not sensor_active
+                        if recorder:
+                            recorder.record_sensor(sensor_active)
+                    elif event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                        warp_index = min(warp_index + 1, len(TIME_WARPS) - 1)  # Fast-forward
+                    elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                        warp_index = max(warp_index - 1, 0)  # Slow motion
+                    elif event.key == pygame.K_p:
+                        show_profiler = not show_profiler
+
+            keys = pygame.key.get_pressed()
+            step_inputs = key_inputs(keys)
+            profiler.lap("events")
+            frame_time = clock.tick(FPS) / 1000  # Wall clock seconds since the last frame
+            profiler.lap("frame cap")
+
+            # Physics substeps covering the time since the last frame
+            if mode in ("joystick", "dynamic", "kinematics"):
+                accumulator += min(frame_time, MAX_FRAME_TIME) * TIME_WARPS[warp_index]
+                if mode == "joystick":
+                    accumulator = DT  # No physics: the car moves once per frame
+            substeps = 0
+            while accumulator >= DT and substeps < MAX_SUBSTEPS:
+                previous_pose = (simulation.x, simulation.y, simulation.angle)
+                previous_road = simulation.road_index
+                if not simulation.step(step_inputs):
+                    print("End of map, congrats!")
+                    running = False
+                    break
+                pose = (simulation.x, simulation.y, simulation.angle)
+                if simulation.road_index != previous_road:
+                    previous_pose = pose  # Do not slide back across the screen
+                if recorder:
+                    recorder.record_step(keys, pose)
+
+                # Save the position and time of every detection to the log
+                current_time = pygame.time.get_ticks()   # Get current time in miliseconds
+                if simulation.lta_active:
+                    display_unsafe_message = True
+                    unsafe_start_time = current_time
+                detection_log.log(simulation.steps, simulation.steps * DT, current_time,
+                                  simulation.detected_lines)
+                profiler.lap("logging")
+
+                accumulator -= DT
+                substeps += 1
+
+            if accumulator >= DT:
+                # Rendering falls behind: skip drawing a few frames, then drop the backlog
+                if skipped_frames < MAX_FRAME_SKIP:
+                    skipped_frames += 1
+                    profiler.end_frame()
+                    continue
+                accumulator %= DT
+            skipped_frames = 0
+
+            # Draw the background (road): erase what was drawn on the last frame
+            alpha = 1 if mode == "joystick" else accumulator / DT  # Car drawn between the last two steps
+            previous_x, previous_y, previous_angle = previous_pose
+            draw_x = previous_x + (simulation.x - previous_x) * alpha
+            camera_x = 0  # Road x at the left of the screen
+            if ROAD_WORLD:
+                # Scrolling camera: the car stays at CAMERA_X and the tiles move under it.
+                # The road is redrawn in full on every frame it scrolls (every pixel moved)
+                camera_x = draw_x - CAMERA_X
+                if simulation.road_index == 0:
+                    camera_x = max(camera_x, 0)  # Nothing before the first tile
+                if simulation.road_index == len(simulation.roads) - 1:
+                    camera_x = min(camera_x, len(simulation.road.mask) - WIDTH)  # Or after the last
+                renderer.set_tiles([(surface, (round(offset - camera_x), 0)) for surface, offset
+                                    in simulation.roads.surfaces(simulation.road_index)])
             else:
-                print("End of map, congrats!")
-                running = False
-
-        # Draw the background (road)
-        screen.blit(road, (0, 0))
-
-        # Calculate the front of the car
-        car_front_x = car_x
-        car_front_y = car_y
-
-        # Define the color of the road lines (e.g., white lines)
-        LINE_COLORS = [
-            (250, 253, 253),  # #fafdfd
-            (206, 213, 205),  # #ced5cd
-            (140, 136, 129),  # #8c8881
-            (229, 230, 229),  # #e5e6e5
-        ]
-
-        # Sensor simulation (anchored at the front of the car)
-        detected_lines = []  # To store the positions of detected lines
-
-        for angle_offset in range(-SENSOR_ANGLE // 2, SENSOR_ANGLE // 2 + 1,
-                                    4):  # Steps within the cone
-                sensor_angle = - car_angle - math.radians(
-                - angle_offset)  # Adjust for rotation
-                for distance in range(1, SENSOR_RANGE,
-                                        5):  # Incremental steps along the ray
-                    sensor_x = int(
-                        car_front_x + distance * math.cos(sensor_angle))
-                    sensor_y = int(
-                        car_front_y - distance * math.sin(sensor_angle))
-
-                    # Ensure the sensor point is within screen bounds
-                    if 0 <= sensor_x < WIDTH and 0 <= sensor_y < HEIGHT:
-                        # Check the color of the pixel at the sensor point
-                        pixel_color = road.get_at((sensor_x, sensor_y))[
-                                        :3]  # Ignore alpha channel
-                        if pixel_color in LINE_COLORS:
-                            detected_lines.append((sensor_x,
-                                                    sensor_y))  # Record detected line position
-                            # Save the position and time to the file
-                            current_time = pygame.time.get_ticks()   # Get current time in miliseconds
-                            file.write(f"{sensor_x} \t {HEIGHT - sensor_y} \t {current_time:.2f}\n")
-                            break  # Stop the ray once a line is detected
-                    if sensor_active:
-                        # Draw the sensor ray
-                        pygame.draw.line(screen, (0, 255, 0),
-                                            (car_front_x, car_front_y),
-                                            (sensor_x, sensor_y), 1)
-        # Draw detected lines (if any)
-        if sensor_active:
-            for line_pos in detected_lines:
-                pygame.draw.circle(screen, (255, 0, 0), line_pos,
-                                5)  # Red dots for detected lines
-
-        
-        if mode == "joystick":
-            car_x, car_y = joystick_mode(keys, car_x, car_y)
-
-        elif mode == "dynamic":
-            # Call the function in the game loop
-            state = dynamic_mode(keys, state)
-            car_x, car_y, car_angle, v_u, phi, u_2 = state
-            if display_unsafe_message:
-                if unsafe_start_time and pygame.time.get_ticks() - unsafe_start_time > 2000:
-                    display_unsafe_message = False
-                    unsafe_start_time = None
-                else:
-                    text_surface = font.render("Unsafe! LTA intervention", True,
-                                                (255, 0, 0))
-                    screen.blit(text_surface, (50, 50))
-
-        elif mode == "kinematics":
-            # Call the function in the game loop
-            car_x, car_y, car_angle, car_speed = kinematics_mode(keys, car_x,
-                                                                 car_y,
-                                                                 car_angle,
-                                                                 car_speed)
-            if display_unsafe_message:
-                if unsafe_start_time and pygame.time.get_ticks() - unsafe_start_time > 2000:
-                    display_unsafe_message = False
-                    unsafe_start_time = None
-                else:
-                    text_surface = font.render("Unsafe! LTA intervention", True,
-                                                (255, 0, 0))
-                    screen.blit(text_surface, (50, 50))
-
-                # Add the help mode handling
-        elif mode == "help":
-            screen.fill((0, 0, 0))  # Clear the screen
-            y_offset = 50
-            for line in help_text.split('\n'):
-                text_surface = font.render(line, True, (255, 255, 255))
-                screen.blit(text_surface, (50, y_offset))
-                y_offset += 40
-            pygame.display.flip()
-            pygame.time.wait(3000)  # Display help for 5 seconds
-            in_home_screen = True
-            mode = None
-
-            
-
-        # Rotate and draw the car
-        rotated_car = pygame.transform.rotate(car, -math.degrees(
-            car_angle))  # Negative angle to match screen coordinates
-        rect = rotated_car.get_rect(center=(car_x, car_y))
-        screen.blit(rotated_car, rect.topleft)
-
-        # Refresh screen
-        pygame.display.flip()
-        pygame.time.Clock().tick(60)
-
-pygame.quit()
+                renderer.set_background(simulation.road.surface)
+            renderer.begin()
+            profiler.lap("road blit")
+
+            # Calculate the front of the car
+            car_front_x = simulation.x - camera_x
+            car_front_y = simulation.y
+
+            if sensor_active:
+                # Draw the sensor rays
+                renderer.add_all([pygame.draw.line(screen, (0, 255, 0),
+                                                   (car_front_x, car_front_y),
+                                                   (ray_x - camera_x, ray_y), 1)
+                                  for ray_x, ray_y in simulation.ray_ends])
+            # Draw detected lines (if any)
+            if sensor_active:
+                for line_x, line_y in simulation.detected_lines:
+                    renderer.add(pygame.draw.circle(screen, (255, 0, 0), (line_x - camera_x, line_y),
+                                    5))  # Red dots for detected lines
+
+            if mode == "dynamic":
+                if display_unsafe_message:
+                    if unsafe_start_time and pygame.time.get_ticks() - unsafe_start_time > 2000:
+                        display_unsafe_message = False
+                        unsafe_start_time = None
+                    else:
+                        text_surface = font.render("Unsafe! LTA intervention", True,
+                                                    (255, 0, 0))
+                        renderer.add(screen.blit(text_surface, (50, 50)))
+
+            elif mode == "kinematics":
+                if display_unsafe_message:
+                    if unsafe_start_time and pygame.time.get_ticks() - unsafe_start_time > 2000:
+                        display_unsafe_message = False
+                        unsafe_start_time = None
+                    else:
+                        text_surface = font.render("Unsafe! LTA intervention", True,
+                                                    (255, 0, 0))
+                        renderer.add(screen.blit(text_surface, (50, 50)))
+
+                    # Add the help mode handling
+            elif mode == "help":
+                screen.fill((0, 0, 0))  # Clear the screen
+                y_offset = 50
+                for line in help_text.split('\n'):
+                    text_surface = font.render(line, True, (255, 255, 255))
+                    screen.blit(text_surface, (50, y_offset))
+                    y_offset += 40
+                pygame.display.flip()
+                pygame.time.wait(3000)  # Display help for 5 seconds
+                in_home_screen = True
+                mode = None
+                renderer.invalidate()
+
+            profiler.lap("draw")
+
+            # Rotate and draw the car, between the last two physics steps
+            draw_y = previous_y + (simulation.y - previous_y) * alpha
+            draw_angle = previous_angle + (simulation.angle - previous_angle) * alpha
+            renderer.add(car_sprites.draw(screen, -math.degrees(draw_angle),
+                                          (draw_x - camera_x, draw_y)))  # Negative angle to match screen coordinates
+            profiler.lap("car sprite")
+
+            if TIME_WARPS[warp_index] != 1:
+                text_surface = font.render(f"x{TIME_WARPS[warp_index]:g}", True, (255, 255, 255))
+                renderer.add(screen.blit(text_surface, (WIDTH - text_surface.get_width() - 20, 20)))
+            if show_profiler:
+                renderer.add(profiler.draw(screen))
+            profiler.lap("draw")
+
+            # Refresh the parts of the screen that changed
+            renderer.end()
+            profiler.lap("flip")
+            profiler.end_frame()
+
+    if recorder:
+        recorder.save(args.record)
+    if args.frame_stats:
+        profiler.write(args.frame_stats)
+    detection_log.close()
+    if args.text_detections:
+        to_text(detection_log.path, "detected_positions.txt", HEIGHT)
+    road_assets.shutdown()
+    if road_world is not None:
+        road_world.shutdown()
+    pygame.quit()
@@ -0,0 +1,203 @@
+import math
+import sys
+import time
+
+import numpy as np
+
+# Constants of the car (those of CAR_LTA.py), defined once in sim_engine
+from sim_engine import (ACCELERATION, DT, FA, FRICTION, INCREMENT, J, L, LTA_CORRECTION, M,
+                        MAX_SPEED, MAX_STEER_ANGLE, SAFE_DISTANCE_THRESHOLD, b, c_s, tau_s)
+
+# Columns of the state arrays
+X, Y, THETA, V_U, PHI, U_2 = range(6)
+
+# Steering and throttle commands, one per vehicle (the arrow keys of the simulators)
+UP, NONE, DOWN = -1, 0, 1  # steer
+LEFT, RIGHT = -1, 1  # throttle
+
+
+def lta_correction(states, lane_check, safe_threshold=SAFE_DISTANCE_THRESHOLD):
+    """
+    Steering correction of the LTA for every vehicle: +LTA_CORRECTION near the
+    up line, -LTA_CORRECTION near the down line, 0 when safe.
+    lane_check(xs, ys, safe_threshold) returns (is_safe, line_ids) arrays, e.g.
+    LaneDistanceField.is_safe_many.
+    """
+    if lane_check is None:
+        return np.zeros(len(states))
+    is_safe, line_ids = lane_check(states[:, X], states[:, Y], safe_threshold)
+    return np.where(is_safe, 0.0, np.where(line_ids == 1, LTA_CORRECTION, -LTA_CORRECTION))
+
+
+def car_dynamics(states, FD, u_2_LTA=0.0, FA=FA, M=M, J=J, tau_s=tau_s, c_s=c_s, out=None):
+    """
+    Dynamic model of Simulation.car_dynamics() in sim_engine.py for (N, 6) states
+    [x, y, theta, v_u, phi, u_2], without touching its arguments.
+    FD, u_2_LTA and the parameters are scalars or (N,) arrays.
+    The derivatives are written to out if it is given.
+    """
+    theta, v_u, phi, u_2 = states[:, THETA], states[:, V_U], states[:, PHI], states[:, U_2]
+
+    # Clamp steering angle
+    phi = np.clip(phi, -math.radians(MAX_STEER_ANGLE), math.radians(MAX_STEER_ANGLE))
+
+    cos_phi = np.cos(phi)
+    tan_phi = np.tan(phi)
+    tan_theta = np.tan(theta)
+    gamma = (cos_phi ** 2) * (L**2 * M + (M * b**2 + J) * (tan_phi ** 2))
+
+    derivatives = np.empty_like(states) if out is None else out
+    derivatives[:, X] = v_u * (np.cos(theta) - b / L * tan_theta * np.sin(theta))
+    derivatives[:, Y] = v_u * (np.sin(theta) + b / L * tan_theta * np.cos(theta))
+    derivatives[:, THETA] = v_u * tan_phi / L
+    dphi = (1 / tau_s) * (phi + c_s * (u_2 + u_2_LTA))  # Steering dynamics
+    derivatives[:, V_U] = (v_u * (b**2 * M + J) * tan_phi * dphi + L**2 * cos_phi**2) / gamma * (FD + FA)
+    derivatives[:, PHI] = dphi
+    derivatives[:, U_2] = 0
+    return derivatives
+
+
+def dynamic_step(states, FD, dt, lane_check=None, **params):
+    """
+    One RK4 step of car_dynamics for every vehicle. Returns the new (N, 6)
+    states and a boolean array of the vehicles the LTA intervened on.
+
+    The scalar car_dynamics() sets phi and u_2 of the state it is given to 0,
+    so in runge_kutta() only k1 sees them and the later stages (and the update)
+    start from phi = u_2 = 0. This is reproduced here so trajectories match.
+    """
+    u_2_LTA = lta_correction(states, lane_check)
+    lta_active = u_2_LTA != 0
+    k1 = car_dynamics(states, FD, u_2_LTA, **params)
+
+    base = states.copy()
+    base[:, PHI] = 0
+    base[:, U_2] = 0
+
+    stage = base + dt * 0.5 * k1
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k2 = car_dynamics(stage, FD, u_2_LTA, **params)
+
+    stage = base + dt * 0.5 * k2
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k3 = car_dynamics(stage, FD, u_2_LTA, **params)
+
+    stage = base + dt * k3
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k4 = car_dynamics(stage, FD, u_2_LTA, **params)
+
+    return base + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4), lta_active
+
+
+def dynamic_controls(states, FD, steer, throttle):
+    """
+    dynamic_mode() input handling for every vehicle: updates u_2 in states (in
+    place) and returns the new driving forces. steer is UP/NONE/DOWN and
+    throttle LEFT/NONE/RIGHT, as (N,) arrays.
+    """
+    u_2 = states[:, U_2]
+    states[:, U_2] = np.where(steer == UP, np.where(u_2 > -5, u_2 - 0.1, u_2),
+                              np.where(steer == DOWN, np.where(u_2 < 5, u_2 + 0.1, u_2), 0))
+    return np.where(throttle == LEFT, np.maximum(FD - 100, -10000),
+                    np.where(throttle == RIGHT, np.minimum(FD + 100, 10000), 0))
+
+
+def car_derivatives(states, speed, steering_angle, u_2_LTA=0.0, out=None):
+    """
+    Kinematic model of Simulation.car_derivatives() in sim_engine.py for (N, 3) states
+    [x, y, angle]. The derivatives are written to out if it is given.
+    """
+    angle = states[:, THETA]
+    derivatives = np.empty_like(states) if out is None else out
+    derivatives[:, X] = speed * np.cos(angle)
+    derivatives[:, Y] = speed * np.sin(angle)
+    derivatives[:, THETA] = (speed / L) * np.tan(np.radians(steering_angle + u_2_LTA))
+    return derivatives
+
+
+def kinematic_step(states, speed, steering_angle, dt, lane_check=None):
+    """
+    One RK4 step of car_derivatives for every vehicle: (new states, LTA intervened).
+    The CAR_LTA.py car integrates with the speed of the previous step
+    (Simulation speed_lag), so pass the speeds from before kinematic_controls()
+    to reproduce it.
+    """
+    u_2_LTA = lta_correction(states, lane_check)
+    lta_active = u_2_LTA != 0
+    k1 = car_derivatives(states, speed, steering_angle, u_2_LTA)
+
+    stage = states + dt * 0.5 * k1
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k2 = car_derivatives(stage, speed, steering_angle, u_2_LTA)
+
+    stage = states + dt * 0.5 * k2
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k3 = car_derivatives(stage, speed, steering_angle, u_2_LTA)
+
+    stage = states + dt * k3
+    u_2_LTA = lta_correction(stage, lane_check)
+    lta_active |= u_2_LTA != 0
+    k4 = car_derivatives(stage, speed, steering_angle, u_2_LTA)
+
+    return states + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4), lta_active
+
+
+def kinematic_controls(steering_angle, speed, steer, throttle):
+    """kinematics_mode() input handling for every vehicle: (new steering angles, new speeds)."""
+    steering_angle = np.where(steer == DOWN, steering_angle + INCREMENT,
+                              np.where(steer == UP, steering_angle - INCREMENT, 0))
+    speed = np.where(throttle == LEFT, np.minimum(speed - ACCELERATION, MAX_SPEED),
+                     np.where(throttle == RIGHT, np.maximum(speed + ACCELERATION, -MAX_SPEED), speed))
+    return steering_angle, speed * FRICTION
+
+
+def start_states(n, car_x=50, car_y=323, model="dynamic"):
+    """(n, 6) dynamic or (n, 3) kinematic states of n cars at the starting position."""
+    states = np.zeros((n, 6 if model == "dynamic" else 3))
+    states[:, X] = car_x
+    states[:, Y] = car_y
+    return states
+
+
+if __name__ == "__main__":
+    # Monte Carlo style benchmark: N cars with random inputs, e.g. python batched_dynamics.py 10000
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    steps = 200
+    dt = DT
+    rng = np.random.default_rng(0)
+
+    from distance_field import load_distance_field
+    lane_check = load_distance_field("road1.png").is_safe_many
+
+    states = start_states(n)
+    FD = np.zeros(n)
+    interventions = np.zeros(n, dtype=int)
+    start = time.perf_counter()
+    for step in range(steps):
+        steer = rng.integers(-1, 2, n)
+        throttle = np.where(rng.random(n) < 0.8, RIGHT, NONE)
+        FD = dynamic_controls(states, FD, steer, throttle)
+        states, lta_active = dynamic_step(states, FD, dt, lane_check)
+        interventions += lta_active
+    elapsed = time.perf_counter() - start
+    print(f"dynamic:   {n} cars x {steps} steps in {elapsed:.2f} s "
+          f"({n * steps / elapsed:,.0f} car-steps/s), "
+          f"{np.mean(interventions > 0):.0%} of cars had an LTA intervention")
+
+    states = start_states(n, model="kinematic")
+    speed, steering_angle = np.zeros(n), np.zeros(n)
+    start = time.perf_counter()
+    for step in range(steps):
+        steer = rng.integers(-1, 2, n)
+        throttle = np.where(rng.random(n) < 0.8, RIGHT, NONE)
+        steering_angle, new_speed = kinematic_controls(steering_angle, speed, steer, throttle)
+        states, lta_active = kinematic_step(states, speed, steering_angle, dt, lane_check)
+        speed = new_speed
+    elapsed = time.perf_counter() - start
+    print(f"kinematic: {n} cars x {steps} steps in {elapsed:.2f} s "
+          f"({n * steps / elapsed:,.0f} car-steps/s)")
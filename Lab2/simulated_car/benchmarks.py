@@ -0,0 +1,307 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import timeit
+
+# Benchmarks of the simulator hot paths, headless and on fixed synthetic inputs.
+#   python benchmarks.py           run, and compare with the baseline if there is one
+#   python benchmarks.py --save    run and store the results as the baseline
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+BASELINE = "benchmark_baseline.json"
+TOLERANCE = 0.15  # Slower than the baseline by more than this fraction is a regression
+SEED = 0
+
+# name -> function returning the callable to time (set up once, outside the timing)
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def simulator():
+    """The Simulation of CAR_LTA.py imported headless, reset, with the car on the first road."""
+    import CAR_LTA
+    CAR_LTA.reset_simulation()
+    return CAR_LTA.simulation
+
+
+def detections(n, seed=SEED):
+    """n random detected line points on the screen."""
+    rng = random.Random(seed)
+    return [(rng.randint(0, 999), rng.randint(0, 599)) for _ in range(n)]
+
+
+@benchmark("rk4_car_dynamics")
+def setup_rk4_dynamics():
+    sim = simulator()
+    sim.FD = 500
+    sim.detected_lines = detections(6)
+    state = [400.0, 310.0, 0.05, 5.0, 0.01, 0.1]
+    # car_dynamics zeroes phi and u_2 of the state it is given: start from a copy every call
+    return lambda: sim.runge_kutta(sim.car_dynamics, list(state))
+
+
+@benchmark("rk4_car_derivatives")
+def setup_rk4_kinematics():
+    sim = simulator()
+    sim.speed = 5.0
+    sim.steering_angle = 0.3
+    sim.detected_lines = detections(6)
+    state = [400.0, 310.0, 0.05]
+    return lambda: sim.runge_kutta(sim.car_derivatives, state)
+
+
+@benchmark("mpc_dynamic_rollout")
+def setup_mpc_dynamic_rollout():
+    from mpc_lta import (CANDIDATES, HORIZON, MAX_CORRECTION, correction_sequences,
+                         dynamic_rollout, held_controls)
+    from sim_engine import RIGHT
+    sim = simulator()
+    sim.state = [400.0, 310.0, 0.05, 5.0, 0.01, 0.1]
+    sim.FD = 500
+    sequences = correction_sequences(CANDIDATES, HORIZON, MAX_CORRECTION)
+    controls = held_controls(sim, RIGHT, HORIZON)
+    return lambda: dynamic_rollout(sim, sequences, *controls)
+
+
+@benchmark("mpc_kinematic_rollout")
+def setup_mpc_kinematic_rollout():
+    from mpc_lta import (CANDIDATES, HORIZON, MAX_CORRECTION, correction_sequences,
+                         held_controls, kinematic_rollout)
+    from sim_engine import RIGHT
+    sim = simulator()
+    sim.mode = "kinematics"
+    sim.x, sim.y, sim.angle, sim.speed = 400.0, 310.0, 0.05, 5.0
+    sequences = correction_sequences(CANDIDATES, HORIZON, MAX_CORRECTION)
+    controls = held_controls(sim, RIGHT, HORIZON)
+    return lambda: kinematic_rollout(sim, sequences, *controls)
+
+
+@benchmark("traffic_step_200")
+def setup_traffic_step():
+    from traffic import Traffic
+    traffic = Traffic(200)
+    for _ in range(100):  # Cars spread out from the start
+        traffic.step()
+    return traffic.step
+
+
+@benchmark("sensor_cone_cast")
+def setup_sensor():
+    sim = simulator()
+    mask = sim.road.mask
+    return lambda: sim.sensor.cast(mask, 400.0, 310.0, 0.05)
+
+
+@benchmark("sensor_geometry_cast")
+def setup_geometry_sensor():
+    from lane_geometry import GeometrySensor, lane_geometry
+    sim = simulator()
+    mask = sim.road.mask
+    lane_geometry(mask)  # Extracted once per road, not every frame
+    sensor = GeometrySensor(450, 20, angle_step=4)
+    return lambda: sensor.cast(mask, 400.0, 310.0, 0.05)
+
+
+@benchmark("sensor_coherent_cast")
+def setup_coherent_sensor():
+    from lane_sensor import CoherentConeSensor
+    sim = simulator()
+    mask = sim.road.mask
+    sensor = CoherentConeSensor(450, 20, angle_step=4)
+    sensor.cast(mask, 400.0, 310.0, 0.05)  # Every ray starts from its last hit, as on a drive
+    return lambda: sensor.cast(mask, 400.0, 310.0, 0.05)
+
+
+def setup_safe_distance(n):
+    from detection_index import calculate_safe_distance_loop
+    sim = simulator()
+    points = detections(n)
+    return lambda: calculate_safe_distance_loop(500.5, 300.5, points, sim.safe_distance)
+
+
+def setup_detection_index(n):
+    from detection_index import DetectionIndex
+    sim = simulator()
+    points = detections(n)
+    # One frame: build the index and check the 4 RK4 stages
+    stages = [(500.5 + 0.5 * k, 300.5) for k in (0, 1, 1, 2)]
+
+    def frame():
+        index = DetectionIndex(points)
+        for x, y in stages:
+            index.is_safe(x, y, sim.safe_distance)
+    return frame
+
+
+for n in (10, 100, 1000):
+    benchmark(f"calculate_safe_distance_{n}")(lambda n=n: setup_safe_distance(n))
+    benchmark(f"detection_index_frame_{n}")(lambda n=n: setup_detection_index(n))
+
+
+def display():
+    screen = pygame.display.get_surface()
+    return screen if screen is not None else pygame.display.set_mode((1000, 600))
+
+
+@benchmark("road_blit")
+def setup_road_blit():
+    screen = display()
+    road = pygame.image.load("road1.png").convert()
+    return lambda: screen.blit(road, (0, 0))
+
+
+@benchmark("sprite_rotate")
+def setup_sprite_rotate():
+    screen = display()
+    car = pygame.image.load("car.png").convert_alpha()
+    angles = iter(range(10 ** 9))
+
+    def draw():
+        rotated = pygame.transform.rotate(car, next(angles) % 360 * 0.37)
+        screen.blit(rotated, rotated.get_rect(center=(500, 300)))
+    return draw
+
+
+@benchmark("sprite_cache_draw")
+def setup_sprite_cache():
+    from sprite_cache import RotationCache
+    screen = display()
+    cache = RotationCache(pygame.image.load("car.png").convert_alpha())
+    angles = iter(range(10 ** 9))
+    return lambda: cache.draw(screen, next(angles) % 360 * 0.37, (500, 300))
+
+
+def frame_setup():
+    """Screen, road, car sprites and a generator of car poses driving along the road."""
+    from sprite_cache import RotationCache
+    screen = display()
+    road = pygame.image.load("road1.png").convert()
+    cache = RotationCache(pygame.image.load("car.png").convert_alpha())
+    poses = ((100 + frame % 800, 310 + frame % 7, frame % 360 * 0.37) for frame in range(10 ** 9))
+    return screen, road, cache, poses
+
+
+def draw_cone(screen, pose):
+    x, y, angle = pose
+    return [pygame.draw.line(screen, (0, 255, 0), (x, y),
+                             (x + 450 * math.cos(math.radians(angle + offset)),
+                              y + 450 * math.sin(math.radians(angle + offset))), 1)
+            for offset in range(-10, 11, 4)]
+
+
+@benchmark("frame_full_redraw")
+def setup_full_redraw():
+    screen, road, cache, poses = frame_setup()
+
+    def frame():
+        pose = next(poses)
+        screen.blit(road, (0, 0))
+        draw_cone(screen, pose)
+        cache.draw(screen, pose[2], pose[:2])
+        pygame.display.flip()
+    return frame
+
+
+@benchmark("frame_dirty_rects")
+def setup_dirty_rects():
+    from dirty_renderer import DirtyRenderer
+    screen, road, cache, poses = frame_setup()
+    renderer = DirtyRenderer(screen)
+    renderer.set_background(road)
+
+    def frame():
+        pose = next(poses)
+        renderer.begin()
+        renderer.add_all(draw_cone(screen, pose))
+        renderer.add(cache.draw(screen, pose[2], pose[:2]))
+        renderer.end()
+    return frame
+
+
+def time_call(function, repeat=5):
+    """Best time of one call in seconds, over repeat runs of about 0.2 s each."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(names, repeat=5):
+    results = {}
+    for name in names:
+        results[name] = time_call(BENCHMARKS[name](), repeat)
+        print(f"{name:32}{results[name] * 1e6:12.2f} us", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Print the change of every benchmark against the baseline; returns the regressions."""
+    regressions = []
+    print(f"\n{'benchmark':32}{'baseline':>12}{'now':>12}{'change':>9}")
+    for name, seconds in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:32}{'-':>12}{seconds * 1e6:10.2f}us{'new':>9}")
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif change < -tolerance:
+            flag = "  faster"
+        print(f"{name:32}{before * 1e6:10.2f}us{seconds * 1e6:10.2f}us{change:+9.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulator hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all); "
+                        "a name ending in * selects every benchmark starting with it")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline results (JSON)")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="slowdown (fraction) counted as a regression")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS)
+    if args.names:
+        names = [name for name in names if any(
+            name == pattern or (pattern.endswith("*") and name.startswith(pattern[:-1]))
+            for pattern in args.names)]
+        if not names:
+            parser.error(f"no benchmark matches {' '.join(args.names)}; there are: "
+                         f"{', '.join(BENCHMARKS)}")
+
+    pygame.init()
+    results = run(names, args.repeat)
+
+    if args.save:
+        baseline = {"python": platform.python_version(), "machine": platform.machine(),
+                    "pygame": pygame.version.ver, "results": results}
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
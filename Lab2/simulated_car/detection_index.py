@@ -0,0 +1,97 @@
+import math
+import random
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Below this many detections a linear scan is cheaper than building the tree
+TREE_MIN_POINTS = 32
+
+
+class DetectionIndex:
+    """
+    One frame of sensor detections in a KD-tree, so the LTA finds the nearest
+    detected line point in O(log n); with only a few detections (the default
+    sensor cone) a plain scan is used instead. Safety verdicts are memoized
+    per position, so repeated checks in the same frame are free.
+    """
+
+    def __init__(self, detected_lines):
+        self.detected_lines = detected_lines
+        self.tree = None
+        if len(detected_lines) >= TREE_MIN_POINTS:
+            self.points = np.asarray(detected_lines, dtype=np.float64)
+            self.tree = cKDTree(self.points)
+        self.verdicts = {}  # (x, y, safe_threshold) -> (is_safe, line_id)
+
+    def nearest(self, x, y):
+        """Return (distance, line_y) of the nearest detection, or (inf, None) if there is none."""
+        if self.tree is not None:
+            distance, i = self.tree.query((x, y))
+            return float(distance), float(self.points[i, 1])
+
+        min_distance, min_y = float('inf'), None
+        for line_x, line_y in self.detected_lines:
+            distance = math.sqrt((line_x - x)**2 + (line_y - y)**2)
+            if distance < min_distance:
+                min_distance, min_y = distance, line_y
+        return min_distance, min_y
+
+    def is_safe(self, x, y, safe_threshold):
+        """Same result as calculate_safe_distance(): (is_safe, line_id), 1 = up line, 0 = down line."""
+        key = (x, y, safe_threshold)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            distance, line_y = self.nearest(x, y)
+            if line_y is None:
+                verdict = (True, 0)
+            else:
+                verdict = (distance > safe_threshold, 1 if line_y < y else 0)
+            self.verdicts[key] = verdict
+        return verdict
+
+
+def calculate_safe_distance_loop(car_x, car_y, detected_lines, safe_threshold):
+    """Linear scan over the detections, as the original calculate_safe_distance() of CAR_LTA.py."""
+    min_distance = float('inf')
+    min_y = None
+    for line_x, line_y in detected_lines:
+        distance = math.sqrt((line_x - car_x)**2 + (line_y - car_y)**2)
+        if distance < min_distance:
+            min_distance = distance
+            min_y = line_y
+    if min_y is None:
+        return True, 0
+    return min_distance > safe_threshold, 1 if min_y < car_y else 0
+
+
+if __name__ == "__main__":
+    # One frame = 4 RK4 stages at nearby positions, each checked the way
+    # car_dynamics used to: 4 calls with the same arguments
+    random.seed(0)
+    frames = 500
+    for n_points in (10, 100, 1000):
+        frames_data = []
+        for _ in range(frames):
+            points = [(random.randint(0, 999), random.randint(0, 599)) for _ in range(n_points)]
+            x, y = random.uniform(0, 1000), random.uniform(0, 600)
+            frames_data.append((points, [(x + 0.5 * k, y) for k in (0, 1, 1, 2)]))
+
+        start = time.perf_counter()
+        for points, stages in frames_data:
+            for x, y in stages:
+                for _ in range(4):
+                    calculate_safe_distance_loop(x, y, points, 25)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for points, stages in frames_data:
+            index = DetectionIndex(points)
+            for x, y in stages:
+                for _ in range(4):
+                    index.is_safe(x, y, 25)
+        index_time = time.perf_counter() - start
+
+        print(f"{n_points:5d} detections: loop {loop_time / frames * 1e6:8.1f} us/frame, "
+              f"index {index_time / frames * 1e6:8.1f} us/frame")
@@ -0,0 +1,160 @@
+import atexit
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+# One detection: physics step, simulated time (s), pygame ticks (ms) and screen position
+RECORD = np.dtype([("frame", "<u4"), ("sim_time", "<f4"), ("ticks", "<u4"),
+                   ("x", "<i2"), ("y", "<i2")])
+PACKER = struct.Struct("<IfIhh")  # The same layout, to fill the buffer without numpy overhead
+MAGIC = b"LTADET01"  # File header, followed by RECORD records
+
+CAPACITY = 1 << 16  # Detections the ring buffer holds
+FLUSH_INTERVAL = 0.5  # Seconds between two writes of the background thread
+
+
+class DetectionLogger:
+    """
+    Detections logged to a preallocated ring buffer and written to a binary
+    file of fixed-width records by a background thread, so logging costs the
+    game loop a copy instead of formatted text I/O. Everything is written
+    when the logger is closed, at the latest when the interpreter exits.
+    """
+
+    def __init__(self, path, capacity=CAPACITY, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.buffer = bytearray(capacity * PACKER.size)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.written = 0  # Records handed to log() so far
+        self.drained = 0  # Records written to the file so far
+        self.waits = 0  # Times log() had to wait for the writer (buffer full)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.thread = threading.Thread(target=self._drain, name="detection-logger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, frame, sim_time, ticks, detections):
+        """Add the (x, y) detections of one physics step."""
+        n = len(detections)
+        if n == 0:
+            return
+        if n > self.capacity:
+            raise ValueError(f"{n} detections do not fit in a buffer of {self.capacity}")
+        with self.condition:
+            while self.written + n - self.drained > self.capacity:
+                self.waits += 1
+                self.condition.notify()
+                self.condition.wait()
+        # The writer does not touch the free part of the buffer, no lock needed
+        pack_into, buffer, size, capacity = PACKER.pack_into, self.buffer, PACKER.size, self.capacity
+        index = self.written % capacity
+        for x, y in detections:
+            pack_into(buffer, index * size, frame, sim_time, ticks, x, y)
+            index = index + 1 if index + 1 < capacity else 0
+        with self.condition:
+            self.written += n
+
+    def _drain(self):
+        """Background thread: write whatever is in the buffer every flush_interval."""
+        while True:
+            with self.condition:
+                if not self.closed:
+                    self.condition.wait(self.flush_interval)
+                closed = self.closed
+                drained, written = self.drained, self.written
+            # The records between drained and written are not touched by log() until freed
+            view = memoryview(self.buffer)
+            while drained < written:
+                start = drained % self.capacity
+                end = min(start + written - drained, self.capacity)
+                self.file.write(view[start * PACKER.size:end * PACKER.size])
+                drained += end - start
+            view.release()
+            self.file.flush()
+            with self.condition:
+                self.drained = drained
+                self.condition.notify_all()
+            if closed:
+                return
+
+    def close(self):
+        """Write everything logged so far and close the file."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.file.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_detections(path):
+    """The records of a detection log, as a structured array of RECORD."""
+    with open(path, "rb") as log_file:
+        if log_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a detection log")
+        return np.fromfile(log_file, dtype=RECORD)
+
+
+def to_text(path, text_path="detected_positions.txt", height=600):
+    """Convert a detection log to the text format of detected_positions.txt."""
+    records = read_detections(path)
+    with open(text_path, "w") as text_file:
+        for x, y, ticks in zip(records["x"].tolist(), records["y"].tolist(),
+                               records["ticks"].tolist()):
+            text_file.write(f"{x} \t {height - y} \t {ticks:.2f}\n")
+    return len(records)
+
+
+if __name__ == "__main__":
+    # python detection_logger.py detected_positions.bin [detected_positions.txt]: convert a log
+    # python detection_logger.py --benchmark: text file writes vs the logger
+    if len(sys.argv) > 1 and sys.argv[1] != "--benchmark":
+        text_path = sys.argv[2] if len(sys.argv) > 2 else "detected_positions.txt"
+        print(f"{to_text(sys.argv[1], text_path)} detections written to {text_path}")
+        sys.exit()
+
+    import os
+    import tempfile
+    frames = 20000
+    detections = [(100 + 4 * i, 205 + i) for i in range(6)]  # A typical sensor frame
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, "detected_positions.txt")
+        start = time.perf_counter()
+        with open(text_path, "w") as file:
+            for frame in range(frames):
+                for sensor_x, sensor_y in detections:
+                    file.write(f"{sensor_x} \t {600 - sensor_y} \t {frame * 16:.2f}\n")
+        text_time = time.perf_counter() - start
+
+        log_path = os.path.join(directory, "detected_positions.bin")
+        start = time.perf_counter()
+        logger = DetectionLogger(log_path)
+        for frame in range(frames):
+            logger.log(frame, frame * 0.1, frame * 16, detections)
+        log_time = time.perf_counter() - start
+        logger.close()
+
+        converted_path = os.path.join(directory, "converted.txt")
+        to_text(log_path, converted_path)
+        with open(text_path) as expected, open(converted_path) as converted:
+            same = expected.read() == converted.read()
+        print(f"text writes: {text_time / frames * 1e6:6.2f} us/frame, "
+              f"{os.path.getsize(text_path) / 1e6:.2f} MB")
+        print(f"logger:      {log_time / frames * 1e6:6.2f} us/frame, "
+              f"{os.path.getsize(log_path) / 1e6:.2f} MB, "
+              f"text conversion {'identical' if same else 'DIFFERENT'}")
@@ -0,0 +1,80 @@
+import pygame
+
+# Dirty rectangles covering more than this fraction of the screen: flip it all instead
+FULL_UPDATE_FRACTION = 0.5
+
+
+class DirtyRenderer:
+    """
+    Frames drawn over a static background (the road) by erasing and showing
+    only what changed: the rectangles drawn on the previous frame and the ones
+    drawn on this frame (car, sensor cone, text), instead of blitting the
+    whole road and flipping the whole screen every frame. Everything is
+    redrawn after a new background or invalidate(). The background can also
+    be made of tiles (set_tiles()), e.g. road tiles around a scrolling camera.
+    A frame the camera scrolled on moves every pixel of the screen, so it is
+    drawn and flipped in full; only the frames it stands still on are dirty.
+
+        renderer.set_background(road)
+        renderer.begin()
+        renderer.add(car_sprites.draw(screen, angle, center))
+        renderer.end()
+    """
+
+    def __init__(self, screen, full_update_fraction=FULL_UPDATE_FRACTION):
+        self.screen = screen
+        self.screen_rect = screen.get_rect()
+        self.full_update_area = full_update_fraction * self.screen_rect.width * self.screen_rect.height
+        self.tiles = []  # Background: (surface, position) tiles
+        self.full = True  # Redraw and flip the whole screen this frame
+        self.previous = []  # Rects drawn on the previous frame
+        self.current = []  # Rects drawn on this frame
+
+    def set_background(self, background):
+        """The surface under everything, e.g. the road; a new one is drawn in full."""
+        self.set_tiles([(background, (0, 0))])
+
+    def set_tiles(self, tiles):
+        """
+        A background of (surface, (x, y)) tiles; drawn in full when a tile or
+        position changes (on every frame the tiles scroll).
+        """
+        if tiles != self.tiles:  # Surfaces compare by identity
+            self.tiles = tiles
+            self.full = True
+
+    def invalidate(self):
+        """Something else drew over the screen (home screen, help): redraw all of it."""
+        self.full = True
+
+    def begin(self):
+        """Start a frame: erase what the previous frame drew over the background."""
+        if self.full:
+            for surface, position in self.tiles:
+                self.screen.blit(surface, position)
+        else:
+            for rect in self.previous:
+                for surface, (x, y) in self.tiles:
+                    self.screen.blit(surface, rect, rect.move(-x, -y))
+
+    def add(self, rect):
+        """Mark rect (what a blit or pygame.draw call returns) as drawn this frame."""
+        if rect:  # Empty when nothing was drawn on the screen
+            self.current.append(rect)
+        return rect
+
+    def add_all(self, rects):
+        """Mark the bounding box of several rects, e.g. the rays of the sensor cone."""
+        rects = [rect for rect in rects if rect]
+        if rects:
+            self.current.append(rects[0].unionall(rects[1:]))
+
+    def end(self):
+        """Show the frame: update the erased and drawn rects, or flip the whole screen."""
+        dirty = self.previous + self.current
+        if self.full or sum(rect.width * rect.height for rect in dirty) > self.full_update_area:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty)
+        self.full = False
+        self.previous, self.current = self.current, []
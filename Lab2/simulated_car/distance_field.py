@@ -0,0 +1,107 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pygame
+from scipy.ndimage import distance_transform_edt
+
+from lane_sensor import LINE_COLORS, lane_mask
+from road_assets import CAPACITY
+
+# Distance fields already loaded, per road image file, least recently used first:
+# as many as RoadAssets keeps roads, RoadAssets loads them on its prefetch thread
+_fields = collections.OrderedDict()
+_fields_lock = threading.Lock()
+
+
+class LaneDistanceField:
+    """
+    Distance from every pixel of a road to the nearest lane line pixel, and the
+    y of that line pixel, so the LTA can check any (x, y) in constant time.
+    """
+
+    def __init__(self, distance, nearest_y):
+        self.distance = distance  # (width, height) float32, pixels
+        self.nearest_y = nearest_y  # (width, height) int16, y of the nearest line pixel
+        self.width, self.height = distance.shape
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Euclidean distance transform of a (width, height) lane mask."""
+        distance, indices = distance_transform_edt(~mask, return_indices=True)
+        return cls(distance.astype(np.float32), indices[1].astype(np.int16))
+
+    def query(self, x, y):
+        """Return (distance, line_id) of the nearest line: 1 = up line, 0 = down line."""
+        px, py = int(x), int(y)
+        if not (0 <= px < self.width and 0 <= py < self.height):
+            return float('inf'), 0
+        line_id = 1 if self.nearest_y[px, py] < y else 0
+        return float(self.distance[px, py]), line_id
+
+    def is_safe(self, x, y, safe_threshold):
+        """Same result as calculate_safe_distance(): (is_safe, line_id)."""
+        distance, line_id = self.query(x, y)
+        return distance > safe_threshold, line_id
+
+    def query_many(self, xs, ys):
+        """query() for arrays of positions: (distances, line_ids)."""
+        px, py = xs.astype(np.int64), ys.astype(np.int64)
+        inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        px, py = np.where(inside, px, 0), np.where(inside, py, 0)
+        distances = np.where(inside, self.distance[px, py], np.inf)
+        line_ids = np.where(inside & (self.nearest_y[px, py] < ys), 1, 0)
+        return distances, line_ids
+
+    def is_safe_many(self, xs, ys, safe_threshold):
+        """is_safe() for arrays of positions: (is_safe, line_ids)."""
+        distances, line_ids = self.query_many(xs, ys)
+        return distances > safe_threshold, line_ids
+
+
+def cache_path(road_file):
+    """Cache file next to the road image, e.g. road1.png -> road1_distance.npz."""
+    return os.path.splitext(road_file)[0] + "_distance.npz"
+
+
+def load_distance_field(road_file, line_colors=LINE_COLORS):
+    """
+    Distance field of a road image: from memory, from the cache file next to the
+    image if it is newer than the image, or computed and written to that file.
+    """
+    with _fields_lock:
+        field = _fields.get(road_file)
+        if field is not None:
+            _fields.move_to_end(road_file)
+            return field
+
+    cache = cache_path(road_file)
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(road_file):
+        with np.load(cache) as data:
+            field = LaneDistanceField(data["distance"], data["nearest_y"])
+    else:
+        mask = lane_mask(pygame.image.load(road_file), line_colors)
+        field = LaneDistanceField.from_mask(mask)
+        # Write to a temporary file first, several processes may build the same cache
+        temporary = f"{cache}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as cache_file:
+            np.savez_compressed(cache_file, distance=field.distance, nearest_y=field.nearest_y)
+        os.replace(temporary, cache)
+
+    with _fields_lock:
+        _fields[road_file] = field
+        while len(_fields) > CAPACITY:
+            _fields.popitem(last=False)
+    return field
+
+
+if __name__ == "__main__":
+    # Build (or refresh) the cache of every road given, e.g. python distance_field.py road*.png
+    for road_file in sys.argv[1:] or ["road1.png", "road2.png", "road3.png", "road4.png"]:
+        start = time.perf_counter()
+        field = load_distance_field(road_file)
+        print(f"{cache_path(road_file)}: {time.perf_counter() - start:.3f} s, "
+              f"max distance {field.distance.max():.1f} px")
@@ -0,0 +1,155 @@
+import array
+import atexit
+import collections
+import cProfile
+import csv
+import json
+import os
+import pstats
+import time
+
+import numpy as np
+import pygame
+
+WINDOW = 300  # Frames in the rolling statistics of the overlay
+REFRESH = 0.5  # Seconds between two updates of the overlay text
+PERCENTILES = (50, 95, 99)
+NAME_WIDTH, COLUMN_WIDTH = 110, 60  # Overlay columns (pixels)
+
+
+class FrameProfiler:
+    """
+    Time spent in each phase of a frame, with time.perf_counter(). Phases are
+    timed as laps (lap("sensor") charges the time since the previous lap to
+    "sensor"), or measured inside a lap and given to add(). A phase hit
+    several times in a frame (e.g. in every physics substep) is summed over
+    the frame, and one not hit counts 0. Keeps a rolling window of frames for
+    the overlay and, if keep_samples, every frame for the summary.
+    """
+
+    def __init__(self, window=WINDOW, keep_samples=True):
+        self.window = window
+        self.keep_samples = keep_samples
+        self.recent = {}  # phase -> deque of the last window frame times (s)
+        self.samples = {}  # phase -> array of every frame time (s), if keep_samples
+        self.current = collections.defaultdict(float)  # phase -> time in this frame
+        self.frame_start = self.last = time.perf_counter()
+        self.overlay = None  # Rendered overlay, refreshed every REFRESH seconds
+        self.overlay_time = 0.0
+        self.font = None
+
+    def reset(self):
+        """Forget every frame so far, e.g. before a new run."""
+        self.recent.clear()
+        self.samples.clear()
+        self.current.clear()
+        self.overlay = None
+        self.start_frame()
+
+    def start_frame(self):
+        self.frame_start = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """Charge the time since the previous lap (or the frame start) to phase."""
+        now = time.perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def add(self, phase, seconds):
+        """Charge seconds measured inside the current lap to phase instead of the lap."""
+        self.current[phase] += seconds
+        self.last += seconds
+
+    def end_frame(self):
+        """Close the frame: its phases and total go into the statistics."""
+        self.current["frame"] = time.perf_counter() - self.frame_start
+        for phase in self.current:
+            if phase not in self.recent:
+                self.recent[phase] = collections.deque(maxlen=self.window)
+                self.samples[phase] = array.array("d")
+        for phase in self.recent:
+            seconds = self.current.get(phase, 0.0)
+            self.recent[phase].append(seconds)
+            if self.keep_samples:
+                self.samples[phase].append(seconds)
+        self.current.clear()
+        self.start_frame()
+
+    def percentiles(self, phase, recent=True):
+        """p50, p95 and p99 of a phase in milliseconds (rolling window or whole run)."""
+        times = self.recent[phase] if recent else self.samples[phase]
+        return np.percentile(np.asarray(times) * 1000, PERCENTILES)
+
+    def summary(self):
+        """{phase: statistics in milliseconds} over the whole run, slowest phase first."""
+        rows = {}
+        for phase, samples in self.samples.items():
+            times = np.frombuffer(samples, dtype=np.float64) * 1000
+            p50, p95, p99 = np.percentile(times, PERCENTILES)
+            rows[phase] = {"frames": len(times), "mean_ms": float(times.mean()),
+                           "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99),
+                           "max_ms": float(times.max())}
+        return dict(sorted(rows.items(), key=lambda row: -row[1]["mean_ms"]))
+
+    def write(self, path):
+        """Write summary() to path, as JSON if it ends in .json, otherwise as CSV."""
+        summary = self.summary()
+        if os.path.splitext(path)[1] == ".json":
+            with open(path, "w") as stats_file:
+                json.dump(summary, stats_file, indent=2)
+            return
+        with open(path, "w", newline="") as stats_file:
+            writer = csv.writer(stats_file)
+            writer.writerow(["phase", "frames", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            for phase, row in summary.items():
+                writer.writerow([phase] + [f"{value:.4f}" if isinstance(value, float) else value
+                                           for value in row.values()])
+
+    def draw(self, screen, position=(10, 10)):
+        """
+        Draw the rolling p50/p95/p99 of every phase (re-rendered every REFRESH
+        seconds); returns the drawn rect, or None before the first frame.
+        """
+        now = time.perf_counter()
+        if self.overlay is None or now - self.overlay_time > REFRESH:
+            self.overlay = self.render_overlay()
+            self.overlay_time = now
+        if self.overlay is not None:
+            return screen.blit(self.overlay, position)
+        return None
+
+    def render_overlay(self):
+        if not self.recent:
+            return None
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        phases = sorted(self.recent, key=lambda phase: -np.mean(self.recent[phase]))
+        rows = [("phase (ms)", "p50", "p95", "p99")]
+        rows += [(phase, *(f"{value:.2f}" for value in self.percentiles(phase))) for phase in phases]
+        line_height = self.font.get_linesize()
+        overlay = pygame.Surface((NAME_WIDTH + 3 * COLUMN_WIDTH + 12, line_height * len(rows) + 8),
+                                 pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 170))
+        for i, row in enumerate(rows):
+            y = 4 + i * line_height
+            overlay.blit(self.font.render(row[0], True, (255, 255, 255)), (6, y))
+            for j, value in enumerate(row[1:], 1):
+                # Right-aligned numbers
+                text = self.font.render(value, True, (255, 255, 255))
+                overlay.blit(text, (6 + NAME_WIDTH + j * COLUMN_WIDTH - text.get_width(), y))
+        return overlay
+
+
+def start_cprofile(path):
+    """Profile the rest of the run with cProfile; the stats are written to path on exit."""
+    profile = cProfile.Profile()
+
+    def dump():
+        profile.disable()
+        profile.dump_stats(path)
+        print(f"cProfile stats written to {path} (python -m pstats {path}), top functions:")
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
+
+    atexit.register(dump)
+    profile.enable()
+    return profile
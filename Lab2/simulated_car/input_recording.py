@@ -0,0 +1,126 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import pygame
+
+from sim_engine import inputs_from_names
+
+# Keys the car modes read
+KEY_NAMES = ["UP", "DOWN", "LEFT", "RIGHT"]
+
+
+def key_names(keys):
+    """Names of the KEY_NAMES held in keys (pygame.key.get_pressed())."""
+    return [name for name in KEY_NAMES if keys[getattr(pygame, "K_" + name)]]
+
+
+def key_inputs(keys):
+    """The sim_engine inputs of the keys held (pygame.key.get_pressed())."""
+    return inputs_from_names(key_names(keys))
+
+
+class InputRecorder:
+    """
+    The inputs of one drive, step by step, with the state it started from, so
+    it can be replayed headless. The pressed keys are stored run-length encoded
+    like an input script ([steps, [KEY, ...]]), the sensor toggles as
+    [step, active] and the car pose after every step to check the replay.
+    """
+
+    def __init__(self, simulator, mode, start, dt):
+        self.recording = {
+            "simulator": simulator,  # Module that replays it, e.g. "CAR_LTA"
+            "mode": mode,
+            "dt": dt,
+            "start": start,
+            "script": [],
+            "sensor": [],
+            "trajectory": [],
+        }
+        self.steps = 0
+        self.started = time.perf_counter()
+
+    def record_step(self, keys, pose):
+        """The keys of one physics step and the (x, y, angle) of the car after it."""
+        self.record_names(key_names(keys), pose)
+
+    def record_names(self, names, pose):
+        """record_step() with the names of the keys held, e.g. ["RIGHT", "UP"]."""
+        script = self.recording["script"]
+        if script and script[-1][1] == names:
+            script[-1][0] += 1
+        else:
+            script.append([1, names])
+        self.recording["trajectory"].append(list(pose))
+        self.steps += 1
+
+    def record_sensor(self, active):
+        """The sensor was switched on or off before the next step."""
+        self.recording["sensor"].append([self.steps, active])
+
+    def save(self, path):
+        """Write the recording as JSON (floats are written exactly)."""
+        self.recording["wall_time"] = time.perf_counter() - self.started
+        with open(path, "w") as recording_file:
+            json.dump(self.recording, recording_file)
+
+
+def load_recording(path):
+    with open(path) as recording_file:
+        return json.load(recording_file)
+
+
+def replay(recording):
+    """
+    Replay a recording headless with the simulator it was made with, as fast as
+    possible: the car pose after every step.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    simulator = importlib.import_module(recording["simulator"])
+    return simulator.replay(recording)
+
+
+def compare(recorded, replayed):
+    """(max difference in any pose coordinate, first step that differs or None)."""
+    if len(recorded) != len(replayed):
+        return float('inf'), min(len(recorded), len(replayed))
+    max_difference, first = 0.0, None
+    for step, (expected, actual) in enumerate(zip(recorded, replayed)):
+        difference = max(abs(e - a) for e, a in zip(expected, actual))
+        if difference > 0 and first is None:
+            first = step
+        max_difference = max(max_difference, difference)
+    return max_difference, first
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded drive headless and check it gives the same trajectory")
+    parser.add_argument("recording", help="JSON file written with --record")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replay this many times (benchmark)")
+    args = parser.parse_args()
+
+    recording = load_recording(args.recording)
+    steps = len(recording["trajectory"])
+    print(f"{recording['simulator']}, {recording['mode']} mode: {steps} steps, "
+          f"{steps * recording['dt']:.1f} s simulated, recorded in {recording['wall_time']:.1f} s")
+
+    replay({**recording, "script": []})  # Import and set up the simulator outside the timing
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        trajectory = replay(recording)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    print(f"replayed in {elapsed:.3f} s ({recording['wall_time'] / max(elapsed, 1e-9):.0f}x "
+          f"the recording, {steps / max(elapsed, 1e-9):.0f} steps/s)")
+
+    max_difference, first = compare(recording["trajectory"], trajectory)
+    if first is None:
+        print("trajectory: identical")
+    else:
+        print(f"trajectory: differs from step {first}, max difference {max_difference:.3g}")
+        sys.exit(1)
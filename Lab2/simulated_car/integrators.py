@@ -0,0 +1,198 @@
+import argparse
+import math
+import time
+
+import numpy as np
+
+# Integrators that work in place on preallocated arrays. The model is a
+# function f(y, out) that writes dy/dt of the state array y into out.
+# They are standalone, for the state arrays of many cars (batched_dynamics.py)
+# and for comparing integration methods (run this file). sim_engine.Simulation
+# keeps its own RK4 on the lists of one car: numpy is slower than plain floats
+# for 6 numbers, and a different summation order would change the recorded
+# trajectories. test_integrators.py checks that both take the same steps.
+
+
+def _combine(out, y, h, coefficients, ks, tmp):
+    """out = y + h * sum(c * k), without allocating (tmp is scratch space)."""
+    np.copyto(out, y)
+    for c, k in zip(coefficients, ks):
+        if c:
+            np.multiply(k, h * c, out=tmp)
+            out += tmp
+
+
+class RK4:
+    """Fixed-step classic Runge-Kutta, as runge_kutta() in the simulators."""
+
+    def __init__(self, f, shape):
+        self.f = f
+        self.k1, self.k2, self.k3, self.k4 = (np.empty(shape) for _ in range(4))
+        self.stage = np.empty(shape)
+        self.tmp = np.empty(shape)
+        self.evaluations = 0
+
+    def step(self, y, dt):
+        """Advance y (in place) by dt."""
+        f, k1, k2, k3, k4, stage, tmp = self.f, self.k1, self.k2, self.k3, self.k4, self.stage, self.tmp
+        f(y, k1)
+        _combine(stage, y, dt * 0.5, (1,), (k1,), tmp)
+        f(stage, k2)
+        _combine(stage, y, dt * 0.5, (1,), (k2,), tmp)
+        f(stage, k3)
+        _combine(stage, y, dt, (1,), (k3,), tmp)
+        f(stage, k4)
+        _combine(y, y, dt / 6, (1, 2, 2, 1), (k1, k2, k3, k4), tmp)
+        self.evaluations += 4
+
+    def advance(self, y, t, t_end, dt):
+        """Advance y (in place) from t to t_end in steps of dt (the last one shortened)."""
+        while t_end - t > 1e-12:
+            h = min(dt, t_end - t)
+            self.step(y, h)
+            t += h
+        return t
+
+
+class DormandPrince:
+    """
+    Adaptive embedded Runge-Kutta 5(4) (Dormand-Prince, as ode45/RK45), with
+    per-step error control and first-same-as-last. The step size shrinks where
+    the model is stiff (e.g. a fast steering lag tau_s) and grows back after.
+    """
+
+    C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+    A = (
+        (),
+        (1 / 5,),
+        (3 / 40, 9 / 40),
+        (44 / 45, -56 / 15, 32 / 9),
+        (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+        (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+        (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+    )
+    # Difference between the 5th and the embedded 4th order solutions
+    E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+    def __init__(self, f, shape, rtol=1e-6, atol=1e-6, max_step=math.inf, min_step=1e-9):
+        self.f = f
+        self.rtol, self.atol = rtol, atol
+        self.max_step, self.min_step = max_step, min_step
+        self.k = [np.empty(shape) for _ in range(7)]
+        self.y_new = np.empty(shape)
+        self.error = np.empty(shape)
+        self.tmp = np.empty(shape)
+        self.scale = np.empty(shape)
+        self.dt = None  # Step size to try next
+        self.evaluations = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def _error_norm(self, y, h):
+        """RMS of the local error estimate, relative to the tolerances."""
+        _combine(self.error, 0, h, self.E, self.k, self.tmp)
+        np.abs(y, out=self.scale)
+        np.abs(self.y_new, out=self.tmp)
+        np.maximum(self.scale, self.tmp, out=self.scale)
+        self.scale *= self.rtol
+        self.scale += self.atol
+        np.divide(self.error, self.scale, out=self.error)
+        np.square(self.error, out=self.error)
+        return math.sqrt(self.error.mean())
+
+    def advance(self, y, t, t_end, dt=None):
+        """Advance y (in place) from t to t_end with as few steps as the tolerances allow."""
+        f, k, tmp = self.f, self.k, self.tmp
+        h = dt or self.dt or (t_end - t)
+        # The model inputs may have changed since the last call, so no first-same-as-last here
+        f(y, k[0])
+        self.evaluations += 1
+        while t_end - t > 1e-12:
+            h = min(h, self.max_step, t_end - t)
+            for i in range(1, 6):
+                _combine(self.y_new, y, h, self.A[i], k, tmp)
+                f(self.y_new, k[i])
+            _combine(self.y_new, y, h, self.A[6], k, tmp)
+            f(self.y_new, k[6])
+            self.evaluations += 6
+
+            error = self._error_norm(y, h)
+            if error <= 1:
+                t += h
+                np.copyto(y, self.y_new)
+                k[0], k[6] = k[6], k[0]  # First same as last
+                self.accepted += 1
+            else:
+                self.rejected += 1
+            # Standard step size controller, with safety factor and limits
+            factor = 5 if error == 0 else 0.9 * error ** -0.2 if math.isfinite(error) else 0.2
+            h_next = h * min(5, max(0.2, factor))
+            if h_next < self.min_step:
+                raise RuntimeError(f"step size underflow at t = {t}")
+            if error <= 1:
+                self.dt = h_next  # Do not let the shortened last step shrink the next call
+                if t_end - t > 1e-12:
+                    h = h_next
+            else:
+                h = h_next
+        return t
+
+
+def dynamic_model(FD, **params):
+    """f(y, out) of the dynamic car model (batched_dynamics.car_dynamics) with fixed inputs."""
+    from batched_dynamics import car_dynamics
+
+    def f(y, out):
+        car_dynamics(y, FD, out=out, **params)
+    return f
+
+
+if __name__ == "__main__":
+    from batched_dynamics import U_2, start_states
+
+    parser = argparse.ArgumentParser(description="Compare the integrators on the dynamic car model")
+    parser.add_argument("--cars", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=3.0, help="simulated time")
+    parser.add_argument("--tau-s", type=float, default=1.0, help="steering lag of the model")
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    DT = 0.1  # Frame time of the simulators
+    frames = int(round(args.seconds / DT))
+    rng = np.random.default_rng(0)
+    y0 = start_states(args.cars)
+    # Gentle inputs: held for seconds, stronger ones make the model diverge (theta past 90 degrees)
+    y0[:, U_2] = rng.uniform(-0.01, 0.01, args.cars)
+    f = dynamic_model(rng.uniform(0, 500, args.cars), tau_s=args.tau_s)
+
+    def run(integrator, step):
+        y = y0.copy()
+        start = time.perf_counter()
+        for frame in range(frames):
+            integrator.advance(y, frame * DT, (frame + 1) * DT, step)
+        return y, time.perf_counter() - start
+
+    # Reference: RK4 with a step 1000 times smaller than the frame
+    with np.errstate(all="ignore"):
+        reference, _ = run(RK4(f, y0.shape), DT / 1000)
+
+    print(f"{args.cars} cars, {args.seconds} s simulated, tau_s = {args.tau_s}")
+    print(f"{'method':28}{'f evals':>9}{'time (s)':>10}{'frames/s':>10}{'max error (px)':>16}")
+    methods = [
+        ("RK4, dt = 0.1", RK4(f, y0.shape), DT),
+        ("RK4, dt = 0.01", RK4(f, y0.shape), DT / 10),
+        (f"Dormand-Prince, rtol = {args.rtol:g}",
+         DormandPrince(f, y0.shape, rtol=args.rtol, atol=args.rtol), None),
+    ]
+    for name, integrator, step in methods:
+        with np.errstate(all="ignore"):
+            try:
+                y, elapsed = run(integrator, step)
+            except RuntimeError as e:
+                print(f"{name:28}  failed: {e} (the model diverges)")
+                continue
+            error = np.abs(y[:, :2] - reference[:, :2]).max()
+        print(f"{name:28}{integrator.evaluations:>9}{elapsed:>10.3f}"
+              f"{frames / elapsed:>10.0f}{error:>16.3g}")
+    print(f"Dormand-Prince steps: {methods[2][1].accepted} accepted, "
+          f"{methods[2][1].rejected} rejected")
@@ -1,6 +1,11 @@
 import pygame
 import math
 
+from dirty_renderer import DirtyRenderer
+from road_assets import RoadAssets
+from sim_engine import Simulation, inputs
+from sprite_cache import RotationCache
+
 # Initialize Pygame
 pygame.init()
 
@@ -11,11 +16,11 @@ pygame.display.set_caption("Car on a Road")
 
 # Load road images
 road_images = ["road1.png", "road2.png", "road3.png"]
-current_road = 0
+road_assets = RoadAssets(road_images)  # Loaded ahead of the road changes
 
 # Attempt to load the first road image
 try:
-    road = pygame.image.load(road_images[current_road])
+    road_assets.get(0)
 except pygame.error as e:
     print(f"Error loading road image: {e}")
     pygame.quit()
@@ -30,9 +35,8 @@ except pygame.error as e:
     exit()
 
 car_width, car_height = car.get_width(), car.get_height()
-car_x, car_y = 50, HEIGHT // 2 + 23  # Starting position of the car
-car_angle = 0
-car_speed = 0
+car_sprites = RotationCache(car)  # The car at every heading, rendered once
+START = (50, HEIGHT // 2 + 23)  # Starting position of the car
 
 # Constants
 L = 2.5  # Wheelbase in meters (adjust this based on your car)
@@ -45,25 +49,15 @@ FRICTION = 0.98  # Friction coefficient (reduce speed by 2% per update)
 # Open a file to save detected positions
 file = open("detected_positions.txt", "w")
 
-# New Runge-Kutta function (provided by user)
-def runge_kutta(f, state, dt):
-    k1 = f(state)
-    k2 = f([s + dt * 0.5 * k for s, k in zip(state, k1)])
-    k3 = f([s + dt * 0.5 * k for s, k in zip(state, k2)])
-    k4 = f([s + dt * k for s, k in zip(state, k3)])
-    return [s + dt / 6 * (k1i + 2 * k2i + 2 * k3i + k4i) for s, k1i, k2i, k3i, k4i in zip(state, k1, k2, k3, k4)]
-
-# Derivatives function for the car's motion
-def car_derivatives(state):
-    """
-    Compute the car's derivatives based on its current state.
-    state: [x, y, angle]
-    """
-    x, y, angle = state
-    dx = car_speed * math.cos(angle)
-    dy = car_speed * math.sin(angle)
-    dtheta = (car_speed / L) * math.tan(math.radians(steering_angle))
-    return [dx, dy, dtheta]
+# Kinematic car: steering held at +/- TURN_SPEED, speed limited to MAX_SPEED, kept on the screen
+simulation = Simulation(road_assets, "kinematics", lta=None, sensing=False, dt=dt, L=L,
+                        acceleration=ACCELERATION, max_speed=MAX_SPEED, turn_speed=TURN_SPEED,
+                        friction=FRICTION, steering="fixed", clamp_speed=True, speed_lag=False,
+                        clamp_to_screen=True, change_road_first=False, width=WIDTH,
+                        height=HEIGHT, start=START)
+
+# Only the parts of the screen that change are redrawn and updated
+renderer = DirtyRenderer(screen)
 
 # Main loop
 running = True
@@ -76,58 +70,33 @@ while running:
     # Input handling for steering and speed
     keys = pygame.key.get_pressed()
 
-    # Steering angle input
-    if keys[pygame.K_LEFT]:  # Turn left (counter-clockwise)
-        steering_angle = TURN_SPEED
-    elif keys[pygame.K_RIGHT]:  # Turn right (clockwise)
-        steering_angle = -TURN_SPEED
-    else:
-        steering_angle = 0  # No steering change
-
-    # Speed control (accelerate or decelerate)
-    if keys[pygame.K_UP]:  # Move forward
-        car_speed = min(car_speed + ACCELERATION, MAX_SPEED)
-    elif keys[pygame.K_DOWN]:  # Move backward
-        car_speed = max(car_speed - ACCELERATION, -MAX_SPEED)
-
-    # Apply road friction to car speed
-    car_speed *= FRICTION
-
-    # Update car state using the new Runge-Kutta function
-    car_x, car_y, car_angle = runge_kutta(car_derivatives, [car_x, car_y, car_angle], dt)
-
-    # Ensure car_x and car_y are within valid range
-    car_x = max(0, min(WIDTH, car_x))
-    car_y = max(0, min(HEIGHT, car_y))
-
-    # Check for end of road (when car reaches the right edge of the current road)
-    road_width = road.get_width()  # Get the width of the current road image
-    if car_x >= road_width:  # Reached the right edge of the screen
-        current_road += 1
-        if current_road < len(road_images):
-            try:
-                road = pygame.image.load(road_images[current_road])
-            except pygame.error as e:
-                print(f"Error loading road image: {e}")
-                pygame.quit()
-                exit()
-            car_x = 0  # Reset car position to the left edge
-        else:
+    # LEFT / RIGHT steer (counter-)clockwise, UP / DOWN accelerate and decelerate
+    step_inputs = inputs(up=keys[pygame.K_RIGHT] and not keys[pygame.K_LEFT],
+                         down=keys[pygame.K_LEFT], left=keys[pygame.K_DOWN],
+                         right=keys[pygame.K_UP])
+
+    # Move the car, then change road at the right edge of the current road
+    try:
+        if not simulation.step(step_inputs):
             print("End of map, congrats!")
             running = False
+    except pygame.error as e:
+        print(f"Error loading road image: {e}")
+        pygame.quit()
+        exit()
 
-    # Draw the background (road)
-    screen.blit(road, (0, 0))
+    # Draw the background (road): erase what was drawn on the last frame
+    renderer.set_background(simulation.road.surface)
+    renderer.begin()
 
     # Rotate and draw the car
-    rotated_car = pygame.transform.rotate(car, -math.degrees(car_angle))
-    rect = rotated_car.get_rect(center=(car_x, car_y))
-    screen.blit(rotated_car, rect.topleft)
+    renderer.add(car_sprites.draw(screen, -math.degrees(simulation.angle), (simulation.x, simulation.y)))
 
-    # Refresh screen
-    pygame.display.flip()
+    # Refresh the parts of the screen that changed
+    renderer.end()
     pygame.time.Clock().tick(60)
 
 # Close the file after quitting
 file.close()
+road_assets.shutdown()
 pygame.quit()
@@ -0,0 +1,439 @@
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import batched_dynamics
+from distance_field import load_distance_field
+from lane_sensor import SENSOR_ANGLE, SENSOR_RANGE, ConeSensor, lane_mask
+from lta_sweep import DEPARTURE_DISTANCE
+from sim_engine import (DOWN, DT, HEIGHT, LEFT, RIGHT, SAFE_DISTANCE_THRESHOLD, START, UP, WIDTH,
+                        Road, Simulation)
+
+# Lane keeping environments over the car models of sim_engine.py, with the
+# reset() / step(action) interface of gymnasium (without depending on it):
+#   LaneKeepingEnv        one car on the scalar Simulation
+#   LaneKeepingVectorEnv  many cars in one process, on the arrays of batched_dynamics.py
+#   ProcessVectorEnv      many LaneKeepingEnv spread over worker processes
+# Nothing is drawn unless LaneKeepingEnv is made with render_mode="human".
+#
+# An action is the inputs of a step, the arrow keys held as bits (sim_engine.inputs()):
+# UP 1 steers left, DOWN 2 steers right, LEFT 4 brakes / reverses, RIGHT 8 accelerates.
+# An observation is the car's y, heading (radians, in [-pi, pi)), speed and steering
+# (u_2 in dynamic mode, the steering angle in kinematics mode), then the distance
+# along every sensor ray to the first lane line hit (the sensor range if none).
+
+ROAD_FILES = ("road1.png", "road2.png", "road3.png")
+N_ACTIONS = 16
+OBSERVATION = ("y", "angle", "speed", "steering")  # Then one distance per sensor ray
+MAX_STEPS = 1000  # Episodes are truncated after this many steps
+RENDER_FPS = 60  # Frame cap of render_mode="human"
+
+# Rewards: progress to the right, a penalty growing as the car gets closer than
+# SAFE_DISTANCE_THRESHOLD to a lane line, and the end of the episode on a lane departure
+# (DEPARTURE_DISTANCE from a line, or off the road, as in lta_sweep.py)
+PROGRESS_SCALE = 100  # Pixels driven to the right for a reward of 1
+LINE_PENALTY = 0.1  # Per step, on a line
+DEPARTURE_PENALTY = 10
+
+# Lane mask and distance field of the roads already loaded, per road image file
+_roads = {}
+
+
+def load_roads(road_files=ROAD_FILES):
+    """The roads as sim_engine.Road (mask and distance field), loaded once per process."""
+    roads = []
+    for road_file in road_files:
+        road = _roads.get(road_file)
+        if road is None:
+            import pygame  # Decoding the image needs no display
+            road = Road(lane_mask(pygame.image.load(road_file)), load_distance_field(road_file))
+            _roads[road_file] = road
+        roads.append(road)
+    return roads
+
+
+def rewards(progress, line_distances, finished):
+    """
+    Rewards of steps that drove progress pixels to the right and ended
+    line_distances from the nearest lane line, and which of them are lane
+    departures (a car past the end of the last road is not).
+    """
+    departed = ((line_distances <= DEPARTURE_DISTANCE) | np.isinf(line_distances)) & ~finished
+    closeness = np.clip(1 - line_distances / SAFE_DISTANCE_THRESHOLD, 0, 1)
+    reward = progress / PROGRESS_SCALE - LINE_PENALTY * closeness - DEPARTURE_PENALTY * departed
+    return reward, departed
+
+
+def observations(ys, angles, speeds, steerings, ray_distances, sensor_range):
+    """Observation rows (float32) of cars, see OBSERVATION."""
+    angles = (np.asarray(angles) + math.pi) % (2 * math.pi) - math.pi
+    return np.column_stack([ys, angles, speeds, steerings,
+                            np.minimum(ray_distances, sensor_range)]).astype(np.float32)
+
+
+class LaneKeepingEnv:
+    """
+    Lane keeping with one car of sim_engine.Simulation: drive to the right
+    along the roads without leaving the lane. mode is "dynamic" (car_dynamics)
+    or "kinematics"; lta is None, "sensor" or "field" to let the LTA of
+    CAR_LTA.py help the controller. The car is deterministic, seed is only
+    taken for compatibility.
+    """
+
+    def __init__(self, mode="dynamic", lta=None, road_files=ROAD_FILES, max_steps=MAX_STEPS,
+                 sensor_range=SENSOR_RANGE, sensor_angle=SENSOR_ANGLE, render_mode=None):
+        if mode not in ("dynamic", "kinematics"):
+            raise ValueError(f"mode must be dynamic or kinematics, not {mode!r}")
+        self.road_files = road_files
+        self.roads = load_roads(road_files)
+        self.sensor = ConeSensor(sensor_range, sensor_angle, angle_step=4)
+        self.sensor_range = sensor_range
+        # The road changes after the move, so the sensor sees the car where the step left it
+        self.simulation = Simulation(self.roads, mode, lta=lta, sensing=False, sensor=self.sensor,
+                                     change_road_first=False)
+        self.max_steps = max_steps
+        self.render_mode = render_mode
+        self.observation_size = len(OBSERVATION) + len(self.sensor.angle_offsets)
+        self.position = 0  # Pixels from the start of the first road
+        self.renderer = None
+
+    def reset(self, seed=None, options=None):
+        """Put the car back at the start of road options["road"] (default 0): (observation, info)."""
+        simulation = self.simulation
+        simulation.reset((options or {}).get("road", 0))
+        if simulation.sensing:
+            simulation.sense()  # Detections for the LTA of the first step
+        self.position = self.car_position()
+        if self.render_mode == "human":
+            self.render()
+        return self.observe(), self.info()
+
+    def step(self, action):
+        """Drive one step with the inputs action: (observation, reward, terminated, truncated, info)."""
+        simulation = self.simulation
+        simulation.step(int(action))
+        position = self.car_position()
+        progress, self.position = position - self.position, position
+        finished = simulation.finished
+        distance = math.inf if finished else simulation.road.field.query(simulation.x, simulation.y)[0]
+        reward, departed = rewards(progress, distance, finished)
+        terminated = finished or bool(departed)
+        truncated = not terminated and simulation.steps >= self.max_steps
+        if self.render_mode == "human":
+            self.render()
+        return self.observe(), float(reward), terminated, truncated, self.info()
+
+    def car_position(self):
+        simulation = self.simulation
+        road_index = min(simulation.road_index, len(self.roads) - 1)  # Past the end once finished
+        return road_index * len(simulation.road.mask) + simulation.x
+
+    def observe(self):
+        simulation = self.simulation
+        if simulation.mode == "dynamic":
+            speed, steering = simulation.state[3], simulation.state[5]
+        else:
+            speed, steering = simulation.speed, simulation.steering_angle
+        rays = self.sensor.distances_many(simulation.road.mask, [simulation.x], [simulation.y],
+                                          [simulation.angle])
+        return observations([simulation.y], [simulation.angle], [speed], [steering], rays,
+                            self.sensor_range)[0]
+
+    def info(self):
+        simulation = self.simulation
+        return {"x": simulation.x, "road": simulation.road_index, "lta": simulation.lta_active,
+                "finished": simulation.finished}
+
+    def render(self):
+        """Draw the road, the sensor rays and the car in a window."""
+        import pygame
+        from dirty_renderer import DirtyRenderer
+        from sprite_cache import RotationCache
+
+        if self.renderer is None:
+            pygame.init()
+            screen = pygame.display.set_mode((WIDTH, HEIGHT))
+            pygame.display.set_caption("Lane keeping")
+            self.renderer = DirtyRenderer(screen)
+            self.car_sprites = RotationCache(pygame.image.load("car.png").convert_alpha())
+            self.road_surfaces = {}  # road file -> converted surface
+            self.clock = pygame.time.Clock()
+        pygame.event.pump()  # Keep the window responsive
+
+        simulation = self.simulation
+        road_file = self.road_files[min(simulation.road_index, len(self.roads) - 1)]
+        if road_file not in self.road_surfaces:
+            self.road_surfaces[road_file] = pygame.image.load(road_file).convert()
+        renderer = self.renderer
+        screen = renderer.screen
+        renderer.set_background(self.road_surfaces[road_file])
+        renderer.begin()
+        _, ray_ends = self.sensor.cast(simulation.road.mask, simulation.x, simulation.y,
+                                       simulation.angle)
+        renderer.add_all([pygame.draw.line(screen, (0, 255, 0), (simulation.x, simulation.y),
+                                           ray_end, 1) for ray_end in ray_ends])
+        renderer.add(self.car_sprites.draw(screen, -math.degrees(simulation.angle),
+                                           (simulation.x, simulation.y)))
+        renderer.end()
+        self.clock.tick(RENDER_FPS)
+
+    def close(self):
+        if self.renderer is not None:
+            import pygame
+            pygame.display.quit()
+            self.renderer = None
+
+
+class LaneKeepingVectorEnv:
+    """
+    n cars of LaneKeepingEnv stepped together on (n, ...) arrays with the
+    batched models of batched_dynamics.py: a few numpy calls per step for all
+    cars instead of a Python step per car. lta is None or "field" (the sensor
+    LTA needs the detections of every car). A car whose episode ends is reset
+    in the same step; info["final_observation"] then holds the observations
+    before the reset, as in gymnasium's vector environments.
+    """
+
+    def __init__(self, n, mode="dynamic", lta=None, road_files=ROAD_FILES, max_steps=MAX_STEPS,
+                 sensor_range=SENSOR_RANGE, sensor_angle=SENSOR_ANGLE):
+        if mode not in ("dynamic", "kinematics"):
+            raise ValueError(f"mode must be dynamic or kinematics, not {mode!r}")
+        if lta not in (None, "field"):
+            raise ValueError("LaneKeepingVectorEnv supports lta=None or \"field\", "
+                             "use ProcessVectorEnv for the sensor LTA")
+        self.n = n
+        self.mode = mode
+        self.roads = load_roads(road_files)
+        self.width = len(self.roads[0].mask)
+        self.sensor = ConeSensor(sensor_range, sensor_angle, angle_step=4)
+        self.sensor_range = sensor_range
+        self.lane_check = self.lane_safety if lta == "field" else None
+        self.max_steps = max_steps
+        self.observation_size = len(OBSERVATION) + len(self.sensor.angle_offsets)
+
+        self.states = batched_dynamics.start_states(n, *START, model=self.model)
+        self.FD = np.zeros(n)  # Driving force (dynamic)
+        self.speed = np.zeros(n)  # Speed (kinematics)
+        self.steering_angle = np.zeros(n)  # Steering angle (kinematics)
+        self.road_index = np.zeros(n, dtype=np.int64)
+        self.steps = np.zeros(n, dtype=np.int64)
+        self.position = np.full(n, float(START[0]))  # Pixels from the start of the first road
+
+    @property
+    def model(self):
+        return "dynamic" if self.mode == "dynamic" else "kinematic"
+
+    def reset(self, seed=None, options=None):
+        """Put every car back at the start: (observations, info)."""
+        self.reset_cars(np.ones(self.n, dtype=bool))
+        return self.observe(), {}
+
+    def reset_cars(self, cars):
+        """Put the cars selected by the boolean array cars back at the start, at rest."""
+        self.states[cars] = batched_dynamics.start_states(1, *START, model=self.model)
+        self.FD[cars] = 0
+        self.speed[cars] = 0
+        self.steering_angle[cars] = 0
+        self.road_index[cars] = 0
+        self.steps[cars] = 0
+        self.position[cars] = START[0]
+
+    def step(self, actions):
+        """
+        Drive every car one step with its inputs in actions, shape (n,):
+        (observations, rewards, terminated, truncated, info), arrays of n.
+        """
+        actions = np.asarray(actions)
+        # The steering and throttle commands of Simulation, where one key wins over the other
+        up, down = (actions & UP) != 0, (actions & DOWN) != 0
+        if self.mode == "dynamic":
+            steer = np.where(up, batched_dynamics.UP, np.where(down, batched_dynamics.DOWN, batched_dynamics.NONE))
+        else:
+            steer = np.where(down, batched_dynamics.DOWN, np.where(up, batched_dynamics.UP, batched_dynamics.NONE))
+        throttle = np.where((actions & LEFT) != 0, batched_dynamics.LEFT,
+                            np.where((actions & RIGHT) != 0, batched_dynamics.RIGHT, batched_dynamics.NONE))
+
+        if self.mode == "dynamic":
+            self.FD = batched_dynamics.dynamic_controls(self.states, self.FD, steer, throttle)
+            self.states, lta_active = batched_dynamics.dynamic_step(self.states, self.FD, DT,
+                                                                    self.lane_check)
+        else:
+            self.steering_angle, speed = batched_dynamics.kinematic_controls(
+                self.steering_angle, self.speed, steer, throttle)
+            # Moved with the speed of the previous step, as Simulation (speed_lag)
+            self.states, lta_active = batched_dynamics.kinematic_step(
+                self.states, self.speed, self.steering_angle, DT, self.lane_check)
+            self.speed = speed
+
+        # Next road at the right edge, as Simulation with change_road_first=False
+        xs = self.states[:, batched_dynamics.X]
+        over = xs >= self.width
+        self.road_index += over
+        finished = self.road_index >= len(self.roads)
+        self.road_index = np.minimum(self.road_index, len(self.roads) - 1)
+        xs[over & ~finished] = 0
+
+        position = self.road_index * self.width + xs
+        progress, self.position = position - self.position, position
+        distances = np.where(finished, np.inf, self.query(xs, self.states[:, batched_dynamics.Y])[0])
+        reward, departed = rewards(progress, distances, finished)
+        self.steps += 1
+        terminated = finished | departed
+        truncated = ~terminated & (self.steps >= self.max_steps)
+
+        observation = self.observe()
+        info = {"finished": finished, "lta": lta_active}
+        done = terminated | truncated
+        if done.any():
+            info["final_observation"] = observation.copy()
+            self.reset_cars(done)
+            observation[done] = self.observe(done)
+        return observation, reward, terminated, truncated, info
+
+    def query(self, xs, ys):
+        """(distances, line_ids) of the nearest lane line of every car, on its own road."""
+        distances = np.empty(len(xs))
+        line_ids = np.empty(len(xs), dtype=np.int64)
+        for index, road in enumerate(self.roads):
+            cars = self.road_index == index
+            if cars.any():
+                distances[cars], line_ids[cars] = road.field.query_many(xs[cars], ys[cars])
+        return distances, line_ids
+
+    def lane_safety(self, xs, ys, safe_threshold):
+        """LaneDistanceField.is_safe_many() with every car on its own road (the field LTA)."""
+        distances, line_ids = self.query(xs, ys)
+        return distances > safe_threshold, line_ids
+
+    def observe(self, cars=None):
+        """Observations of every car, or of the cars selected by the boolean array cars."""
+        cars = np.ones(self.n, dtype=bool) if cars is None else cars
+        states = self.states[cars]
+        road_index = self.road_index[cars]
+        rays = np.empty((len(states), len(self.sensor.angle_offsets)))
+        for index, road in enumerate(self.roads):
+            on_road = road_index == index
+            if on_road.any():
+                rays[on_road] = self.sensor.distances_many(
+                    road.mask, states[on_road, batched_dynamics.X], states[on_road, batched_dynamics.Y],
+                    states[on_road, batched_dynamics.THETA])
+        if self.mode == "dynamic":
+            speeds, steerings = states[:, batched_dynamics.V_U], states[:, batched_dynamics.U_2]
+        else:
+            speeds, steerings = self.speed[cars], self.steering_angle[cars]
+        return observations(states[:, batched_dynamics.Y], states[:, batched_dynamics.THETA],
+                            speeds, steerings, rays, self.sensor_range)
+
+    def close(self):
+        pass
+
+
+def env_worker(connection, n, env_options):
+    """Worker process of ProcessVectorEnv: n LaneKeepingEnv driven by the commands on connection."""
+    envs = [LaneKeepingEnv(**env_options) for _ in range(n)]
+    while True:
+        command, data = connection.recv()
+        if command == "reset":
+            connection.send([env.reset(options=data) for env in envs])
+        elif command == "step":
+            results = []
+            for env, action in zip(envs, data):
+                observation, reward, terminated, truncated, info = env.step(action)
+                if terminated or truncated:
+                    info["final_observation"] = observation
+                    observation, _ = env.reset()
+                results.append((observation, reward, terminated, truncated, info))
+            connection.send(results)
+        else:  # close
+            connection.close()
+            return
+
+
+class ProcessVectorEnv:
+    """
+    n LaneKeepingEnv spread over worker processes (one per CPU by default), for
+    what LaneKeepingVectorEnv does not batch, e.g. lta="sensor". Same reset()
+    and step() as LaneKeepingVectorEnv, except that info is the list of the
+    info of every car.
+    """
+
+    def __init__(self, n, workers=None, **env_options):
+        self.n = n
+        workers = max(1, min(n, workers or os.cpu_count()))
+        self.counts = [len(cars) for cars in np.array_split(np.arange(n), workers)]
+        self.connections = []
+        self.processes = []
+        for count in self.counts:
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=env_worker, daemon=True,
+                                              args=(worker_connection, count, env_options))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def gather(self):
+        return [result for connection in self.connections for result in connection.recv()]
+
+    def reset(self, seed=None, options=None):
+        for connection in self.connections:
+            connection.send(("reset", options))
+        observations, infos = zip(*self.gather())
+        return np.stack(observations), list(infos)
+
+    def step(self, actions):
+        start = 0
+        for connection, count in zip(self.connections, self.counts):
+            connection.send(("step", [int(action) for action in actions[start:start + count]]))
+            start += count
+        observation, reward, terminated, truncated, infos = zip(*self.gather())
+        return (np.stack(observation), np.array(reward), np.array(terminated),
+                np.array(truncated), list(infos))
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+
+
+def benchmark(n=1000, steps=200, seed=0):
+    """Steps per second of the environments, on random actions that mostly accelerate."""
+    rng = np.random.default_rng(seed)
+
+    def random_actions(count):
+        steer = rng.choice([0, UP, DOWN], count)
+        return steer | np.where(rng.random(count) < 0.8, RIGHT, 0)
+
+    env = LaneKeepingEnv()
+    env.reset()
+    start = time.perf_counter()
+    for action in random_actions(steps * 10):
+        _, _, terminated, truncated, _ = env.step(action)
+        if terminated or truncated:
+            env.reset()
+    elapsed = time.perf_counter() - start
+    print(f"LaneKeepingEnv:       1 car  x {steps * 10} steps: {steps * 10 / elapsed:10,.0f} car-steps/s")
+
+    for name, vector_env in (("LaneKeepingVectorEnv", LaneKeepingVectorEnv(n)),
+                             ("ProcessVectorEnv", ProcessVectorEnv(n))):
+        vector_env.reset()
+        start = time.perf_counter()
+        episodes = 0
+        for _ in range(steps):
+            _, _, terminated, truncated, _ = vector_env.step(random_actions(n))
+            episodes += np.count_nonzero(terminated | truncated)
+        elapsed = time.perf_counter() - start
+        vector_env.close()
+        print(f"{name:21} {n} cars x {steps} steps: {n * steps / elapsed:10,.0f} car-steps/s "
+              f"({episodes} episodes ended)")
+
+
+if __name__ == "__main__":
+    # python lane_env.py [cars]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,197 @@
+import math
+import time
+import weakref
+
+import numpy as np
+from scipy import ndimage
+
+from lane_sensor import ANGLE_STEP, SENSOR_ANGLE, SENSOR_RANGE
+
+# Largest distance (pixels) between a simplified outline and the pixel edge it follows
+TOLERANCE = 0.75
+
+# Lane line outlines already extracted, per lane mask: id(mask) -> LaneGeometry
+_geometries = {}
+
+
+def simplify(points, tolerance=TOLERANCE):
+    """Ramer-Douglas-Peucker: the points of the polyline that keep it within tolerance."""
+    points = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        direction = end - start
+        length = math.hypot(*direction)
+        inner = points[first + 1:last] - start
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(direction[0] * inner[:, 1] - direction[1] * inner[:, 0]) / length
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return points[keep]
+
+
+def outline(component, x0, y0, tolerance=TOLERANCE):
+    """
+    Closed outline of one lane line (a (width, height) boolean patch at x0, y0):
+    its top edge left to right and its bottom edge back, in pixel-edge
+    coordinates. Lane lines run across the road, so every column holds one
+    run of pixels; a column with more keeps its outer edges.
+    """
+    width, height = component.shape
+    filled = component.any(axis=1)
+    columns = np.flatnonzero(filled)
+    tops = component.argmax(axis=1)[columns]
+    bottoms = height - component[:, ::-1].argmax(axis=1)[columns]
+    xs = x0 + columns + 0.5
+    top = [(x0 + columns[0], y0 + tops[0])] + list(zip(xs, y0 + tops)) + \
+          [(x0 + columns[-1] + 1, y0 + tops[-1])]
+    bottom = [(x0 + columns[-1] + 1, y0 + bottoms[-1])] + list(zip(xs[::-1], y0 + bottoms[::-1])) + \
+             [(x0 + columns[0], y0 + bottoms[0])]
+    return np.concatenate([simplify(top, tolerance), simplify(bottom, tolerance), [top[0]]])
+
+
+class LaneGeometry:
+    """
+    The lane lines of a road as closed outlines (polylines), and all their
+    edges as one (segments, 4) array of [ax, ay, bx, by] for ray casting.
+    """
+
+    def __init__(self, outlines, mask):
+        self.outlines = outlines
+        self.segments = np.concatenate([np.hstack([points[:-1], points[1:]])
+                                        for points in outlines]) if outlines else np.zeros((0, 4))
+        # Segment starts and edge vectors, as ray casting uses them
+        self.ax, self.ay = self.segments[:, 0].copy(), self.segments[:, 1].copy()
+        self.ex = self.segments[:, 2] - self.ax
+        self.ey = self.segments[:, 3] - self.ay
+        self.mask = mask  # To tell a ray that starts inside a line
+
+    @classmethod
+    def from_mask(cls, mask, tolerance=TOLERANCE):
+        """Outline every connected lane line of a (width, height) lane mask."""
+        labels, _ = ndimage.label(mask, structure=np.ones((3, 3)))
+        outlines = []
+        for index, (xs, ys) in enumerate(ndimage.find_objects(labels), 1):
+            outlines.append(outline(labels[xs, ys] == index, xs.start, ys.start, tolerance))
+        return cls(outlines, mask)
+
+
+def lane_geometry(mask):
+    """The LaneGeometry of a lane mask, extracted once and then cached while the mask lives."""
+    entry = _geometries.get(id(mask))
+    if entry is None or entry.mask is not mask:
+        entry = LaneGeometry.from_mask(mask)
+        _geometries[id(mask)] = entry
+        weakref.finalize(mask, _geometries.pop, id(mask), None)
+    return entry
+
+
+def cone_offsets(sensor_angle, angle_step):
+    """Ray angles of the cone (degrees): as ConeSensor for whole steps, any step works."""
+    start = -sensor_angle // 2
+    return [start + i * angle_step for i in range(int((sensor_angle // 2 - start) // angle_step) + 1)]
+
+
+class GeometrySensor:
+    """
+    Ray cone sensor intersecting its rays exactly with the lane line outlines,
+    instead of sampling the lane mask every few pixels: no stride quantization
+    and a cost that depends on the number of line segments, not on the range.
+    cast() takes and returns the same as ConeSensor.cast().
+    """
+
+    def __init__(self, sensor_range=SENSOR_RANGE, sensor_angle=SENSOR_ANGLE,
+                 angle_step=ANGLE_STEP, distance_step=None):
+        self.sensor_range = sensor_range
+        self.angle_offsets = cone_offsets(sensor_angle, angle_step)  # distance_step: ConeSensor only
+        self.offsets = np.radians(self.angle_offsets)
+
+    def cast(self, mask, car_x, car_y, car_angle):
+        """
+        Return the first lane line hit of every ray (as detected_lines) and the
+        end point of every ray (the hit, or the end of its range), as pixels.
+        """
+        geometry = lane_geometry(mask)
+        # Same ray directions as ConeSensor: screen y points down
+        sensor_angles = self.offsets - car_angle
+        dx = np.cos(sensor_angles)[:, None]
+        dy = -np.sin(sensor_angles)[:, None]
+
+        # Ray (car + t d) against every segment (a + u e), shape (rays, segments);
+        # parallel pairs divide by 0 and fail the tests below
+        ex, ey = geometry.ex, geometry.ey
+        wx, wy = geometry.ax - car_x, geometry.ay - car_y
+        reach = self.sensor_range
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inverse = 1 / (dx * ey - dy * ex)
+            t = (wx * ey - wy * ex) * inverse
+            u = (wx * dy - wy * dx) * inverse
+        t[~((u >= 0) & (u <= 1) & (t >= 0) & (t <= reach))] = np.inf
+        dx, dy = dx[:, 0], dy[:, 0]
+        nearest = t.min(axis=1, initial=np.inf)
+
+        # A ray starting inside a line hits it at once (the first pixel sample of ConeSensor)
+        width, height = mask.shape
+        start_x = (car_x + dx).astype(np.int64)
+        start_y = (car_y + dy).astype(np.int64)
+        inside = (start_x >= 0) & (start_x < width) & (start_y >= 0) & (start_y < height)
+        inside[inside] = mask[start_x[inside], start_y[inside]]
+        nearest = np.where(inside, 1.0, nearest)
+
+        hit = np.isfinite(nearest)
+        # Just past the edge, so the pixel of the hit is a line pixel
+        distance = np.where(hit, nearest + 1e-6, reach)
+        end_x = (car_x + distance * dx).astype(np.int64).tolist()
+        end_y = (car_y + distance * dy).astype(np.int64).tolist()
+
+        ray_ends = list(zip(end_x, end_y))
+        detected_lines = [ray_ends[ray] for ray in np.flatnonzero(hit)]
+        return detected_lines, ray_ends
+
+
+def benchmark(road_file="road1.png", frames=2000, seed=0):
+    """Compare GeometrySensor with ConeSensor on random car poses, at several ranges."""
+    import pygame
+    from lane_sensor import ConeSensor, lane_mask
+
+    mask = lane_mask(pygame.image.load(road_file))
+    width, height = mask.shape
+    start = time.perf_counter()
+    geometry = LaneGeometry.from_mask(mask)
+    extract_time = time.perf_counter() - start
+    print(f"Lane lines of {road_file}: {len(geometry.outlines)} outlines, "
+          f"{len(geometry.segments)} segments, extracted in {extract_time * 1e3:.1f} ms (once per road)")
+
+    rng = np.random.default_rng(seed)
+    poses = list(zip(rng.uniform(0, width, frames), rng.uniform(0, height, frames),
+                     rng.uniform(-math.pi, math.pi, frames)))
+    for sensor_range, angle_step in ((SENSOR_RANGE, ANGLE_STEP), (4 * SENSOR_RANGE, ANGLE_STEP),
+                                     (4 * SENSOR_RANGE, 1)):
+        sensors = {"ConeSensor": ConeSensor(sensor_range, SENSOR_ANGLE, angle_step),
+                   "GeometrySensor": GeometrySensor(sensor_range, SENSOR_ANGLE, angle_step)}
+        results = {}
+        for name, sensor in sensors.items():
+            sensor.cast(mask, *poses[0])
+            start = time.perf_counter()
+            results[name] = [sensor.cast(mask, *pose)[1] for pose in poses]
+            elapsed = time.perf_counter() - start
+            print(f"range {sensor_range:4d}, {len(sensor.angle_offsets):2d} rays, {name:15}"
+                  f"{elapsed / frames * 1e6:8.1f} us/frame")
+        # Ray ends closer than the pixel stride of ConeSensor (5 px) count as the same
+        rays = [(a, b) for cone, exact in zip(*results.values()) for a, b in zip(cone, exact)]
+        close = sum(math.hypot(a[0] - b[0], a[1] - b[1]) <= 5 for a, b in rays)
+        print(f"  ray ends within 5 px of each other: {close / len(rays):.1%}")
+
+
+if __name__ == "__main__":
+    benchmark()
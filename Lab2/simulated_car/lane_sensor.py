@@ -0,0 +1,298 @@
+import math
+import os
+import threading
+import time
+import weakref
+
+import numpy as np
+
+# Colors for sensor line detection
+LINE_COLORS = [
+    (250, 253, 253),  # #fafdfd
+    (206, 213, 205),  # #ced5cd
+    (140, 136, 129),  # #8c8881
+    (229, 230, 229),  # #e5e6e5
+]
+
+# Sensor constants (same as the simulators)
+SENSOR_RANGE = 450  # 30 meters in pixels
+SENSOR_ANGLE = 20  # Sensor cone angle (degrees)
+ANGLE_STEP = 4  # Degrees between two rays of the cone
+DISTANCE_STEP = 5  # Pixels between two samples of a ray
+WARM_WINDOW = 3  # CoherentConeSensor: samples searched on each side of a ray's last hit
+
+# Lane masks already computed, per road surface
+_lane_masks = weakref.WeakKeyDictionary()
+_lane_masks_lock = threading.Lock()  # Roads are also loaded on RoadAssets' background thread
+
+
+def _after_fork():
+    global _lane_masks_lock
+    _lane_masks_lock = threading.Lock()  # Possibly held by a thread the child does not have
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def lane_mask(road, line_colors=LINE_COLORS):
+    """
+    Boolean array of shape (width, height), True where the road pixel has one
+    of the lane line colors. Computed once per road surface and then cached.
+    """
+    with _lane_masks_lock:
+        mask = _lane_masks.get(road)
+    if mask is None:
+        import pygame  # Only needed here: the sensor itself works on masks
+        pixels = pygame.surfarray.array3d(road).astype(np.uint32)  # No alpha
+        # Compare each pixel as one 0xRRGGBB integer instead of three channels
+        packed = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+        mask = np.isin(packed, [(r << 16) | (g << 8) | b for r, g, b in line_colors])
+        with _lane_masks_lock:
+            mask = _lane_masks.setdefault(road, mask)
+    return mask
+
+
+def line_hits(mask, xs, ys):
+    """Whether each sample point (integer arrays) is a lane line pixel, False off the mask."""
+    width, height = mask.shape
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    # np.where instead of np.clip: the same points, at a fraction of the call overhead
+    return inside & mask[np.where(inside, xs, 0), np.where(inside, ys, 0)]
+
+
+class ConeSensor:
+    """
+    Ray cone sensor that casts all rays at once over a lane mask.
+    Gives the same detections as marching each ray with road.get_at().
+    """
+
+    def __init__(self, sensor_range=SENSOR_RANGE, sensor_angle=SENSOR_ANGLE,
+                 angle_step=ANGLE_STEP, distance_step=DISTANCE_STEP):
+        self.angle_offsets = list(range(-sensor_angle // 2,
+                                        sensor_angle // 2 + 1, angle_step))
+        self.distances = np.arange(1, sensor_range, distance_step,
+                                   dtype=np.float64)
+
+    def ray_directions(self, car_angle):
+        """(cos, sin) of the direction of every ray, arrays of shape (rays,)."""
+        # With math.cos/sin so the points match the scalar loop bit for bit
+        sensor_angles = [- car_angle - math.radians(- angle_offset)
+                         for angle_offset in self.angle_offsets]
+        return (np.array([math.cos(angle) for angle in sensor_angles]),
+                np.array([math.sin(angle) for angle in sensor_angles]))
+
+    def sample_points(self, car_x, car_y, car_angle):
+        """Integer pixel coordinates of every ray sample, each of shape (rays, samples)."""
+        cos_a, sin_a = self.ray_directions(car_angle)
+        xs = (car_x + self.distances * cos_a[:, None]).astype(np.int64)
+        ys = (car_y - self.distances * sin_a[:, None]).astype(np.int64)
+        return xs, ys
+
+    def cast(self, mask, car_x, car_y, car_angle):
+        """
+        Return the first lane line hit of every ray (as detected_lines) and the
+        end point of every ray (the hit, or the last sample if nothing was hit).
+        """
+        xs, ys = self.sample_points(car_x, car_y, car_angle)
+        hits = line_hits(mask, xs, ys)
+
+        rays = np.arange(len(xs))
+        hit_any = hits.any(axis=1)
+        last = np.where(hit_any, hits.argmax(axis=1), xs.shape[1] - 1)
+        end_x = xs[rays, last].tolist()
+        end_y = ys[rays, last].tolist()
+
+        ray_ends = list(zip(end_x, end_y))
+        detected_lines = [ray_ends[ray] for ray in np.flatnonzero(hit_any)]
+        return detected_lines, ray_ends
+
+    def distances_many(self, mask, car_xs, car_ys, car_angles):
+        """
+        Distance along every ray to the first lane line hit, for many cars at
+        once: shape (cars, rays), inf where a ray hits nothing. The samples are
+        those of cast(), up to the rounding of numpy's cos and sin.
+        """
+        sensor_angles = np.radians(self.angle_offsets) - np.asarray(car_angles)[:, None]
+        xs = (np.asarray(car_xs)[:, None, None] +
+              self.distances * np.cos(sensor_angles)[..., None]).astype(np.int64)
+        ys = (np.asarray(car_ys)[:, None, None] -
+              self.distances * np.sin(sensor_angles)[..., None]).astype(np.int64)
+        hits = line_hits(mask, xs, ys)
+        return np.where(hits.any(axis=2), self.distances[hits.argmax(axis=2)], np.inf)
+
+
+class CoherentConeSensor(ConeSensor):
+    """
+    ConeSensor that only samples the rays as far as their hits on the last
+    cast: the car moves a few pixels per frame, so the lines are found again
+    within a few samples of where they were. All rays are cast at once up to
+    window samples past the farthest last hit; a ray that hits nothing there
+    (its line moved away or went out of sight) is marched over the rest of
+    its range. The first hit of a ray within the samples cast is its first
+    hit, so the detections are exactly ConeSensor's. It pays off on long,
+    dense cones; on the simulators' cone the samples saved cost about as
+    much as the extra numpy calls (see benchmark_coherent()).
+
+    The window is shared by the rays rather than one per ray around its own
+    last hit: rows of different lengths cannot be cast in one numpy call,
+    and gathering them flat costs more than the samples it saves (about
+    1.6x ConeSensor's time on the simulators' cone, no gain on long ones).
+    """
+
+    def __init__(self, sensor_range=SENSOR_RANGE, sensor_angle=SENSOR_ANGLE,
+                 angle_step=ANGLE_STEP, distance_step=DISTANCE_STEP, window=WARM_WINDOW):
+        super().__init__(sensor_range, sensor_angle, angle_step, distance_step)
+        self.window = window
+        self.forget()
+        # Statistics: casts, rays cast, rays hit within the warm samples, samples read
+        self.casts = self.rays = self.warm_hits = self.samples = 0
+
+    def forget(self):
+        """Start the next cast from scratch (new road, car put somewhere else)."""
+        self.mask = None
+        self.warm_samples = len(self.distances)  # Samples of every ray cast first
+
+    def cast(self, mask, car_x, car_y, car_angle):
+        """Same as ConeSensor.cast()."""
+        if mask is not self.mask:
+            self.forget()
+            self.mask = mask
+        cos_a, sin_a = self.ray_directions(car_angle)
+        # The same points as ConeSensor.sample_points(), of the first warm_samples samples
+        distances = self.distances[:self.warm_samples]
+        xs = (car_x + distances * cos_a[:, None]).astype(np.int64)
+        ys = (car_y - distances * sin_a[:, None]).astype(np.int64)
+        hits = line_hits(mask, xs, ys)
+        hit_any = hits.any(axis=1)
+        last = np.where(hit_any, hits.argmax(axis=1), -1)
+        self.samples += hits.size
+        warm_hits = int(np.count_nonzero(hit_any))
+        if self.warm_samples < len(self.distances):  # Otherwise every ray was marched in full
+            self.warm_hits += warm_hits
+
+        # The other rays: march the rest of their range
+        if warm_hits < len(last) and self.warm_samples < len(self.distances):
+            cold = ~hit_any
+            distances = self.distances[self.warm_samples:]
+            found = line_hits(mask, (car_x + distances * cos_a[cold, None]).astype(np.int64),
+                              (car_y - distances * sin_a[cold, None]).astype(np.int64))
+            hit_any[cold] = found.any(axis=1)
+            last[cold] = np.where(hit_any[cold], self.warm_samples + found.argmax(axis=1), -1)
+            self.samples += found.size
+        self.casts += 1
+        self.rays += len(last)
+        farthest = int(last.max())  # -1 if no ray hit
+        self.warm_samples = (min(farthest + self.window + 1, len(self.distances))
+                             if farthest >= 0 else len(self.distances))
+
+        # The hit of every ray, or its last sample, at the same points as ConeSensor
+        distances = self.distances[last]  # -1: the last sample
+        ray_ends = list(zip((car_x + distances * cos_a).astype(np.int64).tolist(),
+                            (car_y - distances * sin_a).astype(np.int64).tolist()))
+        detected_lines = [ray_end for ray_end, hit in zip(ray_ends, hit_any.tolist()) if hit]
+        return detected_lines, ray_ends
+
+    def stats(self):
+        """
+        Warm start hit rate (rays found within the window of the last hits, of
+        all rays cast) and samples read per cast.
+        """
+        return {"warm_hit_rate": self.warm_hits / max(self.rays, 1),
+                "samples_per_cast": self.samples / max(self.casts, 1)}
+
+
+def cast_reference(road, car_x, car_y, car_angle, sensor_range=SENSOR_RANGE,
+                   sensor_angle=SENSOR_ANGLE, angle_step=ANGLE_STEP,
+                   distance_step=DISTANCE_STEP):
+    """Original per-pixel sensor loop, kept to check and benchmark ConeSensor."""
+    width, height = road.get_size()
+    detected_lines = []
+    for angle_offset in range(-sensor_angle // 2, sensor_angle // 2 + 1, angle_step):
+        sensor_angle_rad = - car_angle - math.radians(- angle_offset)
+        for distance in range(1, sensor_range, distance_step):
+            sensor_x = int(car_x + distance * math.cos(sensor_angle_rad))
+            sensor_y = int(car_y - distance * math.sin(sensor_angle_rad))
+            if 0 <= sensor_x < width and 0 <= sensor_y < height:
+                pixel_color = road.get_at((sensor_x, sensor_y))[:3]
+                if pixel_color in LINE_COLORS:
+                    detected_lines.append((sensor_x, sensor_y))
+                    break
+    return detected_lines
+
+
+def benchmark(road_file="road1.png", frames=2000, seed=0):
+    """Compare ConeSensor with the per-pixel loop on random car poses."""
+    import pygame
+    road = pygame.image.load(road_file)
+    width, height = road.get_size()
+    rng = np.random.default_rng(seed)
+    poses = list(zip(rng.uniform(0, width, frames), rng.uniform(0, height, frames),
+                     rng.uniform(-math.pi, math.pi, frames)))
+
+    sensor = ConeSensor()
+    start = time.perf_counter()
+    mask = lane_mask(road)
+    mask_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [cast_reference(road, *pose) for pose in poses]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    detected = [sensor.cast(mask, *pose)[0] for pose in poses]
+    cone_time = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(expected, detected))
+    print(f"Lane mask of {road_file}: {mask_time * 1e3:.1f} ms (once per road)")
+    print(f"Per-pixel loop: {loop_time / frames * 1e6:.1f} us/frame")
+    print(f"ConeSensor:     {cone_time / frames * 1e6:.1f} us/frame "
+          f"({loop_time / cone_time:.1f}x faster)")
+    print(f"Frames with different detections: {mismatches} of {frames}")
+
+
+def benchmark_coherent(steps=3000, seed=0):
+    """
+    Compare CoherentConeSensor with ConeSensor along a drive (the poses of one
+    frame after the other, as the simulators cast it) over the three roads,
+    with the simulators' cone and a longer and denser one.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    from road_assets import RoadAssets
+    from sim_engine import DOWN, RIGHT, UP, Simulation
+
+    rng = np.random.default_rng(seed)
+    simulation = Simulation(RoadAssets(["road1.png", "road2.png", "road3.png"]), "kinematics",
+                            clamp_speed=True)
+    poses = []
+    keys = RIGHT
+    while len(poses) < steps and simulation.step(keys):
+        if rng.random() < 0.05:  # Change the steering now and then
+            keys = RIGHT | int(rng.choice([0, UP, DOWN]))
+        poses.append((simulation.road.mask, simulation.x, simulation.y, simulation.angle))
+
+    for sensor_range, angle_step in ((SENSOR_RANGE, ANGLE_STEP), (4 * SENSOR_RANGE, 1)):
+        results = {}
+        for sensor in (ConeSensor(sensor_range, SENSOR_ANGLE, angle_step),
+                       CoherentConeSensor(sensor_range, SENSOR_ANGLE, angle_step)):
+            start = time.perf_counter()
+            results[type(sensor).__name__] = [sensor.cast(*pose)[0] for pose in poses]
+            elapsed = time.perf_counter() - start
+            print(f"range {sensor_range:4d}, {len(sensor.angle_offsets):2d} rays, "
+                  f"{type(sensor).__name__:18}{elapsed / len(poses) * 1e6:8.1f} us/frame")
+        stats = sensor.stats()
+        full = len(sensor.angle_offsets) * len(sensor.distances)
+        expected, detected = results.values()
+        mismatches = sum(a != b for a, b in zip(expected, detected))
+        print(f"  samples per frame: {stats['samples_per_cast']:.0f} of {full} "
+              f"({stats['samples_per_cast'] / full:.0%}), warm start hit rate "
+              f"{stats['warm_hit_rate']:.1%}, frames with different detections: "
+              f"{mismatches} of {len(poses)}")
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["coherent"]:
+        benchmark_coherent()
+    else:
+        benchmark()
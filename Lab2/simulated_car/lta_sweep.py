@@ -0,0 +1,213 @@
+import argparse
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import signal
+import time
+
+# Constants of CAR_LTA.py that can be swept
+SWEEPABLE = ["SAFE_DISTANCE_THRESHOLD", "LTA_CORRECTION", "SENSOR_RANGE",
+             "SENSOR_ANGLE", "tau_s", "c_s", "M", "J"]
+INTEGER_PARAMETERS = {"SENSOR_RANGE", "SENSOR_ANGLE"}  # Used in range()
+
+# Grid swept when no --param is given
+DEFAULT_GRID = {
+    "SAFE_DISTANCE_THRESHOLD": [15, 25, 35],
+    "LTA_CORRECTION": [0.4, 0.8, 1.2],
+    "SENSOR_RANGE": [300, 450],
+    "SENSOR_ANGLE": [20, 40],
+}
+
+# The car centre this close to a lane line (pixels), or off the road, is a lane departure
+DEPARTURE_DISTANCE = 3
+
+METRICS = ["lane_departures", "time_to_intervention", "min_line_distance",
+           "steps", "seconds"]
+
+RUN_TIMEOUT = 300  # Seconds to wait for the next result before giving up on the sweep
+
+# Set in every worker process by init_worker()
+sim = None
+defaults = {}
+script = None
+
+
+def init_worker(script_path=None):
+    """
+    Import the simulator headless in the worker, remember its default
+    constants and read the input script (None: CAR_LTA.DEFAULT_SCRIPT).
+    """
+    global sim, defaults, script
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    import CAR_LTA
+    # pygame (SDL) turns SIGTERM into a QUIT event: Pool.terminate() could not stop the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sim = CAR_LTA
+    defaults = {name: getattr(sim, name) for name in SWEEPABLE}
+    script = sim.load_script(script_path) if script_path else sim.DEFAULT_SCRIPT
+
+
+def lane_metrics(trajectory, road_images):
+    """Lane departures, time of the first LTA intervention and minimum distance to a line."""
+    from distance_field import load_distance_field  # Imports pygame: only in the workers
+    departures = 0
+    departed = False
+    first_intervention = math.nan
+    min_distance = math.inf
+    for sim_time, x, y, angle, lta, road_index in trajectory:
+        distance, _ = load_distance_field(road_images[road_index]).query(x, y)
+        if distance <= DEPARTURE_DISTANCE or math.isinf(distance):
+            if not departed:
+                departures += 1
+            departed = True
+        else:
+            departed = False
+        min_distance = min(min_distance, distance)
+        if lta and math.isnan(first_intervention):
+            first_intervention = sim_time
+    return {"lane_departures": departures,
+            "time_to_intervention": first_intervention,
+            "min_line_distance": min_distance}
+
+
+def run_scenario(task):
+    """Run one headless simulation with the given constants and measure it."""
+    index, params, mode, max_steps = task
+    for name, value in {**defaults, **params}.items():
+        setattr(sim, name, value)
+    sim.reset_simulation()
+
+    start = time.perf_counter()
+    trajectory = sim.simulate(mode, script, max_steps)
+    elapsed = time.perf_counter() - start
+
+    result = {**params, **lane_metrics(trajectory, sim.road_images)}
+    result["steps"] = len(trajectory)
+    result["seconds"] = elapsed
+    return index, result
+
+
+def grid_points(grid):
+    """Every combination of the values in grid ({name: [values]})."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def random_points(grid, n, seed=0):
+    """
+    n random points: values in grid are either a list to choose from or a
+    (low, high) range to sample uniformly.
+    """
+    rng = random.Random(seed)
+    points = []
+    for _ in range(n):
+        point = {}
+        for name, values in grid.items():
+            if isinstance(values, tuple):
+                value = rng.uniform(*values)
+                point[name] = round(value) if name in INTEGER_PARAMETERS else value
+            else:
+                point[name] = rng.choice(values)
+        points.append(point)
+    return points
+
+
+def parse_param(text):
+    """NAME=v1,v2,... (values) or NAME=low:high (range, for --random)."""
+    name, _, values = text.partition("=")
+    if name not in SWEEPABLE:
+        raise argparse.ArgumentTypeError(f"{name} is not one of {', '.join(SWEEPABLE)}")
+    cast = int if name in INTEGER_PARAMETERS else float
+    if ":" in values:
+        low, high = values.split(":")
+        return name, (float(low), float(high))
+    return name, [cast(value) for value in values.split(",")]
+
+
+def sweep(points, mode, script_path=None, max_steps=None, workers=None, timeout=RUN_TIMEOUT):
+    """
+    Run every parameter point on a process pool, results in the order of points.
+    The workers import CAR_LTA and read the input script at script_path
+    themselves: the parent stays free of pygame and of CAR_LTA's road loading.
+    Raises multiprocessing.TimeoutError if no run finishes for timeout seconds.
+    """
+    tasks = [(i, point, mode, max_steps) for i, point in enumerate(points)]
+    results = [None] * len(tasks)
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(script_path,))
+    try:
+        runs = pool.imap_unordered(run_scenario, tasks)
+        for done in range(1, len(tasks) + 1):
+            i, result = runs.next(timeout)
+            results[i] = result
+            print(f"\r{done}/{len(tasks)} runs", end="", flush=True)
+    except BaseException:
+        pool.terminate()  # A failed or hung worker must not keep the sweep waiting
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    print()
+    return results
+
+
+def write_table(results, path):
+    """Save the results table as CSV (parameters, then metrics)."""
+    columns = [name for name in SWEEPABLE if name in results[0]] + METRICS
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def print_table(results, rows=10):
+    """Print the best runs: fewest lane departures, then largest distance to the lines."""
+    columns = [name for name in SWEEPABLE if name in results[0]] + METRICS[:3]
+    best = sorted(results, key=lambda r: (r["lane_departures"], -r["min_line_distance"]))
+    print("  ".join(f"{column:>12.12}" for column in columns))
+    for result in best[:rows]:
+        print("  ".join(f"{result[column]:>12.4g}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep the LTA constants of CAR_LTA.py headless")
+    parser.add_argument("--param", action="append", type=parse_param, default=[],
+                        help="NAME=v1,v2,... or NAME=low:high (with --random); repeatable")
+    parser.add_argument("--random", type=int, metavar="N",
+                        help="sample N random points instead of the full grid")
+    parser.add_argument("--seed", type=int, default=0, help="seed for --random")
+    parser.add_argument("--mode", choices=["dynamic", "kinematics"], default="kinematics")
+    parser.add_argument("--script", help="input script (see CAR_LTA.load_script), "
+                                         "by default CAR_LTA.DEFAULT_SCRIPT")
+    parser.add_argument("--steps", type=int, help="stop every run after this many steps")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (default: all cores)")
+    parser.add_argument("--output", default="lta_sweep.csv", help="results table (CSV)")
+    parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT,
+                        help=f"give up when no run finishes for this many seconds "
+                             f"(default {RUN_TIMEOUT})")
+    args = parser.parse_args()
+
+    grid = dict(args.param) if args.param else DEFAULT_GRID
+    if args.random:
+        points = random_points(grid, args.random, args.seed)
+    elif any(isinstance(values, tuple) for values in grid.values()):
+        parser.error("low:high ranges need --random")
+    else:
+        points = grid_points(grid)
+
+    start = time.perf_counter()
+    results = sweep(points, args.mode, args.script, args.steps, args.workers, args.timeout)
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} runs on {args.workers} workers in {elapsed:.1f} s")
+
+    write_table(results, args.output)
+    print_table(results)
+    print(f"Results table written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
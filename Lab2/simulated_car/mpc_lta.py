@@ -0,0 +1,436 @@
+import collections
+import functools
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from lta_sweep import DEPARTURE_DISTANCE
+
+# Model-predictive LTA: instead of the fixed +/- LTA_CORRECTION once the car is
+# within the safe distance of a line, every step rolls the car model out over a
+# short horizon for many steering correction sequences at once, scores them
+# against the road's distance field and applies the first correction of the best.
+
+CANDIDATES = 256  # Correction sequences rolled out every step
+HORIZON = 20  # Steps of each rollout
+MAX_CORRECTION = 1.6  # Largest steering correction (twice the bang-bang LTA_CORRECTION)
+BUDGET = 0.002  # Seconds a control tick may take
+BATCH = 64  # Candidates rolled out at once, the budget is checked between batches
+TICK_HISTORY = 10000  # Latest tick times kept for the percentiles of stats()
+# Speed of the dynamic model a rollout ran away at (the car drives at a few
+# thousand): the model is unstable with the driving force and a steering
+# correction held, such rollouts grow to inf and count as off the road
+RUNAWAY_SPEED = 1e6
+
+# Weights of the rollout cost
+LANE_WEIGHT = 1  # Per step, (how far inside the safe distance / safe distance) ** 2
+DEPARTURE_WEIGHT = 100  # Per step over a line
+EFFORT_WEIGHT = 0.02  # Per step, (correction / MAX_CORRECTION) ** 2
+SMOOTHNESS_WEIGHT = 0.5  # Per step, (change of correction / MAX_CORRECTION) ** 2
+
+
+def correction_sequences(candidates, horizon, max_correction, seed=0):
+    """
+    The candidate sequences, shape (candidates, horizon): none (row 0), the
+    best of the last step moved on by one (row 1, filled in every step), then
+    constant corrections and smooth random walks, the same for every step.
+    """
+    rng = np.random.default_rng(seed)
+    sequences = np.zeros((candidates, horizon))
+    constants = (candidates - 2) // 4
+    sequences[2:2 + constants] = np.linspace(-max_correction, max_correction, constants)[:, None]
+    walks = candidates - 2 - constants
+    starts = rng.uniform(-max_correction, max_correction, (walks, 1))
+    moves = rng.normal(0, max_correction / 4, (walks, horizon))
+    moves[:, 0] = 0
+    sequences[2 + constants:] = np.clip(starts + np.cumsum(moves, axis=1), -max_correction,
+                                        max_correction)
+    return sequences
+
+
+def held_controls(simulation, inputs, horizon):
+    """
+    The driver's controls of the next horizon steps with the inputs of this step
+    held, by the Simulation's own control code: the (driving forces, steering
+    inputs) of the dynamic model or the (steering angles, speeds) the kinematic
+    model integrates with.
+    """
+    if simulation.mode == "dynamic":
+        forces, steering_inputs = [simulation.FD], [simulation.state[5]]
+        for _ in range(horizon - 1):
+            forces.append(simulation.driving_force(inputs, forces[-1]))
+            # runge_kutta() leaves u_2 at 0 after every step
+            steering_inputs.append(simulation.steering_input(inputs, 0.0))
+        return np.array(forces), np.array(steering_inputs)
+    steering_angles, speeds = [simulation.steering_angle], [simulation.speed]
+    for _ in range(horizon - 1):
+        steering_angle, speed = simulation.kinematic_controls(inputs, steering_angles[-1],
+                                                              speeds[-1])
+        steering_angles.append(steering_angle)
+        speeds.append(speed)
+    return np.array(steering_angles), np.array(speeds)
+
+
+def rk4_sum(stages, dt):
+    """dt / 6 (k1 + 2 k2 + 2 k3 + k4) of the four stages stacked on the first axis."""
+    weights = np.array([dt / 6, dt / 3, dt / 3, dt / 6], stages.dtype)
+    return (weights @ stages.reshape(4, -1)).reshape(stages.shape[1:])
+
+
+@functools.lru_cache()
+def steering_response(dt, tau_s, horizon):
+    """
+    (first, steer, start): the steering angle at the start of every step of the
+    dynamic model is first_inputs @ first + steer_inputs @ steer + phi * start,
+    first_inputs being the steering of the first RK4 stage of every step and
+    steer_inputs that of the others. car_dynamics() zeroes phi before the RK4
+    update, so while the clamp does not act the steering angle after a step is
+    a * phi + b * first input + c * steer input, the same a, b, c every step.
+    """
+    def step(phi, first, steer):
+        d1 = (phi + first) / tau_s
+        d2 = (dt * 0.5 * d1 + steer) / tau_s
+        d3 = (dt * 0.5 * d2 + steer) / tau_s
+        d4 = (dt * d3 + steer) / tau_s
+        return dt / 6 * (d1 + 2 * d2 + 2 * d3 + d4)
+    a, b, c = step(1, 0, 0), step(0, 1, 0), step(0, 0, 1)
+    lags = np.arange(horizon)[None, :] - 1 - np.arange(horizon)[:, None]
+    powers = np.where(lags >= 0, a ** np.maximum(lags, 0), 0)  # a ** (t - 1 - j) at [j, t]
+    return ((b * powers).astype(np.float32), (c * powers).astype(np.float32),
+            (a ** np.arange(horizon)).astype(np.float32))
+
+
+def dynamic_rollout(simulation, corrections, forces, steering_inputs):
+    """
+    (xs, ys) of the dynamic model of a Simulation (car_dynamics(), RK4 as
+    runge_kutta()) after every step of every correction sequence, each of
+    shape (candidates, horizon), with the driving force and steering input of
+    every step. Stepping like runge_kutta() takes about 1600 numpy calls,
+    whose overhead is the time of a rollout, so the whole horizon is computed
+    at once: the steering angle is linear in the corrections (one matrix
+    product), the speed is then linear in itself (a product and a sum over the
+    steps) and the angle and position are sums. Where the steering clamp acts
+    it falls back to stepwise_dynamic_rollout(). Rollouts are at nan from
+    the step they run away (RUNAWAY_SPEED) on.
+    """
+    candidates, horizon = corrections.shape
+    x0, y0, theta0, v0, phi0, _ = simulation.state
+    dt, h = simulation.dt, simulation.dt * 0.5
+    L, b, M, J = simulation.L, simulation.b, simulation.M, simulation.J
+    tau_s, c_s = simulation.tau_s, simulation.c_s
+    inertia = M * b**2 + J
+
+    # Steering angle at the start of every step. The stages are in single
+    # precision, a fraction of the time of double on arrays this size; the
+    # positions move by 1e-5 px
+    first_response, steer_response, start_response = steering_response(dt, tau_s, horizon)
+    lta = (c_s * corrections).astype(np.float32)
+    first = (c_s * np.asarray(steering_inputs)).astype(np.float32)
+    phi = lta @ (first_response + steer_response)
+    phi += first @ first_response + np.float32(phi0) * start_response
+    # The four stages of every step, stacked on the first axis
+    d1 = (phi + first + lta) / tau_s
+    d2 = (h * d1 + lta) / tau_s
+    d3 = (h * d2 + lta) / tau_s
+    d4 = (dt * d3 + lta) / tau_s
+    phis = np.stack((phi, h * d1, h * d2, dt * d3))
+    max_steer = math.radians(simulation.max_steer_angle)
+    if np.abs(phis).max() > max_steer:
+        return stepwise_dynamic_rollout(simulation, corrections, forces, steering_inputs)
+    dphis = np.stack((d1, d2, d3, d4))
+
+    # dv = g * v + e in every stage, car_dynamics() with
+    # gamma / cos(phi) ** 2 = L**2 M + inertia tan(phi) ** 2
+    tan_phis = np.tan(phis)
+    tan2_phis = tan_phis * tan_phis
+    scale = (np.asarray(forces, np.float32) + simulation.FA) / (L**2 * M + inertia * tan2_phis)
+    g = inertia * tan_phis * (1 + tan2_phis) * dphis * scale
+    e = L**2 * scale
+    # The RK4 stages of v are affine in the v of the step: k = slope * v + offset
+    slope2 = g[1] * (1 + h * g[0])
+    offset2 = g[1] * h * e[0] + e[1]
+    slope3 = g[2] * (1 + h * slope2)
+    offset3 = g[2] * h * offset2 + e[2]
+    slope4 = g[3] * (1 + dt * slope3)
+    offset4 = g[3] * dt * offset3 + e[3]
+    # v[t + 1] = growth[t] * v[t] + gain[t], in double precision: with
+    # product[t] = growth[0] ... growth[t],
+    # v[t + 1] = product[t] * (v0 + gain[0] / product[0] + ... + gain[t] / product[t])
+    growth = (1 + dt / 6 * (g[0] + 2 * (slope2 + slope3) + slope4)).astype(float)
+    gain = (dt / 6 * (e[0] + 2 * (offset2 + offset3) + offset4)).astype(float)
+    v = np.empty((candidates, horizon))
+    v[:, 0] = v0
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        product = np.cumprod(growth, axis=1)
+        v[:, 1:] = (product * (v0 + np.cumsum(gain / product, axis=1)))[:, :-1]
+        runaway = ~(np.abs(v) < RUNAWAY_SPEED)  # Also inf and nan
+    if runaway.any():
+        runaway = np.logical_or.accumulate(runaway, axis=1)
+        v[runaway] = 0  # Their positions are dropped, the rest need not see inf
+    else:
+        runaway = None
+    v = v.astype(np.float32)
+    k1 = g[0] * v + e[0]
+    k2 = slope2 * v + offset2
+    k3 = slope3 * v + offset3
+    vs = np.stack((v, v + h * k1, v + h * k2, v + dt * k3))
+
+    # Angle: dtheta = v tan(phi) / L, summed over the steps
+    dthetas = vs * tan_phis / L
+    turns = rk4_sum(dthetas, dt)
+    theta = (theta0 + np.cumsum(turns, axis=1, dtype=float) - turns).astype(np.float32)
+    thetas = np.stack((theta, theta + h * dthetas[0], theta + h * dthetas[1],
+                       theta + dt * dthetas[2]))
+    # Position: car_dynamics() with tan(theta) sin(theta) = 1 / cos(theta) - cos(theta)
+    # and tan(theta) cos(theta) = sin(theta)
+    sin_thetas, cos_thetas = np.sin(thetas), np.cos(thetas)
+    b_L = b / L
+    dxs = vs * ((1 + b_L) * cos_thetas - b_L / cos_thetas)
+    xs = x0 + np.cumsum(rk4_sum(dxs, dt), axis=1, dtype=float)
+    ys = y0 + (1 + b_L) * np.cumsum(rk4_sum(vs * sin_thetas, dt), axis=1, dtype=float)
+    if runaway is not None:
+        xs[runaway] = ys[runaway] = np.nan
+    return xs, ys
+
+
+def stepwise_dynamic_rollout(simulation, corrections, forces, steering_inputs):
+    """
+    dynamic_rollout() one step after the other, stage by stage as
+    runge_kutta() does, for steering angles the clamp of car_dynamics() limits.
+    """
+    candidates, horizon = corrections.shape
+    x0, y0, theta0, v0, phi0, _ = simulation.state
+    dt, h = simulation.dt, simulation.dt * 0.5
+    L, b, M, J = simulation.L, simulation.b, simulation.M, simulation.J
+    tau_s, c_s = simulation.tau_s, simulation.c_s
+    max_steer = math.radians(simulation.max_steer_angle)
+    inertia = M * b**2 + J
+    L2M = L**2 * M
+    b_L = b / L
+
+    def derivatives(theta, v, phi, steer, force):
+        # steer: c_s times the steering input and correction of the stage
+        phi = np.minimum(np.maximum(phi, -max_steer), max_steer)  # Clamp steering angle
+        sin_theta, cos_theta = np.sin(theta), np.cos(theta)
+        tan_phi = np.tan(phi)
+        tan2_phi = tan_phi * tan_phi
+        cos2_phi = 1 / (1 + tan2_phi)
+        gamma = cos2_phi * (L2M + inertia * tan2_phi)
+        tan_b = b_L * sin_theta / cos_theta
+        v_tan_phi = v * tan_phi
+        dphi = (phi + steer) / tau_s  # Steering dynamics
+        return (v * (cos_theta - tan_b * sin_theta), v * (sin_theta + tan_b * cos_theta),
+                v_tan_phi / L,
+                (inertia * v_tan_phi * dphi + L**2 * cos2_phi) / gamma * force,
+                dphi)
+
+    xs = np.empty((candidates, horizon))
+    ys = np.empty((candidates, horizon))
+    x, y, theta, v, phi = (np.full(candidates, float(value))
+                           for value in (x0, y0, theta0, v0, phi0))
+    for step in range(horizon):
+        force = forces[step] + simulation.FA
+        lta = c_s * corrections[:, step]
+        # car_dynamics() zeroes phi and u_2 of the state: only k1 sees them
+        d1 = derivatives(theta, v, phi, c_s * steering_inputs[step] + lta, force)
+        d2 = derivatives(theta + h * d1[2], v + h * d1[3], h * d1[4], lta, force)
+        d3 = derivatives(theta + h * d2[2], v + h * d2[3], h * d2[4], lta, force)
+        d4 = derivatives(theta + dt * d3[2], v + dt * d3[3], dt * d3[4], lta, force)
+        x, y, theta, v, phi = (
+            start + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            for start, k1, k2, k3, k4 in zip((x, y, theta, v, 0), d1, d2, d3, d4))
+        xs[:, step] = x
+        ys[:, step] = y
+    return xs, ys
+
+
+def kinematic_rollout(simulation, corrections, steering_angles, speeds):
+    """
+    (xs, ys) of the kinematic model of a Simulation (car_derivatives(), RK4)
+    for every correction sequence, with the steering angle and speed of every
+    step. The turn rate does not depend on the state, so the RK4 stages have
+    closed forms and all the steps are computed at once.
+    """
+    dt = simulation.dt
+    turn_rates = (speeds / simulation.L) * np.tan(np.radians(steering_angles + corrections))
+    turns = dt * turn_rates
+    ends = simulation.angle + np.cumsum(turns, axis=1)  # Angle after every step
+    starts = ends - turns
+    middles = starts + 0.5 * turns  # k2 and k3 are taken at the same angle
+    step = dt / 6 * speeds
+    xs = simulation.x + np.cumsum(step * (np.cos(starts) + 4 * np.cos(middles) + np.cos(ends)),
+                                  axis=1)
+    ys = simulation.y + np.cumsum(step * (np.sin(starts) + 4 * np.sin(middles) + np.sin(ends)),
+                                  axis=1)
+    return xs, ys
+
+
+class MPCController:
+    """
+    Steering correction of Simulation(lta="mpc") for every step: the first
+    correction of the best of candidates sequences rolled out over horizon
+    steps. A rollout costs lane (inside the safe distance of a line, squared),
+    departure (over a line or off the road), effort and smoothness (change
+    from the correction before). No correction is made while the rollout
+    without one stays safe, as the bang-bang LTA does not intervene outside
+    the safe distance; after a safe step only that rollout is made. The
+    road's distance field needs query_many(). The candidates are rolled out
+    batch at a time: once the next batch would not finish within budget,
+    the best candidate so far is taken (rows 0 and 1 are in the first batch,
+    which always runs). stats() reports the tick times against budget.
+    """
+
+    def __init__(self, candidates=CANDIDATES, horizon=HORIZON, max_correction=MAX_CORRECTION,
+                 budget=BUDGET, batch=BATCH, seed=0):
+        self.sequences = correction_sequences(candidates, horizon, max_correction, seed)
+        self.max_correction = max_correction
+        # Effort and smoothness within the sequences: only row 1 changes every step
+        self.effort, self.smoothness = self.fixed_costs(self.sequences)
+        self.budget = budget
+        self.batch = batch
+        self.tick_times = collections.deque(maxlen=TICK_HISTORY)
+        self.ticks = 0
+        self.over_budget = 0
+        self.cut_short = 0  # Ticks that ran out of budget before the last batch
+        self.reset()
+
+    def reset(self):
+        """Forget the last plan (the car was put somewhere else)."""
+        self.plan = np.zeros(self.sequences.shape[1])
+        self.applied = 0.0
+        self.safe = True  # The last step was safe without a correction
+
+    def fixed_costs(self, sequences):
+        """(effort, smoothness after the first correction) of every sequence."""
+        scaled = sequences / self.max_correction
+        changes = np.diff(scaled, axis=1)
+        return (EFFORT_WEIGHT * (scaled * scaled).sum(axis=1),
+                SMOOTHNESS_WEIGHT * (changes * changes).sum(axis=1))
+
+    def correction(self, simulation, inputs):
+        """The steering correction (u_2_LTA) of this step of simulation, inputs held after it."""
+        start = time.perf_counter()
+        sequences = self.sequences
+        controls = held_controls(simulation, inputs, sequences.shape[1])
+        rollout = dynamic_rollout if simulation.mode == "dynamic" else kinematic_rollout
+        safe = False  # Without a correction (row 0)
+        if self.safe:
+            # Most steps the car is safe without a correction: after such a step
+            # that rollout tells, in a tenth of the time of all of them
+            lane, departures = self.lane_costs(simulation,
+                                               *rollout(simulation, sequences[:1], *controls))
+            safe = lane[0] == 0 and departures[0] == 0
+        if not safe:
+            sequences[1, :-1] = self.plan[1:]
+            sequences[1, -1] = self.plan[-1]
+            lane, departures = self.budgeted_lane_costs(simulation, rollout, sequences,
+                                                        controls, start)
+            sequences = sequences[:len(lane)]
+            safe = lane[0] == 0 and departures[0] == 0
+        self.safe = safe
+        if safe:
+            self.plan[:] = 0
+        else:
+            effort, smoothness = self.fixed_costs(sequences[1:2])
+            self.effort[1], self.smoothness[1] = effort[0], smoothness[0]
+            first_change = (sequences[:, 0] - self.applied) / self.max_correction
+            count = len(sequences)
+            costs = (LANE_WEIGHT * lane + DEPARTURE_WEIGHT * departures + self.effort[:count] +
+                     self.smoothness[:count] + SMOOTHNESS_WEIGHT * first_change * first_change)
+            self.plan = sequences[int(costs.argmin())].copy()
+        self.applied = float(self.plan[0])
+        elapsed = time.perf_counter() - start
+        self.tick_times.append(elapsed)
+        self.ticks += 1
+        self.over_budget += elapsed > self.budget
+        return self.applied
+
+    def budgeted_lane_costs(self, simulation, rollout, sequences, controls, start):
+        """
+        lane_costs() of the first batches of sequences that fit in the budget
+        of the tick started at start (at least the first batch).
+        """
+        deadline = start + self.budget
+        lanes, departures = [], []
+        done = 0
+        while done < len(sequences):
+            batch_start = time.perf_counter()
+            if lanes and batch_start + batch_time > deadline:
+                self.cut_short += 1
+                break
+            batch = sequences[done:done + self.batch]
+            lane, departed = self.lane_costs(simulation, *rollout(simulation, batch, *controls))
+            lanes.append(lane)
+            departures.append(departed)
+            done += len(batch)
+            batch_time = time.perf_counter() - batch_start
+        return np.concatenate(lanes), np.concatenate(departures)
+
+    def lane_costs(self, simulation, xs, ys):
+        """(lane, departures) of every rollout (xs, ys) on the road's distance field."""
+        field = simulation.road.field
+        with np.errstate(invalid="ignore"):  # nan positions of runaway rollouts
+            distances, _ = field.query_many(xs.ravel(), ys.ravel())
+        distances = distances.reshape(xs.shape)
+        safe = simulation.safe_distance
+        inside = np.maximum(safe - distances, 0) / safe
+        # Off the top or bottom of the road the field has no lines: a departure too
+        off_road = ~((ys >= 0) & (ys < field.height))
+        return ((inside * inside).sum(axis=1),
+                ((distances < DEPARTURE_DISTANCE) | off_road).sum(axis=1))
+
+    def stats(self):
+        """
+        Tick times (ms) of the latest TICK_HISTORY ticks: median, 99th
+        percentile, max; of all ticks: the number, those over budget and those
+        cut short by it.
+        """
+        times = np.array(self.tick_times or [0.0]) * 1e3
+        return {"ticks": self.ticks, "median_ms": float(np.median(times)),
+                "p99_ms": float(np.percentile(times, 99)), "max_ms": float(times.max()),
+                "over_budget": self.over_budget, "cut_short": self.cut_short}
+
+
+def compare(script=None, modes=("dynamic", "kinematics")):
+    """
+    Drive CAR_LTA.py headless on script (its DEFAULT_SCRIPT if None) with the
+    bang-bang LTA on the distance field and with the MPC LTA, and print the
+    lane metrics of lta_sweep.py, the interventions, the heading reversals
+    (the car swinging from side to side) and the MPC tick times.
+    """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    import CAR_LTA
+    from lta_sweep import lane_metrics
+
+    script = CAR_LTA.load_script(script) if script else CAR_LTA.DEFAULT_SCRIPT
+    print(f"{'mode':10} {'lta':6} {'steps':>5} {'departures':>10} {'min distance':>12} "
+          f"{'interventions':>13} {'reversals':>9}")
+    for mode in modes:
+        for lta in ("field", "mpc"):
+            CAR_LTA.LTA_DISTANCE_FIELD = lta == "field"
+            CAR_LTA.LTA_MPC = lta == "mpc"
+            CAR_LTA.reset_simulation()
+            trajectory = CAR_LTA.simulate(mode, script)
+            metrics = lane_metrics(trajectory, CAR_LTA.road_images)
+            active = [step[4] for step in trajectory]
+            interventions = sum(1 for before, now in zip([False] + active, active)
+                                if now and not before)
+            turns = np.sign(np.diff([step[3] for step in trajectory]))
+            turns = turns[turns != 0]
+            reversals = int((turns[1:] != turns[:-1]).sum())
+            print(f"{mode:10} {lta:6} {len(trajectory):5} {metrics['lane_departures']:10} "
+                  f"{metrics['min_line_distance']:12.1f} {interventions:13} {reversals:9}")
+            if lta == "mpc":
+                stats = CAR_LTA.simulation.controller.stats()
+                print(f"{'':17} ticks: {stats['median_ms']:.2f} ms median, "
+                      f"{stats['p99_ms']:.2f} ms p99, {stats['max_ms']:.2f} ms max, "
+                      f"{stats['over_budget']} of {stats['ticks']} over {BUDGET * 1e3:g} ms, "
+                      f"{stats['cut_short']} cut short")
+
+
+if __name__ == "__main__":
+    # python mpc_lta.py [script]
+    compare(sys.argv[1] if len(sys.argv) > 1 else None)
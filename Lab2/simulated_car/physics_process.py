@@ -0,0 +1,266 @@
+import collections
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lane_sensor import ConeSensor
+
+# The car physics and sensor of a simulator in a worker process, so a slow
+# display.flip() does not hold back the physics and a heavy sensor does not
+# drop frames. The worker publishes the car after every step into a double
+# buffer in shared memory; the pygame loop only reads the latest one and draws.
+
+# Control slots (int64) at the start of the shared memory, written by both sides
+FRONT = 0  # Buffer holding the latest step, written by the worker
+INPUTS = 1  # sim_engine inputs of the next steps, written by the front end
+SENSING = 2  # Cast the sensor after every step (1) or not (0)
+DRIVING = 3  # Step the car (1) or wait, e.g. on the home screen (0)
+CONTROL_SLOTS = 4
+
+# Slots (float64) of one buffer, followed by the detected points and the ray
+# ends, (x, y) each. seq is odd while the worker writes the buffer.
+SEQ, STEPS, ROAD, X, Y, ANGLE, SPEED, V_U, PHI, LTA, INTERVENTIONS, FINISHED, DETECTED, RAYS = range(14)
+HEADER_SLOTS = 14
+
+# The car as the front end draws it: same names as the Simulation attributes
+Snapshot = collections.namedtuple(
+    "Snapshot", ["steps", "road_index", "x", "y", "angle", "speed", "v_u", "phi", "lta_active",
+                 "interventions", "finished", "detected_lines", "ray_ends"])
+
+
+def buffer_slots(rays):
+    return HEADER_SLOTS + 4 * rays
+
+
+def attach(memory, rays):
+    """(control, buffers) views of the shared memory block."""
+    control = np.ndarray((CONTROL_SLOTS,), np.int64, memory.buf)
+    buffers = np.ndarray((2, buffer_slots(rays)), np.float64, memory.buf,
+                         offset=control.nbytes)
+    return control, buffers
+
+
+def publish(control, buffers, simulation, rays):
+    """Write the car after a step into the back buffer, then make it the front one."""
+    buffer = buffers[1 - control[FRONT]]
+    buffer[SEQ] += 1
+    buffer[STEPS:DETECTED] = (simulation.steps, simulation.road_index, simulation.x,
+                              simulation.y, simulation.angle, simulation.speed, simulation.v_u,
+                              simulation.phi, simulation.lta_active, simulation.interventions,
+                              simulation.finished)
+    detected_lines = simulation.detected_lines[:rays]
+    buffer[DETECTED] = len(detected_lines)
+    points = HEADER_SLOTS
+    if detected_lines:
+        buffer[points:points + 2 * len(detected_lines)] = np.ravel(detected_lines)
+    ray_ends = simulation.ray_ends[:rays]
+    buffer[RAYS] = len(ray_ends)
+    if ray_ends:
+        points += 2 * rays
+        buffer[points:points + 2 * len(ray_ends)] = np.ravel(ray_ends)
+    buffer[SEQ] += 1
+    control[FRONT] = 1 - control[FRONT]
+
+
+def worker(memory_name, road_files, mode, rate, options, connection):
+    """
+    Drive a Simulation at rate steps per second (0: as fast as possible) with
+    the inputs of the control slots; commands come through connection.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # Never opens a window
+    # Forked from a pygame process SDL turns SIGTERM into a QUIT event: the worker
+    # would not stop when the front end exits
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from input_recording import InputRecorder
+    from road_assets import RoadAssets
+    from sim_engine import Simulation, input_names
+
+    memory = shared_memory.SharedMemory(memory_name)
+    roads = RoadAssets(road_files)
+    simulation = Simulation(roads, mode, **options)
+    rays = len(simulation.sensor.angle_offsets)
+    control, buffers = attach(memory, rays)
+    recorder = None
+    sensing = False
+    period = 1 / rate if rate else 0
+    next_step = time.perf_counter()
+
+    while True:
+        # Commands are answered before the next step, so they apply from it on
+        while connection.poll():
+            command, argument = connection.recv()
+            result = None
+            if command == "stop":
+                connection.send(None)
+                del control, buffers
+                memory.close()
+                roads.shutdown()
+                return
+            elif command == "mode":
+                simulation.mode = argument
+            elif command == "reset":
+                simulation.reset(simulation.road_index if argument is None else argument)
+            elif command == "get_state":
+                result = simulation.get_state()
+            elif command == "record":
+                recorder = InputRecorder(argument, simulation.mode, simulation.get_state(),
+                                         simulation.dt)
+                sensing = bool(control[SENSING])
+            elif command == "save":
+                if recorder:
+                    recorder.save(argument)
+                    recorder = None
+            publish(control, buffers, simulation, rays)
+            connection.send(result)
+
+        if not control[DRIVING] or simulation.finished:
+            connection.poll(0.01)  # Wait for the next command or the next drive
+            next_step = time.perf_counter()
+            continue
+
+        inputs = int(control[INPUTS])
+        if bool(control[SENSING]) != sensing:
+            sensing = not sensing
+            if recorder:
+                recorder.record_sensor(sensing)
+        if simulation.step(inputs):
+            if sensing:
+                simulation.sense()
+            elif simulation.ray_ends:
+                simulation.detected_lines, simulation.ray_ends = [], []
+            if recorder:
+                recorder.record_names(input_names(inputs),
+                                      (simulation.x, simulation.y, simulation.angle))
+        publish(control, buffers, simulation, rays)
+
+        if period:
+            next_step += period
+            delay = next_step - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_step = time.perf_counter()  # Behind: carry on from now, no burst of steps
+
+
+class PhysicsProcess:
+    """
+    A sim_engine.Simulation over road_files (options as for Simulation) run by
+    a worker process at rate steps per second, 0 for as fast as it goes. The
+    front end sets the inputs and reads the latest car with read(); methods
+    that change the simulation wait until the worker has done it.
+    """
+
+    def __init__(self, road_files, mode="dynamic", rate=60, **options):
+        sensor = options.get("sensor") or ConeSensor()
+        self.rays = len(sensor.angle_offsets)
+        size = 8 * CONTROL_SLOTS + 8 * 2 * buffer_slots(self.rays)
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.control, self.buffers = attach(self.memory, self.rays)
+        self.control[:] = 0
+        self.buffers[:] = 0
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=worker, name="physics", daemon=True,
+            args=(self.memory.name, list(road_files), mode, rate, options, worker_connection))
+        self.process.start()
+        self.call("reset", 0)  # Waits for the worker to be ready and publishes the start
+
+    def call(self, command, argument=None):
+        self.connection.send((command, argument))
+        return self.connection.recv()
+
+    def set_inputs(self, inputs):
+        """sim_engine inputs of the next steps."""
+        self.control[INPUTS] = inputs
+
+    def set_sensing(self, active):
+        self.control[SENSING] = int(active)
+
+    def drive(self, driving=True):
+        """Start (or stop) stepping the car."""
+        self.control[DRIVING] = int(driving)
+
+    def set_mode(self, mode):
+        self.call("mode", mode)
+
+    def reset(self, road_index=None):
+        """Simulation.reset() on road number road_index, by default the road the car is on."""
+        self.call("reset", road_index)
+
+    def get_state(self):
+        return self.call("get_state")
+
+    def record(self, simulator):
+        """Record the inputs of the steps from now on (input_recording.InputRecorder)."""
+        self.call("record", simulator)
+
+    def save_recording(self, path):
+        self.call("save", path)
+
+    def read(self):
+        """The Snapshot of the latest step."""
+        while True:
+            buffer = self.buffers[self.control[FRONT]]
+            seq = buffer[SEQ]
+            values = buffer.copy()
+            # Torn if the worker wrote this buffer meanwhile (it wrote the other one since)
+            if seq % 2 == 0 and buffer[SEQ] == seq:
+                break
+        points = values[HEADER_SLOTS:].astype(np.int64).reshape(2, self.rays, 2)
+        detected_lines = [tuple(point) for point in points[0, :int(values[DETECTED])].tolist()]
+        ray_ends = [tuple(point) for point in points[1, :int(values[RAYS])].tolist()]
+        return Snapshot(int(values[STEPS]), int(values[ROAD]), float(values[X]),
+                        float(values[Y]), float(values[ANGLE]), float(values[SPEED]),
+                        float(values[V_U]), float(values[PHI]), bool(values[LTA]),
+                        int(values[INTERVENTIONS]), bool(values[FINISHED]), detected_lines,
+                        ray_ends)
+
+    def close(self):
+        """Stop the worker and free the shared memory."""
+        if self.process.is_alive():
+            self.call("stop")
+            self.process.join()
+        del self.control, self.buffers
+        self.memory.close()
+        self.memory.unlink()
+
+
+if __name__ == "__main__":
+    # Steps and frames per second with a slow frame (a sleep standing in for
+    # drawing and display.flip()), stepping on the frame loop and in the worker:
+    # python physics_process.py [frame ms] [seconds]
+    import sys
+    from road_assets import RoadAssets
+    from sim_engine import RIGHT, Simulation
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    frame_time = (float(sys.argv[1]) if len(sys.argv) > 1 else 16) / 1000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    roads = ["road1.png", "road2.png", "road3.png"]
+    options = dict(lta="sensor", clamp_speed=True, max_speed=1)  # Long drive, sensor every step
+
+    simulation = Simulation(RoadAssets(roads), "kinematics", **options)
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds and simulation.step(RIGHT):
+        time.sleep(frame_time)
+        frames += 1
+    elapsed = time.perf_counter() - start
+    print(f"one loop:       {simulation.steps / elapsed:7.0f} steps/s, {frames / elapsed:5.1f} frames/s")
+
+    physics = PhysicsProcess(roads, "kinematics", rate=0, **options)
+    physics.set_inputs(RIGHT)
+    physics.drive()
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds and not physics.read().finished:
+        time.sleep(frame_time)
+        frames += 1
+    elapsed = time.perf_counter() - start
+    steps = physics.read().steps
+    physics.close()
+    print(f"physics worker: {steps / elapsed:7.0f} steps/s, {frames / elapsed:5.1f} frames/s")
@@ -0,0 +1,185 @@
+import collections
+import os
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from lane_sensor import LINE_COLORS, lane_mask
+
+# Roads kept in memory by default (the simulators drive through three)
+CAPACITY = 4
+
+# Every RoadAssets, to give them a new background thread in a forked child
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    """
+    A forked child (e.g. a multiprocessing.Pool worker) has none of the
+    parent's threads: the loads they had started would never finish.
+    """
+    for assets in list(_instances):
+        assets.restart()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class RoadAsset:
+    """A road ready to be used on a frame: display surface, lane mask and distance field."""
+
+    def __init__(self, surface, mask, field=None):
+        self.surface = surface
+        self.mask = mask
+        self.field = field
+
+
+class RoadAssets:
+    """
+    Road images decoded, converted to the display pixel format and with their
+    lane masks computed ahead of time, in a bounded LRU cache. Getting a road
+    also starts loading the next one on a background thread, so a road change
+    costs no disk I/O on the frame. The background thread only decodes the
+    image and computes its mask; pygame's convert() runs on the thread that
+    gets the road. Roads are cached by index, so a list that names the same
+    image more than once (e.g. the tiles of a RoadWorld) loads it again for
+    every entry once it has been evicted.
+    """
+
+    def __init__(self, road_files, capacity=CAPACITY, line_colors=LINE_COLORS,
+                 distance_fields=False):
+        self.road_files = road_files
+        self.capacity = capacity
+        self.line_colors = line_colors
+        self.distance_fields = distance_fields  # Also load each road's LaneDistanceField
+        self.cache = collections.OrderedDict()  # road index -> RoadAsset, least recently used first
+        self.pending = {}  # road index -> Future of a background load
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="road-prefetch")
+        _instances.add(self)
+
+    def restart(self):
+        """New lock and background thread, the loads in progress forgotten (after a fork)."""
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="road-prefetch")
+
+    def load(self, road_file):
+        """Decode and analyse one road image (runs on any thread)."""
+        surface = pygame.image.load(road_file)
+        mask = lane_mask(surface, self.line_colors)
+        return RoadAsset(surface, mask, self.load_field(road_file, mask) if self.distance_fields else None)
+
+    def load_field(self, road_file, mask):
+        """The LaneDistanceField of a road (runs on any thread)."""
+        from distance_field import load_distance_field
+        return load_distance_field(road_file, self.line_colors)
+
+    def get(self, index, prefetch=True):
+        """The RoadAsset of road number index; starts prefetching the next road."""
+        road_file = self.road_files[index]
+        with self.lock:
+            asset = self.cache.get(index)
+            if asset is not None:
+                self.cache.move_to_end(index)
+            future = self.pending.pop(index, None)
+        if asset is None:
+            # Wait for the background load if there is one, otherwise load now
+            asset = future.result() if future is not None else self.load(road_file)
+            if pygame.display.get_surface() is not None:
+                # Blitting an unconverted surface converts its pixels on every frame
+                asset.surface = asset.surface.convert()
+            self._store(index, asset)
+        if self.distance_fields and asset.field is None:
+            asset.field = self.load_field(road_file, asset.mask)
+        if prefetch and index + 1 < len(self.road_files):
+            self.prefetch(index + 1)
+        return asset
+
+    def __len__(self):
+        return len(self.road_files)
+
+    def __getitem__(self, index):
+        """Same as get(index): the roads can be handed to sim_engine.Simulation."""
+        return self.get(index)
+
+    def surface(self, index):
+        """The converted surface of road number index."""
+        return self.get(index).surface
+
+    def prefetch(self, index):
+        """Start loading road number index on the background thread, if it is not loaded yet."""
+        with self.lock:
+            if index in self.cache or index in self.pending:
+                return
+            self.pending[index] = self.executor.submit(self.load, self.road_files[index])
+
+    def preload(self):
+        """Load every road now (e.g. behind the home screen), as far as the capacity allows."""
+        for index in range(min(len(self.road_files), self.capacity)):
+            self.get(index, prefetch=False)
+
+    def clear(self):
+        """
+        Forget every loaded road, e.g. after the display mode is set so they are
+        loaded again converted to its pixel format.
+        """
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.cache.clear()
+        for future in pending:
+            future.cancel()
+
+    def shutdown(self):
+        """Stop the background thread."""
+        self.clear()
+        self.executor.shutdown(wait=True)
+
+    def _store(self, index, asset):
+        with self.lock:
+            self.cache[index] = asset
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+
+if __name__ == "__main__":
+    # Time of a road change with and without the cache, e.g. python road_assets.py road*.png
+    import os
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    screen = pygame.display.set_mode((1000, 600))
+    road_files = sys.argv[1:] or ["road1.png", "road2.png", "road3.png", "road4.png"]
+
+    start = time.perf_counter()
+    for road_file in road_files:
+        lane_mask(pygame.image.load(road_file))
+    uncached = (time.perf_counter() - start) / len(road_files)
+
+    assets = RoadAssets(road_files)
+    assets.get(0)
+    times = []
+    for index in range(1, len(road_files)):
+        time.sleep(0.5)  # Frames driven on the previous road, while the next one loads
+        start = time.perf_counter()
+        assets.get(index)
+        times.append(time.perf_counter() - start)
+    assets.shutdown()
+
+    print(f"road change, load on the frame: {uncached * 1000:7.2f} ms")
+    print(f"road change, prefetched:        {max(times) * 1000:7.2f} ms (worst)")
+
+    road = pygame.image.load(road_files[0])
+    converted = road.convert()
+    for name, surface in (("unconverted", road), ("converted", converted)):
+        start = time.perf_counter()
+        for _ in range(200):
+            screen.blit(surface, (0, 0))
+        print(f"blit {name:12}{(time.perf_counter() - start) / 200 * 1000:7.3f} ms")
+    pygame.quit()
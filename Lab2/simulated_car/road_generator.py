@@ -0,0 +1,300 @@
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from lane_sensor import LINE_COLORS
+from sim_engine import Road
+
+# Curvy multi-lane roads generated from a seed, far larger than the road PNGs,
+# written straight to disk as a bit-packed lane mask (8 pixels of a column
+# per byte, np.packbits along y) in a .npy file that is memory-mapped when
+# the world is opened: the sensor and the LTA only read the bytes they need.
+#   python road_generator.py worlds/big --width 1000000 --height 1000 --preview 3
+# writes worlds/big.json (the parameters), worlds/big_lanes.npy (the mask)
+# and worlds/big_tile0.png ... (previews drawn like road1.png).
+
+HEIGHT = 1000
+LANES = 3
+LANE_WIDTH = 90  # Pixels between the middles of two lines
+LINE_WIDTH = 12  # Thickness of the lines, as on the road PNGs
+DASH, GAP = 62, 62  # Dashes of the lines between two lanes
+CURVES = 4  # Sine waves summed into the middle of the road
+MIN_PERIOD, MAX_PERIOD = 2000, 20000  # Pixels, of the sine waves
+MAX_SLOPE = 0.25  # Steepest dy/dx of the road
+MARGIN = 40  # Pixels kept between the road and the top and bottom of the world
+CHUNK = 8192  # Columns generated at a time
+TILE_WIDTH = 1000  # Columns of a preview tile
+GRASS, ASPHALT = (126, 217, 87), (73, 59, 52)  # Colors of the road PNGs
+SEARCH_RADIUS = 64  # Pixels around the car searched for lines by WindowDistanceField
+START_X = 50
+
+
+class Centerline:
+    """y of the middle of the road at every x: a sum of sine waves around base."""
+
+    def __init__(self, base, amplitudes, periods, phases):
+        self.base = base
+        self.amplitudes = np.asarray(amplitudes, dtype=np.float64)
+        self.periods = np.asarray(periods, dtype=np.float64)
+        self.phases = np.asarray(phases, dtype=np.float64)
+
+    @classmethod
+    def random(cls, rng, height, road_width, curves=CURVES, max_slope=MAX_SLOPE):
+        """Random waves, scaled so the road stays inside the world and no steeper than max_slope."""
+        room = (height - road_width) / 2 - MARGIN
+        if room < 0:
+            raise ValueError(f"a road {road_width} pixels wide does not fit in a world "
+                             f"{height} pixels high")
+        periods = rng.uniform(MIN_PERIOD, MAX_PERIOD, curves)
+        weights = rng.uniform(0.5, 1, curves)
+        scale = min(room / weights.sum(), max_slope / (weights * 2 * math.pi / periods).sum())
+        return cls(height / 2, weights * scale, periods, rng.uniform(0, 2 * math.pi, curves))
+
+    def __call__(self, xs):
+        xs = np.asarray(xs, dtype=np.float64)[..., None]
+        return self.base + (self.amplitudes * np.sin(2 * math.pi * xs / self.periods + self.phases)).sum(-1)
+
+    def slope(self, xs):
+        xs = np.asarray(xs, dtype=np.float64)[..., None]
+        return (self.amplitudes * 2 * math.pi / self.periods *
+                np.cos(2 * math.pi * xs / self.periods + self.phases)).sum(-1)
+
+    def to_json(self):
+        return {"base": self.base, "amplitudes": self.amplitudes.tolist(),
+                "periods": self.periods.tolist(), "phases": self.phases.tolist()}
+
+
+def line_offsets(lanes, lane_width):
+    """Offset of every lane line from the middle of the road, top line first."""
+    return [(j - lanes / 2) * lane_width for j in range(lanes + 1)]
+
+
+def mask_chunk(x0, x1, height, centerline, lanes=LANES, lane_width=LANE_WIDTH,
+               line_width=LINE_WIDTH, dash=DASH, gap=GAP):
+    """Boolean lane mask of the columns x0 to x1, shape (x1 - x0, height)."""
+    xs = np.arange(x0, x1)
+    middle = centerline(xs)
+    # Lines keep their width across the road however steep it is
+    half = line_width / 2 * np.sqrt(1 + centerline.slope(xs) ** 2)
+    reach = np.arange(-math.ceil(half.max()), math.ceil(half.max()) + 1)
+    dashes = xs % (dash + gap) < dash
+    chunk = np.zeros((len(xs), height), dtype=bool)
+    columns = np.broadcast_to(np.arange(len(xs))[:, None], (len(xs), len(reach)))
+    for j, offset in enumerate(line_offsets(lanes, lane_width)):
+        line_y = middle + offset
+        rows = np.round(line_y)[:, None].astype(np.int64) + reach
+        on = (np.abs(rows - line_y[:, None]) <= half[:, None]) & (rows >= 0) & (rows < height)
+        if 0 < j < lanes:
+            on &= dashes[:, None]
+        chunk[columns[on], rows[on]] = True
+    return chunk
+
+
+def world_paths(path):
+    """Parameter and lane mask files of the world at path (without extension)."""
+    return path + ".json", path + "_lanes.npy"
+
+
+def generate(path, width, height=HEIGHT, lanes=LANES, seed=0, lane_width=LANE_WIDTH,
+             line_width=LINE_WIDTH, chunk=CHUNK, verbose=False):
+    """Generate a world and write it to disk, CHUNK columns at a time; returns its parameters."""
+    rng = np.random.default_rng(seed)
+    centerline = Centerline.random(rng, height, lanes * lane_width + line_width)
+    params = {"width": width, "height": height, "lanes": lanes, "seed": seed,
+              "lane_width": lane_width, "line_width": line_width, "dash": DASH, "gap": GAP,
+              "centerline": centerline.to_json()}
+    params_path, mask_path = world_paths(path)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    packed = np.lib.format.open_memmap(mask_path, mode="w+", dtype=np.uint8,
+                                       shape=(width, (height + 7) // 8))
+    for x0 in range(0, width, chunk):
+        x1 = min(x0 + chunk, width)
+        packed[x0:x1] = np.packbits(
+            mask_chunk(x0, x1, height, centerline, lanes, lane_width, line_width), axis=1)
+        if verbose and (x0 // chunk) % 16 == 0:
+            print(f"\r{x1 / width:6.1%}", end="", flush=True)
+    packed.flush()
+    del packed
+    with open(params_path, "w") as params_file:
+        json.dump(params, params_file, indent=2)
+    if verbose:
+        print()
+    return params
+
+
+class PackedLaneMask:
+    """
+    A (width, height) lane mask stored 8 pixels per byte along y, e.g.
+    memory-mapped: indexed like the boolean masks of lane_sensor.py
+    (mask[xs, ys] with integer arrays), reading only the bytes it needs.
+    """
+
+    def __init__(self, packed, height):
+        self.packed = np.asarray(packed)  # Plain array on the same memory: np.memmap slices are slow
+        self.shape = (len(packed), height)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        xs, ys = index
+        ys = np.asarray(ys)
+        return ((self.packed[xs, ys >> 3] >> (7 - (ys & 7))) & 1).astype(bool)
+
+    def region(self, x0, x1, y0, y1):
+        """The boolean block mask[x0:x1, y0:y1]."""
+        first, last = y0 // 8, (y1 + 7) // 8
+        bits = np.unpackbits(self.packed[x0:x1, first:last], axis=1)
+        return bits[:, y0 - 8 * first:y1 - 8 * first].astype(bool)
+
+
+class WindowDistanceField:
+    """
+    The LaneDistanceField checks of the LTA (query and is_safe) on a mask too
+    large for a distance transform: the nearest line pixel is searched in the
+    window of radius pixels around the car, lines farther away count as none.
+    radius must be larger than the safe distance of the LTA.
+    """
+
+    def __init__(self, mask, radius=SEARCH_RADIUS):
+        self.mask = mask
+        self.radius = radius
+        self.width, self.height = mask.shape
+
+    def query(self, x, y, radius=None):
+        """
+        Return (distance, line_id) of the nearest line: 1 = up line, 0 = down
+        line; (inf, 0) if there is none within radius (default self.radius).
+        """
+        px, py = int(x), int(y)
+        if not (0 <= px < self.width and 0 <= py < self.height):
+            return float('inf'), 0
+        r = self.radius if radius is None else radius
+        x0, y0 = max(px - r, 0), max(py - r, 0)
+        line_xs, line_ys = np.nonzero(self.mask.region(x0, min(px + r + 1, self.width),
+                                                       y0, min(py + r + 1, self.height)))
+        if not len(line_xs):
+            return float('inf'), 0
+        squared = (line_xs + (x0 - px)) ** 2 + (line_ys + (y0 - py)) ** 2
+        nearest = squared.argmin()
+        distance = math.sqrt(squared[nearest])
+        if distance > r:
+            return float('inf'), 0
+        return distance, 1 if line_ys[nearest] + y0 < y else 0
+
+    def is_safe(self, x, y, safe_threshold):
+        """Same result as LaneDistanceField.is_safe(): only lines closer than safe_threshold matter."""
+        distance, line_id = self.query(x, y, min(self.radius, math.ceil(safe_threshold)))
+        return distance > safe_threshold, line_id
+
+
+class GeneratedWorld:
+    """A generated world opened from disk: its parameters and memory-mapped lane mask."""
+
+    def __init__(self, path):
+        params_path, mask_path = world_paths(path)
+        with open(params_path) as params_file:
+            self.params = json.load(params_file)
+        self.width, self.height = self.params["width"], self.params["height"]
+        self.centerline = Centerline(**self.params["centerline"])
+        self.mask = PackedLaneMask(np.load(mask_path, mmap_mode="r"), self.height)
+        self.field = WindowDistanceField(self.mask)
+
+    def road(self):
+        """The world as a sim_engine road, for Simulation([world.road()], ...)."""
+        return Road(self.mask, self.field)
+
+    def lane_middle(self, x, lane=0):
+        """y of the middle of lane number lane (0 = top) at x."""
+        offsets = line_offsets(self.params["lanes"], self.params["lane_width"])
+        return float(self.centerline(x)) + (offsets[lane] + offsets[lane + 1]) / 2
+
+    def start(self, lane=0):
+        """Starting position of a car in lane number lane."""
+        return (START_X, self.lane_middle(START_X, lane))
+
+    def tile_surface(self, x0, x1, lines=None):
+        """
+        Columns x0 to x1 (the whole height) as a surface drawn like road1.png;
+        lines is their lane mask if already unpacked.
+        """
+        import pygame
+        if lines is None:
+            lines = self.mask.region(x0, x1, 0, self.height)
+        half = (self.params["lanes"] * self.params["lane_width"] + self.params["line_width"]) / 2
+        on_road = np.abs(np.arange(self.height) - self.centerline(np.arange(x0, x1))[:, None]) <= half
+        pixels = np.empty((x1 - x0, self.height, 3), dtype=np.uint8)
+        pixels[:] = GRASS
+        pixels[on_road] = ASPHALT
+        pixels[lines] = LINE_COLORS[0]
+        return pygame.surfarray.make_surface(pixels)
+
+    def preview(self, tile, path, tile_width=TILE_WIDTH):
+        """Write tile number tile (tile_width columns, the whole height) as a PNG drawn like road1.png."""
+        import pygame
+        x0 = tile * tile_width
+        pygame.image.save(self.tile_surface(x0, min(x0 + tile_width, self.width)), path)
+
+
+def stress(world, samples=2000, seed=0):
+    """Time a Simulation step (sensor cast and LTA check) with the car anywhere on the world."""
+    from sim_engine import Simulation
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(0, world.width, samples)
+    lanes = rng.integers(0, world.params["lanes"], samples)
+    for lta in ("sensor", "field"):
+        simulation = Simulation([world.road()], "kinematics", lta=lta, sensing=True,
+                                width=world.width, height=world.height, start=world.start())
+        interventions = 0
+        start = time.perf_counter()
+        for x, lane in zip(xs, lanes):
+            # Parked in the middle of a lane, facing along the road
+            simulation.x, simulation.y = x, world.lane_middle(x, lane)
+            simulation.angle = math.atan(world.centerline.slope(x))
+            simulation.speed = 1
+            simulation.step(0)
+            interventions += simulation.lta_active
+        elapsed = time.perf_counter() - start
+        print(f"lta={lta:6} {elapsed / samples * 1e6:8.1f} us/step, "
+              f"LTA intervened on {interventions / samples:.1%} of the steps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a curvy multi-lane road world")
+    parser.add_argument("path", help="world files prefix, e.g. worlds/big")
+    parser.add_argument("--width", type=int, default=1_000_000)
+    parser.add_argument("--height", type=int, default=HEIGHT)
+    parser.add_argument("--lanes", type=int, default=LANES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--preview", type=int, default=0, metavar="N",
+                        help="also write the first N tiles as PNG previews")
+    parser.add_argument("--stress", type=int, default=0, metavar="N",
+                        help="then time N sensor and LTA steps on the world")
+    parser.add_argument("--open", action="store_true",
+                        help="open an existing world instead of generating it")
+    args = parser.parse_args()
+
+    if not args.open:
+        start = time.perf_counter()
+        generate(args.path, args.width, args.height, args.lanes, args.seed, verbose=True)
+        size = os.path.getsize(world_paths(args.path)[1])
+        print(f"{args.width} x {args.height} world written in {time.perf_counter() - start:.1f} s "
+              f"({size / 2**20:.0f} MiB lane mask)")
+
+    start = time.perf_counter()
+    world = GeneratedWorld(args.path)
+    print(f"Opened {world.width} x {world.height} world in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    for tile in range(args.preview):
+        world.preview(tile, f"{args.path}_tile{tile}.png")
+    if args.stress:
+        stress(world, args.stress)
+
+
+if __name__ == "__main__":
+    main()
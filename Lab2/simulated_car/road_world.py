@@ -0,0 +1,176 @@
+import collections
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+from road_assets import CAPACITY, RoadAsset, RoadAssets
+from road_generator import TILE_WIDTH, GeneratedWorld
+
+# Road tiles: images of the same size whose lane lines meet at their left and right edges
+TILES = ["road1.png", "road2.png", "road3.png", "road4.png"]
+WINDOWS = 2  # Sensor windows kept: the tile the car is on and the one it came from
+
+
+def route(length, tiles=TILES):
+    """A route of length tiles, going through tiles over and over."""
+    return list(itertools.islice(itertools.cycle(tiles), length))
+
+
+class GeneratedTiles(RoadAssets):
+    """
+    RoadAssets of the tiles of a world generated by road_generator.py (all of
+    them, or the first count), tile_width columns each, for a RoadWorld:
+    a tile is drawn and its lane mask unpacked when it is loaded, and its
+    distance field is a distance transform of that mask. start is where a
+    car starts, in the middle lane.
+    """
+
+    def __init__(self, path, count=None, tile_width=TILE_WIDTH, capacity=CAPACITY,
+                 distance_fields=False):
+        self.world = GeneratedWorld(path)
+        self.tile_width = tile_width
+        tiles = self.world.width // tile_width
+        if count is not None and count > tiles:
+            raise ValueError(f"{path} has {tiles} tiles of {tile_width} columns, not {count}")
+        super().__init__(list(range(tiles if count is None else count)), capacity,
+                         distance_fields=distance_fields)
+        self.start = self.world.start(self.world.params["lanes"] // 2)
+
+    def load(self, tile):
+        x0 = tile * self.tile_width
+        lines = self.world.mask.region(x0, x0 + self.tile_width, 0, self.world.height)
+        return RoadAsset(self.world.tile_surface(x0, x0 + self.tile_width, lines), lines,
+                         self.load_field(tile, lines) if self.distance_fields else None)
+
+    def load_field(self, tile, mask):
+        from distance_field import LaneDistanceField
+        return LaneDistanceField.from_mask(mask)
+
+
+class WorldTile:
+    """
+    One tile of a RoadWorld, as sim_engine.Simulation uses a road: surface,
+    lane mask and distance field of the tile, and the window the sensor is
+    cast over, the masks of the previous, this and the next tile side by side
+    with this tile from x = origin, so the sensor sees across the tile edges.
+    """
+
+    def __init__(self, asset, window, origin):
+        self.surface = asset.surface
+        self.mask = asset.mask
+        self.field = asset.field
+        self.window = window
+        self.origin = origin
+
+
+class RoadWorld:
+    """
+    One road without breaks made of the tiles of a route side by side, tile
+    number i starting at x = i * tile width. A Simulation with continuous=True
+    drives through it on the coordinates of the current tile. The tiles are
+    RoadAssets loaded two tiles ahead of the car on a background thread and
+    evicted behind it, so memory stays the same however long the route is.
+    route is a list of tile images, or RoadAssets of the tiles such as
+    GeneratedTiles.
+    """
+
+    def __init__(self, route, capacity=CAPACITY, distance_fields=False):
+        if capacity < 4:
+            raise ValueError("a RoadWorld keeps the previous, current and next two tiles: "
+                             "capacity must be at least 4")
+        if isinstance(route, RoadAssets):
+            self.assets = route
+        else:
+            self.assets = RoadAssets(route, capacity, distance_fields=distance_fields)
+        self.windows = collections.OrderedDict()  # tile index -> (window, origin)
+
+    @property
+    def distance_fields(self):
+        return self.assets.distance_fields
+
+    @distance_fields.setter
+    def distance_fields(self, value):
+        self.assets.distance_fields = value
+
+    def __len__(self):
+        return len(self.assets)
+
+    def __getitem__(self, index):
+        """The WorldTile of tile number index; starts loading the tile after the next."""
+        asset = self.assets.get(index, prefetch=False)
+        window, origin = self.window(index)
+        if index + 2 < len(self):
+            self.assets.prefetch(index + 2)  # The next one is already in the window
+        return WorldTile(asset, window, origin)
+
+    def window(self, index):
+        """(window, origin) of tile number index, see WorldTile."""
+        entry = self.windows.get(index)
+        if entry is not None:
+            self.windows.move_to_end(index)
+            return entry
+        first, last = max(index - 1, 0), min(index + 1, len(self) - 1)
+        masks = [self.assets.get(i, prefetch=False).mask for i in range(first, last + 1)]
+        entry = (np.concatenate(masks), sum(len(mask) for mask in masks[:index - first]))
+        self.windows[index] = entry
+        while len(self.windows) > WINDOWS:
+            self.windows.popitem(last=False)
+        return entry
+
+    def surfaces(self, index):
+        """(surface, x offset) of the tiles before, at and after tile number index."""
+        tiles = []
+        for i in range(max(index - 1, 0), min(index + 1, len(self) - 1) + 1):
+            surface = self.assets.get(i, prefetch=False).surface
+            tiles.append((surface, (i - index) * surface.get_width()))
+        return tiles
+
+    def clear(self):
+        """Forget every loaded tile (see RoadAssets.clear())."""
+        self.windows.clear()
+        self.assets.clear()
+
+    def shutdown(self):
+        self.windows.clear()
+        self.assets.shutdown()
+
+
+if __name__ == "__main__":
+    # Drive the sensor and LTA through a long route headless: time per tile
+    # change and memory, e.g. python road_world.py 300, or through the first
+    # tiles of a generated world: python road_world.py 300 worlds/big
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import tracemalloc
+    from sim_engine import RIGHT, Simulation
+
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tracemalloc.start()
+    if len(sys.argv) > 2:
+        tiles = GeneratedTiles(sys.argv[2], length)
+        world = RoadWorld(tiles)
+        # The LTA steers through the curves, at a speed its corrections keep up with
+        world.distance_fields = True
+        options = dict(start=tiles.start, height=tiles.world.height, lta="field", max_speed=20)
+    else:
+        world = RoadWorld(route(length))
+        options = dict(max_speed=40)
+    simulation = Simulation(world, "kinematics", continuous=True, clamp_speed=True, **options)
+    changes = []
+    start = time.perf_counter()
+    while True:
+        road_index = simulation.road_index
+        step_start = time.perf_counter()
+        if not simulation.step(RIGHT):
+            break
+        if simulation.road_index != road_index:
+            changes.append(time.perf_counter() - step_start)
+            if simulation.road_index % 50 == 0:
+                current, peak = tracemalloc.get_traced_memory()
+                print(f"tile {simulation.road_index:4d}: {current / 2**20:6.1f} MiB in use")
+    elapsed = time.perf_counter() - start
+    world.shutdown()
+    print(f"{length} tiles, {simulation.steps} steps in {elapsed:.1f} s; tile change: "
+          f"median {np.median(changes) * 1e3:.2f} ms, max {max(changes) * 1e3:.1f} ms")
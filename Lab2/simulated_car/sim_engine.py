@@ -0,0 +1,473 @@
+import collections
+import math
+import time
+
+from detection_index import DetectionIndex
+from lane_sensor import ConeSensor
+
+# The car physics, sensor and LTA of the simulators, without pygame: the
+# scripts only read the keyboard, draw and call Simulation.step(). Several
+# simulations can run side by side in one process.
+
+# Inputs of a step: the arrow keys held, one bit each
+UP, DOWN, LEFT, RIGHT = 1, 2, 4, 8
+BUTTONS = {"UP": UP, "DOWN": DOWN, "LEFT": LEFT, "RIGHT": RIGHT}
+
+# joystick: the car is moved directly, dynamic: bicycle model driven by forces,
+# kinematics: bicycle model driven by speed and steering angle,
+# arcade: the simple model of simulated_car.py (heading in degrees)
+MODES = ("joystick", "dynamic", "kinematics", "arcade")
+
+# Constants (same as CAR_LTA.py)
+WIDTH, HEIGHT = 1000, 600
+START = (50, HEIGHT // 2 + 23)  # Starting position of the car
+DT = 0.1  # Time step for simulation
+L = 2.5  # Wheelbase in meters
+b = 1 / 3 * L
+MAX_STEER_ANGLE = 30  # Maximum steering angle in degrees
+M = 1200  # Mass of the car in kg
+J = 2000  # Moment of inertia
+FA = -10  # Friction force
+tau_s, c_s = 1, 1  # constants for steering
+ACCELERATION = 1
+MAX_SPEED = 10
+INCREMENT = 0.1  # Steering angle change per step (steering="increment")
+TURN_SPEED = 2  # Steering angle while a key is held (steering="fixed")
+FRICTION = 0.98  # Friction coefficient (reduce speed by 2% per update)
+JOYSTICK_STEP = 5  # Pixels the joystick moves the car per step
+SAFE_DISTANCE_THRESHOLD = 25
+LTA_CORRECTION = 0.8  # Steering correction of the LTA when too close to a line
+
+# Options of a Simulation and their defaults (the CAR_LTA.py car). The
+# behaviour options reproduce the other simulators:
+#   steering          "increment": UP/DOWN add -/+ increment to the steering angle (CAR_LTA.py),
+#                     "fixed": the steering angle is -/+ turn_speed while UP/DOWN is held
+#   clamp_speed       limit the kinematic speed to max_speed (kinematics.py; CAR_LTA.py
+#                     and simulated_car_homepage.py swap min and max and never limit it)
+#   speed_lag         the kinematic model moves with the speed of the previous step, the
+#                     new one is only used from the next step (CAR_LTA.py, homepage)
+#   clamp_to_screen   keep the car inside width x height (kinematics.py, simulated_car.py)
+#   change_road_first change road at the right edge before moving the car (CAR_LTA.py),
+#                     otherwise right after moving it
+#   continuous        the roads are one road (road_world.RoadWorld): the car carries on
+#                     into the next road (and back into the previous one) instead of
+#                     starting over at x = 0
+DEFAULTS = {
+    "dt": DT, "L": L, "b": b, "M": M, "J": J, "FA": FA, "tau_s": tau_s, "c_s": c_s,
+    "max_steer_angle": MAX_STEER_ANGLE, "acceleration": ACCELERATION, "max_speed": MAX_SPEED,
+    "increment": INCREMENT, "turn_speed": TURN_SPEED, "friction": FRICTION,
+    "joystick_step": JOYSTICK_STEP, "safe_distance": SAFE_DISTANCE_THRESHOLD,
+    "lta_correction": LTA_CORRECTION, "steering": "increment", "clamp_speed": False,
+    "speed_lag": True, "clamp_to_screen": False, "change_road_first": True, "continuous": False,
+    "width": WIDTH, "height": HEIGHT, "start": START,
+}
+
+# A road as the engine needs it: (width, height) lane mask and, for lta="field", its
+# LaneDistanceField. road_assets.RoadAsset (which also has the surface) works too.
+Road = collections.namedtuple("Road", ["mask", "field"], defaults=[None])
+
+# What a step left behind: simulated time, car pose and speed, road index, whether
+# the LTA intervened and the lane line points the sensor saw
+Observation = collections.namedtuple(
+    "Observation", ["time", "x", "y", "angle", "speed", "road", "lta", "detections"])
+
+
+def inputs(up=False, down=False, left=False, right=False):
+    """The inputs of a step with these keys held."""
+    return (UP if up else 0) | (DOWN if down else 0) | (LEFT if left else 0) | (RIGHT if right else 0)
+
+
+def inputs_from_names(names):
+    """The inputs of a step from key names, e.g. ["RIGHT", "UP"] (input scripts, recordings)."""
+    value = 0
+    for name in names:
+        value |= BUTTONS[name]
+    return value
+
+
+def input_names(inputs):
+    """The key names of the inputs of a step, the other way round from inputs_from_names()."""
+    return [name for name, button in BUTTONS.items() if inputs & button]
+
+
+class Simulation:
+    """
+    One car driving over a sequence of roads. roads is indexable and has a
+    len(); each road has a lane mask (and a distance field for lta="field" or
+    "mpc"). lta is None (no lane tracing assist), "sensor" (the LTA checks the
+    sensor detections), "field" (it checks the road's distance field) or "mpc"
+    (controller, by default an mpc_lta.MPCController, picks the correction
+    every step from rollouts of the car model). The sensor is cast every step
+    if sensing is set, or when sense() is called.
+    profiler, if given, is a FrameProfiler the phases of a step are timed with.
+    Other options (model constants and behaviour) are listed in DEFAULTS.
+    """
+
+    __slots__ = (
+        # Configuration
+        "roads", "mode", "lta", "sensing", "sensor", "profiler", "controller",
+        "dt", "L", "b", "M", "J", "FA", "tau_s", "c_s", "max_steer_angle", "acceleration",
+        "max_speed", "increment", "turn_speed", "friction", "joystick_step", "safe_distance",
+        "lta_correction", "steering", "clamp_speed", "speed_lag", "clamp_to_screen",
+        "change_road_first", "continuous", "width", "height", "start",
+        # State
+        "road", "road_index", "x", "y", "angle", "speed", "state", "FD", "steering_angle",
+        "heading", "detected_lines", "ray_ends", "detection_index", "lta_active", "steps",
+        "interventions", "finished", "mpc_correction",
+    )
+
+    def __init__(self, roads, mode="dynamic", lta="sensor", sensing=True, sensor=None,
+                 profiler=None, controller=None, **options):
+        unknown = set(options) - set(DEFAULTS)
+        if unknown:
+            raise TypeError(f"unknown Simulation options: {', '.join(sorted(unknown))}")
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}, not {mode!r}")
+        self.roads = roads
+        self.mode = mode
+        self.lta = lta
+        self.sensing = sensing or lta == "sensor"  # The LTA needs fresh detections every step
+        self.sensor = sensor if sensor is not None else ConeSensor()
+        self.profiler = profiler
+        if lta == "mpc" and controller is None:
+            from mpc_lta import MPCController
+            controller = MPCController()
+        self.controller = controller
+        for name, default in DEFAULTS.items():
+            setattr(self, name, options.get(name, default))
+        self.reset()
+
+    def reset(self, road_index=0):
+        """Put the car back at the start of road number road_index, at rest."""
+        self.road_index = road_index
+        self.road = self.roads[road_index]
+        self.x, self.y = self.start
+        self.angle = 0
+        self.speed = 0
+        # Dynamic model state: [x, y, angle, v_u, phi, u_2]
+        self.state = [self.x, self.y, math.radians(self.angle), 0, 0, 0]
+        self.FD = 0  # Driving force
+        self.steering_angle = 0
+        self.heading = 0  # Arcade model heading (degrees)
+        self.detected_lines = []  # Lane line positions seen by the sensor this step
+        self.ray_ends = []  # End point of every sensor ray this step
+        self.detection_index = DetectionIndex(self.detected_lines)
+        self.lta_active = False  # The LTA intervened during the last step
+        self.mpc_correction = 0  # Correction the controller picked for this step (lta="mpc")
+        if self.controller is not None:
+            self.controller.reset()
+        self.steps = 0
+        self.interventions = 0  # Steps the LTA intervened in since the reset
+        self.finished = False  # Drove off the right edge of the last road
+        if hasattr(self.sensor, "forget"):
+            self.sensor.forget()  # Sensors that search from their last detections start over
+
+    def get_state(self):
+        """Everything the next steps depend on (JSON friendly), for set_state()."""
+        return {"car": [self.x, self.y, self.angle, self.speed], "state": list(self.state),
+                "FD": self.FD, "STEERING_ANGLE": self.steering_angle, "road": self.road_index}
+
+    def set_state(self, start):
+        """Go back to a state given by get_state()."""
+        self.x, self.y, self.angle, self.speed = start["car"]
+        self.state = list(start["state"])
+        self.FD = start["FD"]
+        self.steering_angle = start["STEERING_ANGLE"]
+        self.road_index = start["road"]
+        self.road = self.roads[self.road_index]
+        if hasattr(self.sensor, "forget"):
+            self.sensor.forget()
+
+    def observe(self):
+        return Observation(self.steps * self.dt, self.x, self.y, self.angle, self.speed,
+                           self.road_index, self.lta_active, self.detected_lines)
+
+    @property
+    def v_u(self):
+        """Speed of the car in the model of its mode."""
+        return self.state[3] if self.mode == "dynamic" else self.speed
+
+    @property
+    def phi(self):
+        """Steering angle of the front wheels (radians), 0 in the modes without one."""
+        if self.mode == "dynamic":
+            return self.state[4]
+        if self.mode == "kinematics":
+            return math.radians(self.steering_angle)
+        return 0.0
+
+    def step(self, inputs, n=1):
+        """
+        Advance n steps of dt with the same inputs (see inputs()). Returns False
+        once the car drove off the last road.
+        """
+        for _ in range(n):
+            if not self._step(inputs):
+                return False
+        return True
+
+    def _step(self, inputs):
+        profiler = self.profiler
+        self.lta_active = False  # Set again by the LTA if it intervenes
+        if not self.change_road_first:
+            self._move(inputs)
+            if profiler:
+                profiler.lap("RK4")
+
+        # Check for end of road (when car reaches the right edge of the current road);
+        # on continuous roads a fast car can drive through several in one step
+        while self.x >= len(self.road.mask):
+            self.road_index += 1
+            if self.road_index >= len(self.roads):
+                self.finished = True
+                return False
+            width = len(self.road.mask)
+            self.road = self.roads[self.road_index]
+            self.x = self.x - width if self.continuous else 0  # Reset car position to the left edge
+            if self.mode == "dynamic":
+                self.state[0] = self.x
+        while self.continuous and self.x < 0 and self.road_index > 0:
+            # Back into the previous road
+            self.road_index -= 1
+            self.road = self.roads[self.road_index]
+            self.x += len(self.road.mask)
+            if self.mode == "dynamic":
+                self.state[0] = self.x
+        if profiler:
+            profiler.lap("road change")
+
+        if self.sensing:
+            self.sense()
+            if profiler:
+                profiler.lap("sensor")
+
+        if self.change_road_first:
+            self._move(inputs)
+            if profiler:
+                profiler.lap("RK4")
+        self.steps += 1
+        self.interventions += self.lta_active
+        return True
+
+    def sense(self):
+        """Cast the sensor cone from the car: the first lane line hit of every ray."""
+        road = self.road
+        window = getattr(road, "window", None)  # road_world tiles: the masks around the road
+        if window is None:
+            self.detected_lines, self.ray_ends = self.sensor.cast(
+                road.mask, self.x, self.y, self.angle)
+        else:
+            origin = road.origin
+            detected_lines, ray_ends = self.sensor.cast(window, self.x + origin, self.y, self.angle)
+            self.detected_lines = [(x - origin, y) for x, y in detected_lines]
+            self.ray_ends = [(x - origin, y) for x, y in ray_ends]
+        return self.detected_lines
+
+    def _move(self, inputs):
+        mode = self.mode
+        if mode == "dynamic":
+            self._dynamic(inputs)
+        elif mode == "kinematics":
+            self._kinematics(inputs)
+        elif mode == "joystick":
+            self._joystick(inputs)
+        elif mode == "arcade":
+            self._arcade(inputs)
+        if self.clamp_to_screen:
+            self.x = max(0, min(self.width, self.x))
+            self.y = max(0, min(self.height, self.y))
+
+    def _joystick(self, inputs):
+        if inputs & UP:
+            self.y = max(0, self.y - self.joystick_step)
+        if inputs & DOWN:
+            self.y = min(self.height, self.y + self.joystick_step)
+        if inputs & LEFT:
+            self.x = max(0, self.x - self.joystick_step)
+        if inputs & RIGHT:
+            self.x = min(self.width, self.x + self.joystick_step)
+
+    def _dynamic(self, inputs):
+        state = self.state
+        state[5] = self.steering_input(inputs, state[5])
+        self.FD = self.driving_force(inputs, self.FD)
+        if self.lta == "mpc":
+            self._plan(inputs)
+
+        self.state = state = self.runge_kutta(self.car_dynamics, state)
+        self.x, self.y, self.angle = state[0], state[1], state[2]
+
+    def steering_input(self, inputs, u_2):
+        """Steering input (u_2) of the dynamic model after a step with these inputs."""
+        if inputs & UP:
+            if u_2 > -5:
+                u_2 -= 0.1  # Steer left
+        elif inputs & DOWN:
+            if u_2 < 5:
+                u_2 += 0.1  # Steer right
+        else:
+            u_2 = 0
+        return u_2
+
+    def driving_force(self, inputs, FD):
+        """Driving force of the dynamic model after a step with these inputs."""
+        if inputs & LEFT:
+            return max(FD - 100, -10000)  # Decrease driving force (Newtons)
+        elif inputs & RIGHT:
+            return min(FD + 100, 10000)  # Increase driving force (Newtons)
+        return 0
+
+    def _kinematics(self, inputs):
+        self.steering_angle, speed = self.kinematic_controls(inputs, self.steering_angle,
+                                                             self.speed)
+        if not self.speed_lag:
+            self.speed = speed
+        if self.lta == "mpc":
+            self._plan(inputs)
+        self.x, self.y, self.angle = self.runge_kutta(self.car_derivatives,
+                                                      [self.x, self.y, self.angle])
+        self.speed = speed
+
+    def kinematic_controls(self, inputs, steering_angle, speed):
+        """(steering angle, speed) of the kinematic model after a step with these inputs."""
+        # Steering angle input
+        if self.steering == "increment":
+            if inputs & DOWN:
+                steering_angle += self.increment
+            elif inputs & UP:
+                steering_angle -= self.increment
+            else:
+                steering_angle = 0
+        else:
+            if inputs & UP:
+                steering_angle = -self.turn_speed
+            elif inputs & DOWN:
+                steering_angle = self.turn_speed
+            else:
+                steering_angle = 0
+
+        # Speed control (accelerate or decelerate)
+        if self.clamp_speed:
+            if inputs & RIGHT:
+                speed = min(speed + self.acceleration, self.max_speed)
+            elif inputs & LEFT:
+                speed = max(speed - self.acceleration, -self.max_speed)
+        else:
+            if inputs & LEFT:
+                speed = min(speed - self.acceleration, self.max_speed)
+            elif inputs & RIGHT:
+                speed = max(speed + self.acceleration, -self.max_speed)
+        speed *= self.friction  # Road friction
+        return steering_angle, speed
+
+    def _plan(self, inputs):
+        """lta="mpc": the controller picks the correction of this step, the inputs held after it."""
+        profiler = self.profiler
+        if profiler:
+            start = time.perf_counter()
+        self.mpc_correction = self.controller.correction(self, inputs)
+        self.lta_active = self.mpc_correction != 0
+        if profiler:
+            profiler.add("MPC plan", time.perf_counter() - start)
+
+    def _arcade(self, inputs):
+        if inputs & UP:  # Turn counter clockwise
+            self.heading -= self.turn_speed
+        elif inputs & DOWN:  # Turn clockwise
+            self.heading += self.turn_speed
+
+        if inputs & RIGHT:  # Move forward
+            self.speed = min(self.speed + self.acceleration, self.max_speed)
+        elif inputs & LEFT:  # Move backward
+            self.speed = max(self.speed - self.acceleration, -self.max_speed)
+        else:
+            self.speed *= self.friction  # Friction effect when no key is pressed
+
+        self.x += self.speed * math.cos(-math.radians(self.heading))
+        self.y -= self.speed * math.sin(-math.radians(self.heading))  # Y decreases as we go "up"
+        self.angle = math.radians(self.heading)
+
+    def runge_kutta(self, f, state):
+        """One Runge-Kutta (RK4) step of dt of state under the derivatives f."""
+        dt = self.dt
+        k1 = f(state)
+        k2 = f([s + dt * 0.5 * k for s, k in zip(state, k1)])
+        k3 = f([s + dt * 0.5 * k for s, k in zip(state, k2)])
+        k4 = f([s + dt * k for s, k in zip(state, k3)])
+        return [s + dt / 6 * (k1i + 2 * k2i + 2 * k3i + k4i) for
+                s, k1i, k2i, k3i, k4i in zip(state, k1, k2, k3, k4)]
+
+    def car_dynamics(self, state):
+        """
+        Derivatives of the dynamic model, state: [x, y, angle, v_u, phi, u_2].
+        Zeroes phi and u_2 of the state it is given, as the simulators always did.
+        """
+        x, y, theta, v_u, phi, u_2 = state
+        L, b, M, J = self.L, self.b, self.M, self.J
+        tau_s, c_s = self.tau_s, self.c_s
+
+        # Clamp steering angle
+        max_steer = math.radians(self.max_steer_angle)
+        phi = max(-max_steer, min(max_steer, phi))
+
+        # Precomputed values
+        cos_phi = math.cos(phi)
+        tan_phi = math.tan(phi)
+        gamma = (cos_phi ** 2) * (L**2 * M + (M * (b)**2 + J) * (tan_phi ** 2))
+
+        # Equations of motion (from Equation 2.23 in the PDF)
+        dx = v_u * ( math.cos(theta) -b/L *math.tan(theta)*math.sin(theta))
+        dy = v_u *( math.sin(theta) +b/L *math.tan(theta)*math.cos(theta))
+        dtheta = v_u * tan_phi / L
+        u_2_LTA = self.lta_steering(x, y)
+        if u_2_LTA:
+            dphi = (1 / tau_s) * (phi + c_s * (u_2 + u_2_LTA))  # Steering dynamics
+        else:
+            dphi = (1 / tau_s) * (phi + c_s * u_2)  # Steering dynamics
+        dv_u = (v_u*(b**2*M+J)*tan_phi * dphi + L**2 * cos_phi**2) / gamma * (self.FD+self.FA)
+        state[4] = 0
+        state[5] = 0
+        return [dx, dy, dtheta, dv_u, dphi, 0, u_2_LTA]
+
+    def car_derivatives(self, state):
+        """Derivatives of the kinematic model, state: [x, y, angle]."""
+        x, y, angle = state
+        speed = self.speed
+        dx = speed * math.cos(angle)
+        dy = speed * math.sin(angle)
+        u_2_LTA = self.lta_steering(x, y)
+        if u_2_LTA:
+            dtheta = (speed / self.L) * math.tan(math.radians(self.steering_angle + u_2_LTA))
+        else:
+            dtheta = (speed / self.L) * math.tan(math.radians(self.steering_angle))
+        return [dx, dy, dtheta]
+
+    def lta_steering(self, x, y):
+        """
+        Steering correction of the LTA with the car at (x, y): towards the down
+        line when too close to the up line and the other way round, 0 if safe.
+        """
+        if self.lta is None:
+            return 0
+        if self.lta == "mpc":
+            return self.mpc_correction
+        is_safe, line_id = self.lane_safety(x, y)
+        if is_safe:
+            return 0
+        self.lta_active = True
+        return self.lta_correction if line_id == 1 else -self.lta_correction
+
+    def lane_safety(self, x, y):
+        """LTA safety check of the car at (x, y): (is_safe, line_id), line_id 1 = up line, 0 = down line."""
+        profiler = self.profiler
+        if profiler:
+            start = time.perf_counter()
+        if self.lta == "field":
+            verdict = self.road.field.is_safe(x, y, self.safe_distance)
+        else:
+            if self.detection_index.detected_lines is not self.detected_lines:
+                self.detection_index = DetectionIndex(self.detected_lines)  # New step of detections
+            verdict = self.detection_index.is_safe(x, y, self.safe_distance)
+        if profiler:
+            profiler.add("LTA check", time.perf_counter() - start)
+        return verdict
@@ -1,6 +1,12 @@
 import pygame
 import math
 
+from dirty_renderer import DirtyRenderer
+from input_recording import key_inputs
+from road_assets import RoadAssets
+from sim_engine import Simulation
+from sprite_cache import RotationCache
+
 # Initialize Pygame
 pygame.init()
 
@@ -11,15 +17,13 @@ pygame.display.set_caption("Car on a Road")
 
 # Load road images
 road_images = ["road1.png", "road2.png", "road3.png"]
-current_road = 0
-road = pygame.image.load(road_images[current_road])
+road_assets = RoadAssets(road_images)  # Loaded ahead of the road changes
 
 # Car attributes
 car = pygame.image.load("car.png")
 car_width, car_height = car.get_width(), car.get_height()
-car_x, car_y = 50, HEIGHT // 2 + 23  # Starting position of the car
-car_angle = 0
-car_speed = 0
+car_sprites = RotationCache(car)  # The car at every heading, rendered once
+START = (50, HEIGHT // 2 + 23)  # Starting position of the car
 
 # Constants
 ACCELERATION = 0.2
@@ -31,6 +35,16 @@ SENSOR_ANGLE = 20   # Sensor cone angle (degrees)
 # Open a file to save detected positions
 file = open("detected_positions.txt", "w")
 
+# Arcade car: UP / DOWN turn by TURN_SPEED degrees, RIGHT / LEFT speed up forward and
+# backward, it slows down by 5% when neither is held and stays on the screen
+simulation = Simulation(road_assets, "arcade", lta=None, sensing=False,
+                        acceleration=ACCELERATION, max_speed=MAX_SPEED, turn_speed=TURN_SPEED,
+                        friction=0.95, clamp_to_screen=True, change_road_first=False,
+                        width=WIDTH, height=HEIGHT, start=START)
+
+# Only the parts of the screen that change are redrawn and updated
+renderer = DirtyRenderer(screen)
+
 # Main loop
 running = True
 while running:
@@ -38,41 +52,17 @@ while running:
         if event.type == pygame.QUIT:
             running = False
 
-    # Input handling
+    # Move the car, then change road at the right edge of the current road
     keys = pygame.key.get_pressed()
-    if keys[pygame.K_UP]:  #Turn counter clockwise
-        car_angle -= TURN_SPEED
-    elif keys[pygame.K_DOWN]:  # Turn clockwise
-        car_angle += TURN_SPEED
-
-    if keys[pygame.K_RIGHT]:  # Move forward
-        car_speed = min(car_speed + ACCELERATION, MAX_SPEED)
-    elif keys[pygame.K_LEFT]:  # Move backward
-        car_speed = max(car_speed - ACCELERATION, -MAX_SPEED)
-    else:
-        car_speed *= 0.95  # Friction effect when no key is pressed
-
-    # Update car position
-    car_x += car_speed * math.cos(-math.radians(car_angle))
-    car_y -= car_speed * math.sin(-math.radians(car_angle))  # Y decreases as we go "up"
-
-    # Ensure car_x and car_y are within valid range
-    car_x = max(0, min(WIDTH, car_x))
-    car_y = max(0, min(HEIGHT, car_y))
-
-    # Check for end of road (when car reaches the right edge of the current road)
-    road_width = road.get_width()  # Get the width of the current road image
-    if car_x >= road_width:  # Reached the right edge of the screen
-        current_road += 1
-        if current_road < len(road_images):
-            road = pygame.image.load(road_images[current_road])
-            car_x = 0  # Reset car position to the left edge
-        else:
-            print("End of map, congrats!")
-            running = False
+    if not simulation.step(key_inputs(keys)):
+        print("End of map, congrats!")
+        running = False
+    road = simulation.road.surface
+    car_x, car_y, car_angle = simulation.x, simulation.y, simulation.heading
 
-    # Draw the background (road)
-    screen.blit(road, (0, 0))
+    # Draw the background (road): erase what was drawn on the last frame
+    renderer.set_background(road)
+    renderer.begin()
 
     # Calculate the front of the car
     car_front_x = car_x 
@@ -89,6 +79,7 @@ while running:
     # Sensor simulation (anchored at the front of the car)
     sensor_points = []
     detected_lines = []  # To store the positions of detected lines
+    cone_rects = []  # Screen areas the sensor is drawn on
 
     for angle_offset in range(-SENSOR_ANGLE // 2, SENSOR_ANGLE // 2 + 1, 2):  # Steps within the cone
         sensor_angle = - math.radians(car_angle - angle_offset)  # Adjust for rotation
@@ -102,29 +93,29 @@ while running:
                 pixel_color = road.get_at((sensor_x, sensor_y))[:3]  # Ignore alpha channel
                 if pixel_color in LINE_COLORS:
                     detected_lines.append((sensor_x, sensor_y))  # Record detected line position
-                    pygame.draw.circle(screen, (255, 0, 0), (sensor_x, sensor_y), 3)  # Highlight detected point
+                    cone_rects.append(pygame.draw.circle(screen, (255, 0, 0), (sensor_x, sensor_y), 3))  # Highlight detected point
                     # Save the position to the file
                     #file.write(f"{sensor_x} \t {sensor_y}\n")
 
                     break  # Stop the ray once a line is detected
 
             # Draw the sensor ray
-            pygame.draw.line(screen, (0, 255, 0), (car_front_x, car_front_y), (sensor_x, sensor_y), 1)
+            cone_rects.append(pygame.draw.line(screen, (0, 255, 0), (car_front_x, car_front_y), (sensor_x, sensor_y), 1))
 
     # Draw detected lines (if any)
     for line_pos in detected_lines:
-        pygame.draw.circle(screen, (255, 0, 0), line_pos, 5)  # Red dots for detected lines
+        cone_rects.append(pygame.draw.circle(screen, (255, 0, 0), line_pos, 5))  # Red dots for detected lines
+    renderer.add_all(cone_rects)
 
 
 
     # Rotate and draw the car
-    rotated_car = pygame.transform.rotate(car, -car_angle)  # Negative angle to match screen coordinates
-    rect = rotated_car.get_rect(center=(car_x, car_y))
-    screen.blit(rotated_car, rect.topleft)
+    renderer.add(car_sprites.draw(screen, -car_angle, (car_x, car_y)))  # Negative angle to match screen coordinates
 
 
-    # Refresh screen
-    pygame.display.flip()
+    # Refresh the parts of the screen that changed
+    renderer.end()
     pygame.time.Clock().tick(60)
 
+road_assets.shutdown()
 pygame.quit()
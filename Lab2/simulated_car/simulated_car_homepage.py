@@ -1,28 +1,31 @@
+import argparse
 import pygame
 import math
 
+from dirty_renderer import DirtyRenderer
+from lane_sensor import ConeSensor
+from physics_process import PhysicsProcess
+from input_recording import InputRecorder, key_inputs
+from road_assets import RoadAssets
+from sim_engine import MODES, Simulation, inputs_from_names
+from sprite_cache import RotationCache
+from telemetry import RATE, TelemetryServer, parse_address
+
 # Initialize Pygame
 pygame.init()
 
 # Screen dimensions
 WIDTH, HEIGHT = 1000, 600
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Car Simulation")
 
 # Load road images
 road_images = ["road1.png", "road2.png", "road3.png"]
-current_road = 0
-road = pygame.image.load(road_images[current_road])
-
-# Open a file to save detected positions
-file = open("detected_positions.txt", "w")
+road_assets = RoadAssets(road_images)  # Loaded and converted ahead of the road changes
 
 # Load car image
 car = pygame.image.load("car.png")
 car_width, car_height = car.get_width(), car.get_height()
-car_x, car_y = 50, HEIGHT // 2 + 23  # Starting position of the car
-car_angle = 0
-car_speed = 0
+car_sprites = RotationCache(car)  # The car at every heading, rendered once
+START = (50, HEIGHT // 2 + 23)  # Starting position of the car
 
 # Constants
 L = 2.5  # Wheelbase in meters (adjust this based on your car)
@@ -38,10 +41,9 @@ MAX_V = 5 # Maximum velocity
 MAX_STEER_ANGLE = 30  # Maximum steering angle in degrees
 M = 1200  # Mass of the car in kg
 J = 2000  # Moment of inertia about 
-FA, FD = -10, 0 #Friction, driving force
+FA = -10 #Friction
 tau_s, c_s = 1, 1 #constants for steering
 FRICTION = 0.98  # Friction coefficient (reduce speed by 2% per update)
-STEERING_ANGLE = 0  # Initial steering angle
 
 # Colors for sensor line detection
 LINE_COLORS = [
@@ -51,6 +53,9 @@ LINE_COLORS = [
     (229, 230, 229),  # #e5e6e5
 ]
 
+# Sensor cone, cast over the lane mask of the current road
+cone_sensor = ConeSensor(SENSOR_RANGE, SENSOR_ANGLE, angle_step=4)
+
 # Game state variables
 running = True
 in_home_screen = True
@@ -71,119 +76,41 @@ Press 'q' to return to the home screen.
 Press 's' to toggle the sensor.
 """
 
-# State variables: [x, y, car_angle, v_u, phi, u_2 ]
-state = [car_x, car_y, math.radians(car_angle), 0, 0, 0]
-
 ########## FUNCTIONS ##########
 
-## FUNCTIONS FOR CAR MOVEMENT
-
-# Helper function: Runge-Kutta integration
-def runge_kutta(f, state, dt):
-    #print("inside runge kutta fucntion", state)
-    k1 = f(state)
-    #print("k1:",k1)
-    k2 = f([s + dt * 0.5 * k for s, k in zip(state, k1)])
-    #print("k2:",k2)
-    k3 = f([s + dt * 0.5 * k for s, k in zip(state, k2)])
-    #print("k3:",k3)
-    k4 = f([s + dt * k for s, k in zip(state, k3)])
-    #print("k4:",k4)
-    return [s + dt / 6 * (k1i + 2 * k2i + 2 * k3i + k4i) for s, k1i, k2i, k3i, k4i in zip(state, k1, k2, k3, k4)]
-
-# Dynamics model for the car
-def car_dynamics(state):
-    _, _, car_angle, v_u, phi, u_2 = state
-    global FA, FD # Access global variables
-
-    # Clamp steering angle
-    phi = max(-math.radians(MAX_STEER_ANGLE), min(math.radians(MAX_STEER_ANGLE), phi))
-
-    # Precomputed values
-    cos_phi = math.cos(phi)
-    tan_phi = math.tan(phi)
-    gamma = (cos_phi ** 2) * (L**2 * M + (M * (b)**2 + J) * (tan_phi ** 2))
-
-    # Equations of motion (from Equation 2.23 in the PDF)
-    dx = v_u * ( math.cos(car_angle) -b/L *math.tan(car_angle)*math.sin(car_angle))
-    dy = v_u *( math.sin(car_angle) +b/L *math.tan(car_angle)*math.cos(car_angle))
-    dtheta = v_u * tan_phi / L
-    dphi = (1 / tau_s) * (phi + c_s * u_2)  # Steering dynamics
-    dv_u = (v_u*(b**2*M+J)*tan_phi * dphi + L**2 * cos_phi**2) / gamma * (FD+FA)
-    state[4] = 0
-    state[5] = 0
-    return [dx, dy, dtheta, dv_u, dphi, 0]
-
-# Derivatives function for the car's motion
-def car_derivatives(state):
-    """
-    Compute the car's derivatives based on its current state.
-    state: [x, y, angle]
-    """
-    global STEERING_ANGLE
-    _, _, angle = state
-    dx = car_speed * math.cos(angle)
-    dy = car_speed * math.sin(angle)
-    dtheta = (car_speed / L) * math.tan(math.radians(STEERING_ANGLE))
-    return [dx, dy, dtheta]
-
-def joystick_mode(keys, car_x, car_y):
-                if keys[pygame.K_UP]:
-                    car_y = max(0, car_y - 5)
-                if keys[pygame.K_DOWN]:
-                    car_y = min(HEIGHT, car_y + 5)
-                if keys[pygame.K_LEFT]:
-                    car_x = max(0, car_x - 5)
-                if keys[pygame.K_RIGHT]:
-                    car_x = min(WIDTH, car_x + 5)
-                return car_x, car_y
-
-def dynamic_mode(keys, state):
-    global FD  # Access global variable
-
-    if keys[pygame.K_UP]:
-        if state[5] > -5:
-            state[5] -= 0.1  # Steer left
-    elif keys[pygame.K_DOWN]:
-        if state[5] < 5:
-            state[5] += 0.1  # Steer right
-    else:
-        state[5] = 0
-
-    if keys[pygame.K_LEFT]:
-        FD = max(FD - 100, -10000)  # Decrease driving force (Newtons)
-    elif keys[pygame.K_RIGHT]:
-        FD = min(FD + 100, 10000)  # Increase driving force (Newtons)
-    else:
-        FD = 0
-
-    # Update state using Runge-Kutta integration
-    state = runge_kutta(car_dynamics, state, DT)
-    return state
-
-def kinematics_mode(keys, car_x, car_y, car_angle, car_speed):
-    global STEERING_ANGLE  # Access global variable
-    # Steering angle input
-    if keys[pygame.K_UP]:  # Move forward
-        STEERING_ANGLE = -TURN_SPEED
-    elif keys[pygame.K_DOWN]:  # Move backward
-        STEERING_ANGLE = TURN_SPEED
-    else:
-        STEERING_ANGLE = 0  # No steering change
-
-    # Speed control (accelerate or decelerate)
-    if keys[pygame.K_LEFT]:  # Turn left (counter-clockwise)
-        car_speed = min(car_speed - ACCELERATION, MAX_SPEED)
-    elif keys[pygame.K_RIGHT]:  # Turn right (clockwise)
-        car_speed = max(car_speed + ACCELERATION, -MAX_SPEED)
-
-    # Apply road friction to car speed
-    car_speed *= FRICTION
-
-    # Update car state using the new Runge-Kutta function
-    car_x, car_y, car_angle = runge_kutta(car_derivatives, [car_x, car_y, car_angle], DT)
-    
-    return car_x, car_y, car_angle, car_speed
+## CAR SIMULATION
+
+# The car without LTA: steering held at +/- TURN_SPEED, moved before the road change,
+# sensor cast only when it is shown
+SIMULATION_OPTIONS = dict(lta=None, sensing=False, sensor=cone_sensor,
+                          dt=DT, L=L, b=b, M=M, J=J, FA=FA, tau_s=tau_s, c_s=c_s,
+                          max_steer_angle=MAX_STEER_ANGLE, acceleration=ACCELERATION,
+                          max_speed=MAX_SPEED, turn_speed=TURN_SPEED, friction=FRICTION,
+                          steering="fixed", change_road_first=False, width=WIDTH, height=HEIGHT,
+                          start=START)
+simulation = Simulation(road_assets, "dynamic", **SIMULATION_OPTIONS)
+
+def simulation_state():
+    """Everything the next steps depend on, to start a replay from (JSON friendly)."""
+    return simulation.get_state()
+
+def restore_simulation(start):
+    """Go back to a state given by simulation_state()."""
+    simulation.set_state(start)
+
+def replay(recording):
+    """Replay an InputRecorder recording from its start state: the (x, y, angle) after every step."""
+    simulation.reset()
+    restore_simulation(recording["start"])
+    simulation.mode = recording["mode"]
+    trajectory = []
+    for steps, key_names in recording["script"]:
+        step_inputs = inputs_from_names(key_names)
+        for _ in range(steps):
+            if not simulation.step(step_inputs):
+                return trajectory
+            trajectory.append((simulation.x, simulation.y, simulation.angle))
+    return trajectory
 
 # Fonts
 font = pygame.font.SysFont("Bahnschrift", 30)
@@ -238,144 +165,192 @@ def draw_home_screen(selected):
     pygame.display.flip()
 
 
-# Game loop
-while running:
-    if in_home_screen:
-        draw_home_screen(selected_option)
-
-        if not hasattr(draw_home_screen, "snapshot"):
-            draw_home_screen.snapshot = screen.copy()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected_option = (selected_option - 1) % 4  # Update to 4 options
-                elif event.key == pygame.K_DOWN:
-                    selected_option = (selected_option + 1) % 4  # Update to 4 options
-                elif event.key == pygame.K_RETURN:
-                    if selected_option == 3:  # Help option
-                        mode = "help"
-                    else:
-                        mode = ["joystick", "dynamic", "kinematics"][selected_option]
-                    in_home_screen = False
-                elif event.key == pygame.K_RIGHT and in_home_screen:
-                    selected_option = 3  # Select the Help option
-                elif event.key == pygame.K_LEFT and selected_option == 3:
-                    selected_option = 0  # Select the first option
-    else:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_q:
-                    in_home_screen = True
-                    car_x, car_y = 50, HEIGHT // 2 + 23
-                    car_angle = 0
-                    car_speed = 0
-                    state = [car_x, car_y, math.radians(car_angle), 0, 0, 0]
-                    del draw_home_screen.snapshot
-                elif event.key == pygame.K_s:
-                    # Toggle the sensor state
-                    sensor_active = not sensor_active
-
-        keys = pygame.key.get_pressed()
-
-        if mode == "joystick":
-            car_x, car_y = joystick_mode(keys, car_x, car_y)
-
-        elif mode == "dynamic":
-            # Call the function in the game loop
-            state = dynamic_mode(keys, state)
-            car_x, car_y, car_angle, v_u, phi, u_2 = state
-
-        elif mode == "kinematics":
-            # Call the function in the game loop
-            car_x, car_y, car_angle, car_speed = kinematics_mode(keys, car_x, car_y, car_angle, car_speed)
-
-        # Add the help mode handling
-        elif mode == "help":
-            screen.fill((0, 0, 0))  # Clear the screen
-            y_offset = 50
-            for line in help_text.split('\n'):
-                text_surface = font.render(line, True, (255, 255, 255))
-                screen.blit(text_surface, (50, y_offset))
-                y_offset += 40
-            pygame.display.flip()
-            pygame.time.wait(3000)  # Display help for 5 seconds
-            in_home_screen = True
-            mode = None
-
-        # Check for end of road (when car reaches the right edge of the current road)
-        road_width = road.get_width()  # Get the width of the current road image
-        if car_x >= road_width:  # Reached the right edge of the screen
-            current_road += 1
-            if current_road < len(road_images):
-                road = pygame.image.load(road_images[current_road])
-                if mode == "dynamic":
-                    state[0] = 0  # Reset car position to the left edge
-                car_x = 0  # Reset car position to the left edge
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Car simulation")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record the inputs of every drive to PATH (JSON), to replay "
+                             "them with input_recording.py; a new drive overwrites it")
+    parser.add_argument("--physics-process", action="store_true",
+                        help="run the physics and the sensor in a worker process, the window "
+                             "only draws the latest step (physics and frames on two cores)")
+    parser.add_argument("--physics-rate", type=float, default=60, metavar="HZ",
+                        help="physics steps per second with --physics-process (0: as fast "
+                             "as possible; default 60, one step per frame as without it)")
+    parser.add_argument("--fps", type=float, default=60,
+                        help="frames per second with --physics-process (default 60)")
+    parser.add_argument("--telemetry", metavar="ADDRESS",
+                        help="stream the car as newline-delimited JSON to the clients of "
+                             "ADDRESS (host:port, :port or a Unix socket path); watch it "
+                             "with python telemetry.py ADDRESS")
+    parser.add_argument("--telemetry-rate", type=float, default=RATE, metavar="HZ",
+                        help=f"telemetry frames per second (default {RATE})")
+    args = parser.parse_args()
+
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Car Simulation")
+
+    # Load the roads again, converted to the display pixel format
+    road_assets.clear()
+    simulation.reset()
+
+    # Only the parts of the screen that change are redrawn and updated
+    renderer = DirtyRenderer(screen)
+
+    # Open a file to save detected positions
+    file = open("detected_positions.txt", "w")
+
+    recorder = None  # InputRecorder of the current drive (--record)
+
+    # --physics-process: the worker owns the car, this loop sends it the keys and draws
+    physics = None
+    if args.physics_process:
+        physics = PhysicsProcess(road_images, "dynamic", args.physics_rate, **SIMULATION_OPTIONS)
+    clock = pygame.time.Clock()
+
+    # --telemetry: a server thread sends the latest step to its clients, the loop never waits for them
+    telemetry = None
+    if args.telemetry:
+        telemetry = TelemetryServer(parse_address(args.telemetry), args.telemetry_rate).start()
+
+    # Game loop
+    while running:
+        if in_home_screen:
+            draw_home_screen(selected_option)
+
+            if not hasattr(draw_home_screen, "snapshot"):
+                draw_home_screen.snapshot = screen.copy()
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_UP:
+                        selected_option = (selected_option - 1) % 4  # Update to 4 options
+                    elif event.key == pygame.K_DOWN:
+                        selected_option = (selected_option + 1) % 4  # Update to 4 options
+                    elif event.key == pygame.K_RETURN:
+                        if selected_option == 3:  # Help option
+                            mode = "help"
+                        else:
+                            mode = ["joystick", "dynamic", "kinematics"][selected_option]
+                        in_home_screen = False
+                        renderer.invalidate()  # The home screen covers the road
+                        if mode != "help":
+                            simulation.mode = mode
+                            if physics:
+                                physics.set_mode(mode)
+                                if args.record:
+                                    physics.record("simulated_car_homepage")
+                                physics.drive()
+                        if args.record and mode != "help" and not physics:
+                            recorder = InputRecorder("simulated_car_homepage", mode, simulation_state(), DT)
+                    elif event.key == pygame.K_RIGHT and in_home_screen:
+                        selected_option = 3  # Select the Help option
+                    elif event.key == pygame.K_LEFT and selected_option == 3:
+                        selected_option = 0  # Select the first option
+        else:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_q:
+                        in_home_screen = True
+                        if physics:
+                            physics.drive(False)
+                            if args.record:
+                                physics.save_recording(args.record)
+                            physics.reset()
+                        simulation.reset(simulation.road_index)  # The car starts over on this road
+                        del draw_home_screen.snapshot
+                        if recorder:
+                            recorder.save(args.record)
+                            recorder = None
+                    elif event.key == pygame.K_s:
+                        # Toggle the sensor state
+                        sensor_active = not sensor_active
+                        if physics:
+                            physics.set_sensing(sensor_active)
+                        if recorder:
+                            recorder.record_sensor(sensor_active)
+
+            keys = pygame.key.get_pressed()
+
+            # Add the help mode handling
+            if mode == "help":
+                screen.fill((0, 0, 0))  # Clear the screen
+                y_offset = 50
+                for line in help_text.split('\n'):
+                    text_surface = font.render(line, True, (255, 255, 255))
+                    screen.blit(text_surface, (50, y_offset))
+                    y_offset += 40
+                pygame.display.flip()
+                pygame.time.wait(3000)  # Display help for 5 seconds
+                in_home_screen = True
+                mode = None
+                renderer.invalidate()
+
+            # Move the car (and change road at the right edge)
+            if physics:
+                # The worker steps the car with the keys held; draw its latest step
+                physics.set_inputs(key_inputs(keys))
+                shown = physics.read()  # The step drawn: a Snapshot, or the simulation itself
+                if shown.finished:
+                    print("End of map, congrats!")
+                    running = False
+                road_surface = road_assets.surface(min(shown.road_index, len(road_assets) - 1))  # Past the last road at the end
             else:
-                print("End of map, congrats!")
-                running = False
-
-        # Draw the background (road)
-        screen.blit(road, (0, 0))
-
-        # Calculate the front of the car
-        car_front_x = car_x 
-        car_front_y = car_y 
-
-        # Define the color of the road lines (e.g., white lines)
-        LINE_COLORS = [
-            (250, 253, 253),  # #fafdfd
-            (206, 213, 205),  # #ced5cd
-            (140, 136, 129),  # #8c8881
-            (229, 230, 229),  # #e5e6e5
-        ]
-
-        # Sensor simulation (anchored at the front of the car)
-        if sensor_active:    
-            sensor_points = []
-            detected_lines = []  # To store the positions of detected lines
-
-            for angle_offset in range(-SENSOR_ANGLE // 2, SENSOR_ANGLE // 2 + 1, 4):  # Steps within the cone
-                sensor_angle = - car_angle - math.radians(- angle_offset)  # Adjust for rotation
-                for distance in range(1, SENSOR_RANGE, 5):  # Incremental steps along the ray
-                    sensor_x = int(car_front_x + distance * math.cos(sensor_angle))
-                    sensor_y = int(car_front_y - distance * math.sin(sensor_angle))
-
-                    # Ensure the sensor point is within screen bounds
-                    if 0 <= sensor_x < WIDTH and 0 <= sensor_y < HEIGHT:
-                        # Check the color of the pixel at the sensor point
-                        pixel_color = road.get_at((sensor_x, sensor_y))[:3]  # Ignore alpha channel
-                        if pixel_color in LINE_COLORS:
-                            detected_lines.append((sensor_x, sensor_y))  # Record detected line position
-                            pygame.draw.circle(screen, (255, 0, 0), (sensor_x, sensor_y), 3)  # Highlight detected point
-                            # Save the position to the file
-                            #file.write(f"{sensor_x} \t {sensor_y}\n")
-
-                            break  # Stop the ray once a line is detected
-
-                    # Draw the sensor ray
-                    pygame.draw.line(screen, (0, 255, 0), (car_front_x, car_front_y), (sensor_x, sensor_y), 1)
-
-            # Draw detected lines (if any)
-            for line_pos in detected_lines:
-                pygame.draw.circle(screen, (255, 0, 0), line_pos, 5)  # Red dots for detected lines
-
-
-
-        # Rotate and draw the car
-        rotated_car = pygame.transform.rotate(car, -math.degrees(car_angle))  # Negative angle to match screen coordinates
-        rect = rotated_car.get_rect(center=(car_x, car_y))
-        screen.blit(rotated_car, rect.topleft)
-
-
-        # Refresh screen
-        pygame.display.flip()
-        pygame.time.Clock().tick(60)
-
-
-pygame.quit()
+                shown = simulation
+                if mode in MODES:
+                    if not simulation.step(key_inputs(keys)):
+                        print("End of map, congrats!")
+                        running = False
+                    elif recorder:
+                        recorder.record_step(keys, (simulation.x, simulation.y, simulation.angle))
+                road_surface = simulation.road.surface
+
+            # Draw the background (road): erase what was drawn on the last frame
+            renderer.set_background(road_surface)
+            renderer.begin()
+
+            # Calculate the front of the car
+            car_front_x = shown.x
+            car_front_y = shown.y
+
+            # Sensor simulation (anchored at the front of the car)
+            if sensor_active:    
+                detected_lines = shown.detected_lines if physics else simulation.sense()
+
+                # Draw the sensor rays
+                renderer.add_all([pygame.draw.line(screen, (0, 255, 0), (car_front_x, car_front_y), ray_end, 1)
+                                  for ray_end in shown.ray_ends])
+
+                # Draw detected lines (if any)
+                for line_pos in detected_lines:
+                    renderer.add(pygame.draw.circle(screen, (255, 0, 0), line_pos, 5))  # Red dots for detected lines
+
+            if telemetry and mode in MODES:
+                telemetry.publish(shown, detected_lines if sensor_active else [])
+
+            # Rotate and draw the car
+            renderer.add(car_sprites.draw(screen, -math.degrees(shown.angle), (shown.x, shown.y)))  # Negative angle to match screen coordinates
+
+            # Refresh the parts of the screen that changed
+            renderer.end()
+            if physics:
+                clock.tick(args.fps)
+            else:
+                pygame.time.Clock().tick(60)
+
+
+    if recorder:
+        recorder.save(args.record)
+    if physics:
+        if args.record:
+            physics.save_recording(args.record)
+        physics.close()
+    if telemetry:
+        telemetry.close()
+        for name, sent, dropped, _ in telemetry.stats():
+            print(f"telemetry client {name}: {sent} frames sent, {dropped} dropped")
+    road_assets.shutdown()
+    pygame.quit()
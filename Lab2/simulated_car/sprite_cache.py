@@ -0,0 +1,114 @@
+import collections
+import math
+import os
+import sys
+import time
+
+import pygame
+
+# Default heading resolution (degrees) and memory budget of a cache (bytes)
+STEP = 1.0
+MAX_BYTES = 32 * 1024 * 1024
+
+
+def crop_centered(sprite):
+    """
+    The smallest part of sprite that holds all its visible pixels and has the
+    same centre, so rotating it about the centre draws the same car.
+    car.png is 645x387 with a 73x45 car in the middle.
+    """
+    bounds = sprite.get_bounding_rect()
+    if bounds.width == 0 or bounds.height == 0:
+        return sprite
+    # Cut the same margin from both sides
+    width, height = sprite.get_size()
+    margin_x = min(bounds.left, width - bounds.right)
+    margin_y = min(bounds.top, height - bounds.bottom)
+    rect = pygame.Rect(margin_x, margin_y, width - 2 * margin_x, height - 2 * margin_y)
+    return sprite.subsurface(rect).copy()
+
+
+class RotationCache:
+    """
+    A sprite rendered at quantized headings, so drawing it at any angle is a
+    dictionary lookup instead of a pygame.transform.rotate() per frame.
+    All headings are rendered at startup (eager=True) or on first use, and
+    the least recently used ones are dropped beyond max_bytes.
+    """
+
+    def __init__(self, sprite, step=STEP, smooth=False, max_bytes=MAX_BYTES, crop=True,
+                 eager=True):
+        self.sprite = crop_centered(sprite) if crop else sprite
+        self.step = step  # Degrees between two cached headings
+        self.smooth = smooth  # rotozoom (filtered) instead of rotate
+        self.max_bytes = max_bytes
+        self.headings = round(360 / step)
+        self.cache = collections.OrderedDict()  # heading index -> rotated surface
+        self.bytes = 0
+        if eager:
+            self.prerender()
+
+    def render(self, index):
+        """The sprite rotated to heading number index."""
+        angle = index * self.step
+        if self.smooth:
+            return pygame.transform.rotozoom(self.sprite, angle, 1)
+        return pygame.transform.rotate(self.sprite, angle)
+
+    def get(self, angle):
+        """The sprite rotated counterclockwise by angle degrees, rounded to the step."""
+        index = round(angle / self.step) % self.headings
+        surface = self.cache.get(index)
+        if surface is not None:
+            self.cache.move_to_end(index)
+            return surface
+
+        surface = self.render(index)
+        self.cache[index] = surface
+        self.bytes += surface.get_bytesize() * surface.get_width() * surface.get_height()
+        while self.bytes > self.max_bytes and len(self.cache) > 1:
+            _, dropped = self.cache.popitem(last=False)
+            self.bytes -= dropped.get_bytesize() * dropped.get_width() * dropped.get_height()
+        return surface
+
+    def prerender(self):
+        """Render every heading now, as far as max_bytes allows."""
+        for index in range(self.headings):
+            self.get(index * self.step)
+            if len(self.cache) <= index:
+                break  # Over the budget: the rest is rendered on demand
+
+    def draw(self, screen, angle, center):
+        """Blit the sprite rotated by angle degrees, centred on center; returns the drawn rect."""
+        rotated = self.get(angle)
+        return screen.blit(rotated, rotated.get_rect(center=center))
+
+
+if __name__ == "__main__":
+    # Cost of drawing the car per frame, e.g. python sprite_cache.py 0.5
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    screen = pygame.display.set_mode((1000, 600))
+    car = pygame.image.load("car.png").convert_alpha()
+    step = float(sys.argv[1]) if len(sys.argv) > 1 else STEP
+    angles = [math.degrees(0.3 * math.sin(frame / 50)) for frame in range(2000)]
+
+    start = time.perf_counter()
+    for angle in angles:
+        rotated = pygame.transform.rotate(car, -angle)
+        screen.blit(rotated, rotated.get_rect(center=(500, 300)))
+    rotate_time = (time.perf_counter() - start) / len(angles)
+
+    for smooth in (False, True):
+        start = time.perf_counter()
+        cache = RotationCache(car, step, smooth)
+        prerender_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for angle in angles:
+            cache.draw(screen, -angle, (500, 300))
+        cached_time = (time.perf_counter() - start) / len(angles)
+        print(f"{'rotozoom' if smooth else 'rotate':8} step {step:g} deg: {len(cache.cache)} headings, "
+              f"{cache.bytes / 1e6:.1f} MB, prerendered in {prerender_time:.2f} s")
+    print(f"rotate every frame: {rotate_time * 1e6:8.1f} us/frame")
+    print(f"cached heading:     {cached_time * 1e6:8.1f} us/frame")
+    pygame.quit()
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# Live telemetry of a simulator for tools outside it. An asyncio server in a
+# background thread streams the car to every client connected over TCP or a
+# Unix socket, as newline-delimited JSON:
+#   {"seq": 41, "step": 123, "x": 412.5, "y": 318.2, "theta": 0.02, "v_u": 14.7,
+#    "phi": -0.01, "lta": false, "interventions": 3, "detections": [[520, 217]],
+#    "dropped": 0}
+# The game loop only hands the latest car to publish(); frames are sent at a
+# fixed rate from the server thread. A client that reads too slowly never holds
+# back the others or the game: its oldest frames are dropped and counted
+# ("dropped", the frames that client lost so far; "seq", the number of the
+# frame, jumps over them).
+
+RATE = 20  # Frames per second sent to every client
+QUEUE_FRAMES = 4  # Frames waiting for a slow client before the oldest is dropped
+SEND_BUFFER = 4096  # Bytes the kernel and the transport hold per client, so frames are fresh
+
+
+def parse_address(text):
+    """("host", port) from "host:port" or ":port", else text as a Unix socket path."""
+    host, colon, port = text.rpartition(":")
+    if colon and port.isdigit() and "/" not in text:
+        return host or "127.0.0.1", int(port)
+    return text
+
+
+def car_frame(car, detections):
+    """
+    The telemetry of a sim_engine.Simulation or physics_process.Snapshot;
+    "interventions" counts every step the LTA intervened in, sent or not.
+    """
+    return {"step": car.steps, "x": car.x, "y": car.y, "theta": car.angle, "v_u": car.v_u,
+            "phi": car.phi, "lta": car.lta_active, "interventions": car.interventions,
+            "detections": list(detections)}
+
+
+class Client:
+    """A connected client: the frames waiting for it and what it got so far."""
+
+    def __init__(self, name, writer, queue_frames):
+        self.name = name
+        self.writer = writer
+        self.task = asyncio.current_task()
+        self.queue = asyncio.Queue(queue_frames)
+        self.sent = 0
+        self.dropped = 0
+        self.seq = 0  # Of the last frame queued
+
+    def put(self, seq, line):
+        """Queue frame number seq, serialized without "dropped", dropping the oldest if full."""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.seq = seq
+        self.queue.put_nowait(f'{line}, "dropped": {self.dropped}}}\n'.encode())
+
+
+class TelemetryServer:
+    """
+    Serves the frames given to publish() at rate frames per second on
+    address, ("host", port) or a Unix socket path, from a daemon thread.
+    A client gets the latest frame as soon as it connects.
+    """
+
+    def __init__(self, address, rate=RATE, queue_frames=QUEUE_FRAMES):
+        self.address = address
+        self.period = 1 / rate
+        self.queue_frames = queue_frames
+        self.clients = []
+        self.gone = []  # Clients that disconnected, for stats()
+        self.connections = 0
+        self.step = None  # Step of the last car published
+        self.latest = None  # Frame of the last car published, swapped whole
+        self.serialized = (None, 0, None)  # (frame, seq, line) of the last frame serialized
+        self.loop = None
+        self.stopping = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+
+    def start(self):
+        """Start serving; raises the error if the address cannot be bound."""
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+        return self
+
+    def publish(self, car, detections=None):
+        """
+        The car after a step, with the sensor detections of that step (by
+        default car.detected_lines); the same step again is ignored.
+        """
+        if car.steps == self.step:
+            return
+        self.step = car.steps
+        self.latest = car_frame(car, car.detected_lines if detections is None else detections)
+
+    def stats(self):
+        """(name, frames sent, frames dropped, still connected) of every client so far."""
+        return ([(client.name, client.sent, client.dropped, False) for client in list(self.gone)] +
+                [(client.name, client.sent, client.dropped, True) for client in list(self.clients)])
+
+    def close(self):
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            if isinstance(self.address, str):
+                server = await asyncio.start_unix_server(self.handle, path=self.address)
+            else:
+                server = await asyncio.start_server(self.handle, *self.address)
+        except OSError as error:
+            self.error = error
+            self.ready.set()
+            return
+        self.ready.set()
+        async with server:
+            broadcast = asyncio.create_task(self.broadcast())
+            await self.stopping.wait()
+            broadcast.cancel()
+            server.close()
+            tasks = [client.task for client in self.clients]
+            for client in self.clients:
+                # Unsent frames are thrown away; None stops the client's writer
+                while not client.queue.empty():
+                    client.queue.get_nowait()
+                client.queue.put_nowait(None)
+                client.writer.transport.abort()
+            await asyncio.gather(broadcast, *tasks, return_exceptions=True)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def serialize(self, frame):
+        """(seq, line) of frame: numbered and serialized once, "dropped" added per client."""
+        last, seq, line = self.serialized
+        if frame is not last:
+            seq += 1
+            line = json.dumps(dict(seq=seq, **frame))[:-1]
+            self.serialized = (frame, seq, line)
+        return seq, line
+
+    async def broadcast(self):
+        """Put the latest frame in every client's queue, rate times per second."""
+        next_frame = self.loop.time()
+        sent = None
+        while True:
+            next_frame += self.period
+            await asyncio.sleep(max(next_frame - self.loop.time(), 0))
+            frame = self.latest
+            if frame is None or frame is sent or not self.clients:
+                continue  # No step since the last frame (e.g. on the home screen), or nobody to send it to
+            sent = frame
+            seq, line = self.serialize(frame)
+            for client in self.clients:
+                if client.seq != seq:  # Not already sent when it connected
+                    client.put(seq, line)
+
+    async def handle(self, reader, writer):
+        """Write the frames queued for one client until it goes away."""
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+        client = Client(f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else f"unix #{self.connections}",
+                        writer, self.queue_frames)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        writer.transport.set_write_buffer_limits(SEND_BUFFER)
+        self.clients.append(client)
+        if self.latest is not None:
+            client.put(*self.serialize(self.latest))  # The current state, without waiting for a step
+        try:
+            while True:
+                line = await client.queue.get()
+                if line is None:
+                    break
+                writer.write(line)
+                await writer.drain()  # Only this client waits for its socket
+                client.sent += 1
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.remove(client)
+            self.gone.append(client)
+            writer.close()
+
+
+async def watch(address, frames=None, delay=0.0):
+    """
+    Test client: print the frames of the server at address, reading one every
+    delay seconds (a slow client) and stopping after frames frames if given.
+    """
+    # A slow client buffers little, or the server would only see it fall
+    # behind once its buffers are full, seconds later
+    limit = 4096 if delay else 2 ** 16
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET)
+    if delay:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, limit)  # Before connecting, for TCP
+    sock.connect(address)
+    reader, writer = await asyncio.open_connection(sock=sock, limit=limit)
+    received = 0
+    frame = None
+    missing = 0  # Frames skipped in seq, the server's "dropped" from the start
+    start = time.perf_counter()
+    try:
+        while frames is None or received < frames:
+            line = await reader.readline()
+            if not line:
+                break
+            last_seq = frame and frame["seq"]
+            frame = json.loads(line)
+            received += 1
+            if last_seq is not None:
+                missing += frame["seq"] - last_seq - 1
+            print(f"seq {frame['seq']:6} step {frame['step']:6}  x {frame['x']:8.1f} y {frame['y']:6.1f} "
+                  f"theta {frame['theta']:6.3f} v_u {frame['v_u']:7.2f} phi {frame['phi']:6.3f}  "
+                  f"lta {frame['interventions']:4}  detections {len(frame['detections'])}  "
+                  f"dropped {frame['dropped']}")
+            if delay:
+                await asyncio.sleep(delay)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"{received} frames in {elapsed:.1f} s ({received / max(elapsed, 1e-9):.1f}/s), "
+          f"{missing} missing in seq, {frame['dropped'] if frame else 0} dropped by the server")
+
+
+if __name__ == "__main__":
+    # Test client: python telemetry.py ADDRESS [frames] [seconds between reads]
+    # e.g. python telemetry.py :8765 100, or 1 s per frame to see frames dropped:
+    #      python telemetry.py /tmp/car.sock 20 1
+    if len(sys.argv) < 2:
+        sys.exit("usage: python telemetry.py ADDRESS [frames] [delay]")
+    asyncio.run(watch(parse_address(sys.argv[1]),
+                      int(sys.argv[2]) if len(sys.argv) > 2 else None,
+                      float(sys.argv[3]) if len(sys.argv) > 3 else 0.0))
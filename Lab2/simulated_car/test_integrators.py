@@ -0,0 +1,40 @@
+import math
+
+import numpy as np
+
+from integrators import RK4, DormandPrince
+from sim_engine import Simulation
+
+# integrators.py stands apart from the simulators: its RK4 must keep taking the
+# same steps as Simulation.runge_kutta, and Dormand-Prince must agree with both.
+
+
+def oscillator(y, out):
+    """A damped oscillator in place: x'' = -4 x - 0.2 x'."""
+    out[0] = y[1]
+    out[1] = -4 * y[0] - 0.2 * y[1]
+
+
+def test_rk4_matches_simulation_step():
+    simulation = Simulation([None], dt=0.1)  # No road: only its RK4 step is used
+    y = np.array([1.0, 0.0])
+    state = [1.0, 0.0]
+    rk4 = RK4(oscillator, y.shape)
+    for _ in range(50):
+        rk4.step(y, simulation.dt)
+        state = simulation.runge_kutta(lambda s: [s[1], -4 * s[0] - 0.2 * s[1]], state)
+    assert np.allclose(y, state, rtol=0, atol=1e-12)
+    assert rk4.evaluations == 200
+
+
+def test_dormand_prince_matches_fine_rk4():
+    y = np.array([1.0, 0.0])
+    reference = y.copy()
+    RK4(oscillator, y.shape).advance(reference, 0, 5, 1e-4)
+    dormand_prince = DormandPrince(oscillator, y.shape, rtol=1e-9, atol=1e-9)
+    t = 0
+    for frame in range(50):
+        t = dormand_prince.advance(y, t, (frame + 1) * 0.1)
+    assert math.isclose(t, 5)
+    assert np.allclose(y, reference, rtol=0, atol=1e-7)
+    assert dormand_prince.accepted + dormand_prince.rejected < 200  # Fewer steps than RK4 at dt = 0.1
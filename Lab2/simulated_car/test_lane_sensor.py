@@ -0,0 +1,36 @@
+import math
+import os
+
+# CoherentConeSensor only samples its rays as far as their last hits, and must
+# still detect exactly what ConeSensor does, frame after frame of a drive.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_coherent_sensor_matches_cone_sensor(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from lane_sensor import CoherentConeSensor, ConeSensor
+    from road_assets import RoadAssets
+    mask = RoadAssets(["road1.png"]).get(0).mask
+    for sensor_range, angle_step in ((450, 4), (1800, 1)):
+        cone = ConeSensor(sensor_range, 20, angle_step)
+        coherent = CoherentConeSensor(sensor_range, 20, angle_step)
+        for step in range(500):
+            # Weaving along the lower lane
+            x, y, angle = 50.0 + 4 * step, 361.0 + 30 * math.sin(step / 25), 0.3 * math.cos(step / 25)
+            assert coherent.cast(mask, x, y, angle) == cone.cast(mask, x, y, angle)
+        assert coherent.stats()["samples_per_cast"] < len(cone.angle_offsets) * len(cone.distances)
+
+
+def test_first_cast_is_not_a_warm_hit(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from lane_sensor import CoherentConeSensor
+    from road_assets import RoadAssets
+    mask = RoadAssets(["road1.png"]).get(0).mask
+    sensor = CoherentConeSensor()
+    assert sensor.cast(mask, 50.0, 323.0, 0.0)[0]  # Lines hit, marched in full
+    assert sensor.stats()["warm_hit_rate"] == 0
+    sensor.cast(mask, 52.0, 323.0, 0.0)
+    assert sensor.stats()["warm_hit_rate"] > 0
@@ -0,0 +1,79 @@
+import csv
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+# Regression tests for the LTA sweep on a process pool: forked workers used to
+# inherit road loads started on a RoadAssets thread they do not have, and
+# waited for them forever once a run got to the next road.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 60  # Seconds: a hang fails the test instead of blocking it
+
+
+def test_dynamic_sweep_through_pool(tmp_path):
+    output = tmp_path / "sweep.csv"
+    subprocess.run([sys.executable, "lta_sweep.py",
+                    "--param", "SAFE_DISTANCE_THRESHOLD=15,35",
+                    "--param", "LTA_CORRECTION=0.4,1.2",
+                    "--mode", "dynamic", "--workers", "2", "--output", str(output)],
+                   cwd=HERE, check=True, timeout=TIMEOUT, capture_output=True,
+                   env=dict(os.environ, SDL_VIDEODRIVER="dummy"))
+    with open(output, newline="") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert len(rows) == 4
+    assert all(int(row["steps"]) > 0 for row in rows)
+
+
+def test_parent_stays_free_of_pygame():
+    # Only the workers import pygame (with CAR_LTA and the distance fields)
+    subprocess.run([sys.executable, "-c", "import sys, lta_sweep; assert 'pygame' not in sys.modules"],
+                   cwd=HERE, check=True, timeout=TIMEOUT)
+
+
+def next_road(assets, connection):
+    connection.send(assets.get(1).mask.shape)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_road_assets_after_fork(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from road_assets import RoadAssets
+    assets = RoadAssets(["road1.png", "road2.png"])
+    busy = threading.Event()
+    assets.executor.submit(busy.wait)  # Holds the background thread: road2.png stays pending
+    assets.get(0)
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=next_road, args=(assets, sender))
+    child.start()
+    busy.set()
+    try:
+        assert receiver.poll(TIMEOUT), "the forked child hung loading the next road"
+        assert receiver.recv() == assets.get(1).mask.shape
+    finally:
+        child.kill()
+        child.join()
+        assets.shutdown()
+
+
+def test_runs_keep_no_frame_samples(monkeypatch):
+    # A sweep worker runs many simulations in one process: without
+    # --frame-stats none of them may leave frame times behind
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    import CAR_LTA
+    for _ in range(2):
+        CAR_LTA.reset_simulation()
+        assert CAR_LTA.simulate("dynamic", CAR_LTA.DEFAULT_SCRIPT)
+    assert not CAR_LTA.profiler.samples and not CAR_LTA.profiler.recent
+    monkeypatch.setattr(CAR_LTA.profiler, "keep_samples", True)
+    for steps in (20, 10):
+        CAR_LTA.reset_simulation()
+        CAR_LTA.simulate("dynamic", CAR_LTA.DEFAULT_SCRIPT, steps)
+    assert len(CAR_LTA.profiler.samples["frame"]) == 10  # Only the last run
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+# The MPC LTA keeps to its compute budget: with none left after the first
+# batch of candidates, every tick takes the best of that batch.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def car_lta(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    import CAR_LTA
+    monkeypatch.setattr(CAR_LTA, "LTA_MPC", True)
+    yield CAR_LTA
+    CAR_LTA.LTA_MPC = False
+    CAR_LTA.reset_simulation()
+
+
+def test_budget_cuts_ticks_short(car_lta, monkeypatch):
+    import mpc_lta
+    monkeypatch.setattr(mpc_lta, "TICK_HISTORY", 20)
+    controller = mpc_lta.MPCController(budget=0.0)
+    car_lta.reset_simulation()
+    car_lta.simulation.controller = controller
+    first_batch = controller.sequences[:controller.batch].tolist()
+    plans = []
+    correction = controller.correction
+
+    def recorded(simulation, inputs):
+        applied = correction(simulation, inputs)
+        plans.append(controller.plan.tolist())
+        return applied
+
+    monkeypatch.setattr(controller, "correction", recorded)
+    trajectory = car_lta.simulate("dynamic", car_lta.DEFAULT_SCRIPT)
+    assert controller.cut_short > 0
+    assert controller.ticks == len(trajectory)
+    assert len(controller.tick_times) == 20
+    assert all(plan in first_batch or not any(plan) for plan in plans)
@@ -0,0 +1,69 @@
+import os
+
+# A RoadWorld with more tiles than the RoadAssets capacity loads every tile
+# once as the car gets to it and evicts the tiles behind it.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_tiles_loaded_and_evicted(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from road_assets import CAPACITY
+    from road_world import RoadWorld, route
+    from sim_engine import RIGHT, Simulation
+
+    length = 3 * CAPACITY
+    world = RoadWorld(route(length))
+    loaded = []
+    load = world.assets.load
+
+    def counted(road_file):
+        loaded.append(road_file)
+        return load(road_file)
+
+    monkeypatch.setattr(world.assets, "load", counted)
+    simulation = Simulation(world, "kinematics", continuous=True, clamp_speed=True, max_speed=40)
+    try:
+        while simulation.step(RIGHT):
+            assert len(world.assets.cache) <= CAPACITY
+        assert simulation.finished
+        assert len(loaded) == length  # Every tile once, though the route repeats its images
+        assert 0 not in world.assets.cache
+    finally:
+        world.shutdown()
+
+
+def test_generated_world_tiles(tmp_path, monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from road_generator import generate
+    from road_world import GeneratedTiles, RoadWorld
+    from sim_engine import RIGHT, Simulation
+
+    path = str(tmp_path / "world")
+    generate(path, 8000, height=600)
+    tiles = GeneratedTiles(path, distance_fields=True)
+    world = RoadWorld(tiles)
+    simulation = Simulation(world, "kinematics", lta="field", continuous=True, clamp_speed=True,
+                            max_speed=20, start=tiles.start, height=600)
+    try:
+        while simulation.step(RIGHT):
+            x = simulation.road_index * tiles.tile_width + simulation.x
+            assert abs(simulation.y - tiles.world.lane_middle(x, 1)) < 45  # Within its lane
+        assert simulation.finished
+        assert len(tiles) == 8
+    finally:
+        world.shutdown()
+
+
+def test_distance_fields_evicted(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    import distance_field
+    monkeypatch.setattr(distance_field, "CAPACITY", 2)
+    monkeypatch.setattr(distance_field, "_fields", distance_field.collections.OrderedDict())
+    first = distance_field.load_distance_field("road1.png")
+    distance_field.load_distance_field("road2.png")
+    assert distance_field.load_distance_field("road1.png") is first
+    distance_field.load_distance_field("road3.png")
+    assert list(distance_field._fields) == ["road1.png", "road3.png"]  # road2 used least recently
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import os
+import time
+
+# Telemetry frames count every LTA intervention of the simulation, not only
+# those of the steps that happened to be published, and a client connecting
+# after the last step still gets it.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+async def first_frame(address):
+    reader, writer = await asyncio.open_unix_connection(address)
+    try:
+        return json.loads(await asyncio.wait_for(reader.readline(), 10))
+    finally:
+        writer.close()
+
+
+def test_interventions_counted_between_published_steps(tmp_path, monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from road_assets import RoadAssets
+    from sim_engine import RIGHT, UP, Simulation
+    from telemetry import TelemetryServer
+
+    simulation = Simulation(RoadAssets(["road1.png"]), "kinematics", lta="sensor")
+    active = 0
+    for step in range(150):
+        simulation.step(RIGHT | (UP if step < 10 else 0))  # Steer towards a line
+        active += simulation.lta_active
+    assert active and simulation.interventions == active
+    server = TelemetryServer(str(tmp_path / "car.sock"), rate=50).start()
+    try:
+        server.publish(simulation)  # Only after the last step
+        time.sleep(0.1)  # Several broadcast periods without a client
+        frame = asyncio.run(first_frame(server.address))  # Sent the latest frame on connecting
+    finally:
+        server.close()
+    assert frame["interventions"] == active
+    assert frame["seq"] == 1
+
+
+async def frames_while_driving(server, simulation, count):
+    from sim_engine import RIGHT
+    reader, writer = await asyncio.open_unix_connection(server.address)
+    frames = []
+    try:
+        while len(frames) < count:
+            simulation.step(RIGHT)
+            server.publish(simulation)  # Every step, the server sends the latest at its rate
+            try:
+                frames.append(json.loads(await asyncio.wait_for(reader.readline(), 0.01)))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        writer.close()
+    return frames
+
+
+def test_connected_client_gets_each_frame_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from road_assets import RoadAssets
+    from sim_engine import Simulation
+    from telemetry import TelemetryServer
+
+    simulation = Simulation(RoadAssets(["road1.png"]), "kinematics")
+    server = TelemetryServer(str(tmp_path / "car.sock"), rate=100).start()
+    try:
+        frames = asyncio.run(asyncio.wait_for(frames_while_driving(server, simulation, 5), 10))
+    finally:
+        server.close()
+    seqs = [frame["seq"] for frame in frames]
+    steps = [frame["step"] for frame in frames]
+    assert seqs == sorted(set(seqs)) and steps == sorted(set(steps))
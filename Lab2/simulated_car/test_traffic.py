@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pytest
+
+# The SpatialHash only narrows down the neighbours of every car: the traffic
+# must drive, collide and sense the same as when it checks all pairs of cars,
+# across buckets shared by several cells and across the wrap of the ring.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STEPS = 150
+DENSE_SPACING = 70  # Pixels: shorter than a car, the cars of a lane keep bumping into each other
+
+
+@pytest.fixture
+def traffic(monkeypatch):
+    monkeypatch.chdir(HERE)
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    import traffic
+    return traffic
+
+
+def collision_pairs(traffic):
+    return sorted(zip(*(cars.tolist() for cars in traffic.collision_pairs)))
+
+
+@pytest.mark.parametrize("dense", [False, True])
+@pytest.mark.parametrize("n", [7, 60, 250])
+def test_hash_matches_all_pairs(traffic, n, dense):
+    spacing = DENSE_SPACING if dense else traffic.SPACING
+    hashed = traffic.Traffic(n, spacing=spacing, spatial_hash=True)
+    checked = traffic.Traffic(n, spacing=spacing, spatial_hash=False)
+    collisions = 0
+    for _ in range(STEPS):
+        hashed.step()
+        checked.step()
+        assert np.array_equal(hashed.states, checked.states)
+        assert collision_pairs(hashed) == collision_pairs(checked)
+        assert np.array_equal(hashed.car_distances, checked.car_distances)
+        collisions += len(hashed.collision_pairs[0])
+    assert np.isfinite(hashed.car_distances).any()  # The sensors saw cars
+    assert (collisions > 0) == dense
+
+
+def test_collision_across_ring_wrap(traffic):
+    from batched_dynamics import X
+    for spatial_hash in (True, False):
+        cars = traffic.Traffic(2, lanes=(260,), spatial_hash=spatial_hash)
+        assert cars.tiles == 1
+        # Car 0 at the start of the ring, car 1 40 pixels behind it, at the end
+        cars.states[:, X] = [10, cars.width - 30]
+        cars.collide()
+        assert collision_pairs(cars) == [(0, 1)]
+        assert cars.colliding.all()
+        # Bumper to bumper, but not touching
+        cars.states[:, X] = [10, 10 + traffic.CAR_LENGTH + 1]
+        cars.collide()
+        assert collision_pairs(cars) == []
+        assert not cars.colliding.any()
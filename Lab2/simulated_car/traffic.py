@@ -0,0 +1,461 @@
+import math
+import sys
+import time
+
+import numpy as np
+
+import batched_dynamics
+from lane_env import ROAD_FILES, load_roads
+from lane_sensor import ConeSensor
+from lta_sweep import DEPARTURE_DISTANCE
+from sim_engine import DOWN, DT, HEIGHT, LEFT, RIGHT, UP, WIDTH
+
+# Many cars on one road at once, each with its own state, driver and sensor, on
+# the (n, ...) arrays of batched_dynamics.py. The road is a ring of road tiles
+# (a car leaving the last tile comes back on the first one), long enough for
+# the cars at a fixed density so the work per car does not grow with their number.
+#
+# A car is two discs along its heading, which cover the 73x45 car of car.png.
+# Neighbours are found with a SpatialHash rebuilt every step: collisions between
+# cars, and the sensor rays that end on a car before any lane line.
+
+CAR_LENGTH = 73
+CAR_WIDTH = 45
+DISC_RADIUS = CAR_WIDTH / 2
+DISC_OFFSET = (CAR_LENGTH - CAR_WIDTH) / 2  # Distance from the car centre to each disc centre
+CAR_RADIUS = DISC_OFFSET + DISC_RADIUS  # Circle around the whole car
+CELL_SIZE = 125  # Pixels, divides the road tile width so the ring wraps on a cell edge
+
+LANES = (260, 361)  # y of the middle of the two lanes, where the cars start
+SPACING = 150  # Pixels between two cars of a lane at the start
+SENSOR_RANGE = 450  # 30 meters in pixels
+
+# Drivers: cruise at their own speed, keep a gap growing with the speed to the
+# nearest car their sensor sees, and wander left and right now and then
+TARGET_SPEEDS = (20, 45)  # Range of the cruise speeds (kinematics), pixels per second
+MIN_GAP = 40  # Pixels between the front of the car and the car ahead, at rest
+HEADWAY = 1.5  # Seconds of driving added to the gap
+WANDER = 0.01  # Chance per step that a driver starts steering to one side
+WANDER_STOP = 0.3  # and that it lets go again
+
+
+class SpatialHash:
+    """
+    Uniform grid of cell_size pixels over points, with the cells hashed into a
+    table of buckets: built again for the points of every step with build(),
+    then queried for the points in the cells around a position. If period is
+    given the x axis wraps around every period pixels (a multiple of cell_size).
+
+    Cells that share a bucket return each other's points, so the queries give
+    candidates: callers check the actual distances.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE, period=None):
+        if period is not None and period % cell_size:
+            raise ValueError(f"period {period} is not a multiple of the cell size {cell_size}")
+        self.cell_size = cell_size
+        self.columns = None if period is None else period // cell_size
+        self.table_size = 0
+        self.order = np.zeros(0, dtype=np.int64)  # Points sorted by bucket
+        self.starts = np.zeros(1, dtype=np.int64)  # Bucket b holds order[starts[b]:starts[b + 1]]
+
+    def bucket(self, cx, cy):
+        if self.columns is not None:
+            cx = cx % self.columns
+        return ((cx * 73856093) ^ (cy * 19349663)) & (self.table_size - 1)
+
+    def build(self, xs, ys):
+        """Put the points (xs[i], ys[i]) in their cells; the point ids are their indices."""
+        # About two buckets per point keeps the buckets short
+        self.table_size = 1 << max(int(2 * len(xs)).bit_length(), 6)
+        buckets = self.bucket(np.floor_divide(xs, self.cell_size).astype(np.int64),
+                              np.floor_divide(ys, self.cell_size).astype(np.int64))
+        self.order = np.argsort(buckets, kind="stable")
+        self.starts = np.zeros(self.table_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(buckets, minlength=self.table_size), out=self.starts[1:])
+
+    def query(self, xs, ys, radius):
+        """
+        The points in the cells overlapping the squares of half side radius
+        around the positions (xs[q], ys[q]), as (queries, points) arrays of
+        candidate pairs, each pair once.
+        """
+        span = math.ceil(2 * radius / self.cell_size) + 1  # Cells per side of a square
+        offsets = np.arange(span)
+        cx = np.floor_divide(np.subtract(xs, radius), self.cell_size).astype(np.int64)
+        cy = np.floor_divide(np.subtract(ys, radius), self.cell_size).astype(np.int64)
+        buckets = self.bucket((cx[:, None] + offsets)[:, :, None],
+                              (cy[:, None] + offsets)[:, None, :]).reshape(len(cx), -1)
+        # Cells of one square in the same bucket would give its points twice
+        buckets.sort(axis=1)
+        starts, ends = self.starts[buckets], self.starts[buckets + 1]
+        ends[:, 1:][buckets[:, 1:] == buckets[:, :-1]] = starts[:, 1:][buckets[:, 1:] == buckets[:, :-1]]
+        counts = (ends - starts).ravel()
+        total = counts.sum()
+        queries = np.repeat(np.repeat(np.arange(len(cx)), buckets.shape[1]), counts)
+        # Position of every candidate in the sorted points: the start of its
+        # bucket plus its rank within the bucket
+        first = np.repeat(starts.ravel() - (np.cumsum(counts) - counts), counts)
+        return queries, self.order[first + np.arange(total)]
+
+    def pairs(self, xs, ys, radius):
+        """Candidate pairs (i, j), i < j, among the points the hash was built with."""
+        queries, points = self.query(xs, ys, radius)
+        keep = queries < points
+        return queries[keep], points[keep]
+
+
+def all_pairs(n):
+    """Every (i, j) pair of n points, i != j: what the SpatialHash queries replace."""
+    queries, points = np.divmod(np.arange(n * n), n)
+    keep = queries != points
+    return queries[keep], points[keep]
+
+
+class Traffic:
+    """
+    n cars driving on a ring of road tiles, made of road_files over and over
+    for a density of one car every spacing pixels in each lane.
+    mode is "dynamic" or "kinematics", lta None or "field" (every car has the
+    LTA of the road's distance field, as LaneKeepingVectorEnv). Each car
+    casts its own sensor cone every step; a ray stops at the first lane line
+    or car it hits. spatial_hash=False finds the neighbours by checking all
+    pairs of cars instead, to compare.
+    """
+
+    def __init__(self, n, mode="kinematics", lta="field", road_files=ROAD_FILES,
+                 lanes=LANES, spacing=SPACING, spatial_hash=True, seed=0):
+        if mode not in ("dynamic", "kinematics"):
+            raise ValueError(f"mode must be dynamic or kinematics, not {mode!r}")
+        if lta not in (None, "field"):
+            raise ValueError(f"lta must be None or \"field\", not {lta!r}")
+        self.n = n
+        self.mode = mode
+        self.roads = load_roads(road_files)
+        self.width = len(self.roads[0].mask)
+        per_lane = -(-n // len(lanes))
+        self.tiles = max(-(-per_lane * spacing // self.width), 1)
+        self.tile_roads = np.arange(self.tiles) % len(self.roads)  # Road of every tile
+        self.length = self.tiles * self.width
+        self.sensor = ConeSensor(SENSOR_RANGE)
+        self.lane_check = self.lane_safety if lta == "field" else None
+        self.hash = SpatialHash(CELL_SIZE, self.length) if spatial_hash else None
+        self.rng = np.random.default_rng(seed)
+
+        # Ray directions relative to the heading, as ConeSensor casts them
+        self.ray_offsets = -np.radians(self.sensor.angle_offsets)
+
+        # Cars of a lane one spacing apart, the lanes shifted from each other
+        index = np.arange(n)
+        lane = index % len(lanes)
+        position = (index // len(lanes) * spacing + lane * spacing / len(lanes)) % self.length
+        self.tile = (position // self.width).astype(np.int64)
+        self.states = batched_dynamics.start_states(n, 0, 0, model=self.model)
+        self.states[:, batched_dynamics.X] = position % self.width
+        self.states[:, batched_dynamics.Y] = np.asarray(lanes, dtype=float)[lane]
+        self.FD = np.zeros(n)  # Driving force (dynamic)
+        self.speed = np.zeros(n)  # Speed (kinematics)
+        self.steering_angle = np.zeros(n)  # Steering angle (kinematics)
+        self.target_speed = self.rng.uniform(*TARGET_SPEEDS, n)
+        self.steer = np.zeros(n, dtype=np.int64)  # What each driver holds: 0, UP or DOWN
+
+        self.steps = 0
+        self.lta_active = np.zeros(n, dtype=bool)
+        self.colliding = np.zeros(n, dtype=bool)
+        self.collide()
+        self.sense()
+
+    @property
+    def model(self):
+        return "dynamic" if self.mode == "dynamic" else "kinematic"
+
+    @property
+    def xs(self):
+        """x of every car along the whole ring."""
+        return self.tile * self.width + self.states[:, batched_dynamics.X]
+
+    @property
+    def ys(self):
+        return self.states[:, batched_dynamics.Y]
+
+    @property
+    def angles(self):
+        return self.states[:, batched_dynamics.THETA]
+
+    @property
+    def speeds(self):
+        if self.mode == "dynamic":
+            return self.states[:, batched_dynamics.V_U]
+        return self.speed
+
+    def wrap(self, dx):
+        """Offsets along the ring, the shortest way round."""
+        return (dx + self.length / 2) % self.length - self.length / 2
+
+    def neighbours(self, radius, centers=None):
+        """
+        Candidate (cars, others) pairs: the other cars within radius of
+        centers[car], or if centers is None the pairs of cars within radius
+        of each other, each pair once.
+        """
+        if self.hash is None:
+            cars, others = all_pairs(self.n)
+        elif centers is None:
+            return self.hash.pairs(self.xs, self.ys, radius)
+        else:
+            cars, others = self.hash.query(*centers, radius)
+        keep = cars < others if centers is None else cars != others
+        return cars[keep], others[keep]
+
+    def step(self, actions=None):
+        """
+        Drive every car one step with its inputs in actions, shape (n,), or
+        with the drivers' own (drive()) if actions is None.
+        """
+        actions = self.drive() if actions is None else np.asarray(actions)
+        up, down = (actions & UP) != 0, (actions & DOWN) != 0
+        if self.mode == "dynamic":
+            steer = np.where(up, batched_dynamics.UP, np.where(down, batched_dynamics.DOWN, batched_dynamics.NONE))
+        else:
+            steer = np.where(down, batched_dynamics.DOWN, np.where(up, batched_dynamics.UP, batched_dynamics.NONE))
+        throttle = np.where((actions & LEFT) != 0, batched_dynamics.LEFT,
+                            np.where((actions & RIGHT) != 0, batched_dynamics.RIGHT, batched_dynamics.NONE))
+
+        if self.mode == "dynamic":
+            self.FD = batched_dynamics.dynamic_controls(self.states, self.FD, steer, throttle)
+            self.states, self.lta_active = batched_dynamics.dynamic_step(
+                self.states, self.FD, DT, self.lane_check)
+        else:
+            self.steering_angle, speed = batched_dynamics.kinematic_controls(
+                self.steering_angle, self.speed, steer, throttle)
+            self.states, self.lta_active = batched_dynamics.kinematic_step(
+                self.states, self.speed, self.steering_angle, DT, self.lane_check)
+            self.speed = speed
+
+        # Next (or previous) tile at the edges, round the ring
+        xs = self.states[:, batched_dynamics.X]
+        moved = np.floor_divide(xs, self.width)
+        self.tile = (self.tile + moved.astype(np.int64)) % self.tiles
+        xs -= moved * self.width
+
+        self.collide()
+        self.sense()
+        self.steps += 1
+
+    def drive(self):
+        """
+        Inputs of every driver: accelerate up to its cruise speed, brake when
+        the car its sensor sees ahead is closer than the gap for its speed.
+        The steering is left to the LTA, but for short pulses to either side.
+        """
+        speeds = self.speeds
+        gap = self.car_distances.min(axis=1) - CAR_RADIUS
+        keep_gap = MIN_GAP + HEADWAY * np.abs(speeds)
+        throttle = np.where(gap < keep_gap, np.where(speeds > 1, LEFT, 0),
+                            np.where((gap > keep_gap + MIN_GAP / 2) & (speeds < self.target_speed),
+                                     RIGHT, 0))
+        draw = self.rng.random(self.n)
+        start = (self.steer == 0) & (draw < WANDER)
+        self.steer[start] = np.where(draw[start] < WANDER / 2, UP, DOWN)
+        self.steer[(self.steer != 0) & ~start & (draw < WANDER_STOP)] = 0
+        return throttle | self.steer
+
+    def discs(self, cars=None):
+        """(xs, ys) of the two discs of the cars, shape (cars, 2), along the ring."""
+        cars = slice(None) if cars is None else cars
+        xs, ys, angles = self.xs[cars], self.ys[cars], self.angles[cars]
+        along = np.array([DISC_OFFSET, -DISC_OFFSET])
+        return (xs[:, None] + np.cos(angles)[:, None] * along,
+                ys[:, None] + np.sin(angles)[:, None] * along)
+
+    def collide(self):
+        """Find the pairs of cars whose discs overlap."""
+        xs, ys = self.xs, self.ys
+        if self.hash is not None:
+            self.hash.build(xs, ys)
+        cars, others = self.neighbours(2 * CAR_RADIUS)
+        close = np.hypot(self.wrap(xs[others] - xs[cars]), ys[others] - ys[cars]) < 2 * CAR_RADIUS
+        cars, others = cars[close], others[close]
+        disc_x, disc_y = self.discs()
+        dx = self.wrap(disc_x[others][:, None, :] - disc_x[cars][:, :, None])
+        dy = disc_y[others][:, None, :] - disc_y[cars][:, :, None]
+        touching = (dx * dx + dy * dy < (2 * DISC_RADIUS) ** 2).any(axis=(1, 2))
+        self.collision_pairs = (cars[touching], others[touching])
+        self.colliding[:] = False
+        self.colliding[self.collision_pairs[0]] = True
+        self.colliding[self.collision_pairs[1]] = True
+
+    def sense(self):
+        """
+        Cast the sensor cone of every car: line_distances to the first lane
+        line hit of every ray, car_distances to the first car (car_hits, -1 if
+        none) and ray_distances to whichever comes first, inf if nothing.
+        Expects the hash to hold the cars of this step (collide()).
+        """
+        xs, ys, angles = self.xs, self.ys, self.angles
+        local_x = self.states[:, batched_dynamics.X]
+        self.line_distances = np.empty((self.n, len(self.ray_offsets)))
+        road_of_car = self.tile_roads[self.tile]
+        for index, road in enumerate(self.roads):
+            cars = road_of_car == index
+            if cars.any():
+                self.line_distances[cars] = self.sensor.distances_many(
+                    road.mask, local_x[cars], ys[cars], angles[cars])
+
+        # The cars in the square around the middle of the cone
+        half = SENSOR_RANGE / 2
+        centers = (xs + half * np.cos(angles), ys + half * np.sin(angles))
+        cars, others = self.neighbours(half + CAR_RADIUS, centers)
+        dx, dy = self.wrap(xs[others] - xs[cars]), ys[others] - ys[cars]
+        # Ahead of the car and within range of the rays
+        cos_a, sin_a = np.cos(angles[cars]), np.sin(angles[cars])
+        ahead = ((dx * cos_a + dy * sin_a > -CAR_RADIUS) &
+                 (dx * dx + dy * dy < (SENSOR_RANGE + CAR_RADIUS) ** 2))
+        cars, others = cars[ahead], others[ahead]
+
+        # First crossing of every ray with the two discs of every other car
+        disc_x, disc_y = self.discs(others)
+        dx = self.wrap(disc_x - xs[cars][:, None])[:, :, None]
+        dy = (disc_y - ys[cars][:, None])[:, :, None]
+        ray_angles = angles[cars][:, None] + self.ray_offsets
+        ray_cos, ray_sin = np.cos(ray_angles)[:, None, :], np.sin(ray_angles)[:, None, :]
+        along = dx * ray_cos + dy * ray_sin  # Shape (pairs, discs, rays)
+        across = dx * ray_sin - dy * ray_cos
+        inside = DISC_RADIUS ** 2 - across * across
+        with np.errstate(invalid="ignore"):
+            hit = np.maximum(along - np.sqrt(inside), 0)
+        hit = np.where((inside >= 0) & (along > 0) & (hit < SENSOR_RANGE), hit, np.inf).min(axis=1)
+
+        self.car_distances = np.full((self.n, len(self.ray_offsets)), np.inf)
+        np.minimum.at(self.car_distances, cars, hit)
+        self.car_hits = np.full((self.n, len(self.ray_offsets)), -1)
+        first = np.isfinite(hit) & (hit == self.car_distances[cars])
+        pair, ray = np.nonzero(first)
+        self.car_hits[cars[pair], ray] = others[pair]
+        self.ray_distances = np.minimum(self.line_distances, self.car_distances)
+
+    def lane_safety(self, xs, ys, safe_threshold):
+        """LaneDistanceField.is_safe_many() with every car on the road of its tile."""
+        distances, line_ids = self.query(xs, ys)
+        return distances > safe_threshold, line_ids
+
+    def query(self, xs, ys):
+        """(distances, line_ids) of the nearest lane line of every car, on its own tile."""
+        distances = np.empty(len(xs))
+        line_ids = np.empty(len(xs), dtype=np.int64)
+        road_of_car = self.tile_roads[self.tile]
+        for index, road in enumerate(self.roads):
+            cars = road_of_car == index
+            if cars.any():
+                distances[cars], line_ids[cars] = road.field.query_many(xs[cars], ys[cars])
+        return distances, line_ids
+
+    def departed(self):
+        """Cars this close to a lane line, or off the road: a lane departure (lta_sweep.py)."""
+        return self.query(self.states[:, batched_dynamics.X], self.ys)[0] <= DEPARTURE_DISTANCE
+
+    def visible(self, camera_x):
+        """The cars on the screen from ring x camera_x, found with the hash."""
+        if self.hash is None:
+            return np.flatnonzero(np.abs(self.wrap(self.xs - camera_x - WIDTH / 2)) < WIDTH / 2 + CAR_RADIUS)
+        _, cars = self.hash.query([camera_x + WIDTH / 2], [HEIGHT / 2], WIDTH / 2 + CAR_RADIUS)
+        return cars[np.abs(self.wrap(self.xs[cars] - camera_x - WIDTH / 2)) < WIDTH / 2 + CAR_RADIUS]
+
+
+def view(n, mode="kinematics", seconds=None, fps=60):
+    """
+    Drive the traffic in a window, one step per frame, the camera following
+    car 0: the cars on the screen with their sensor rays, in red when they
+    touch another car. Returns the frame times.
+    """
+    import pygame
+    from dirty_renderer import DirtyRenderer
+    from sprite_cache import RotationCache
+
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption(f"Traffic: {n} cars")
+    renderer = DirtyRenderer(screen)
+    car_sprites = RotationCache(pygame.image.load("car.png").convert_alpha())
+    surfaces = [pygame.image.load(road_file).convert() for road_file in ROAD_FILES]
+    clock = pygame.time.Clock()
+    traffic = Traffic(n, mode)
+    frame_times = []
+    start = time.perf_counter()
+    running = True
+    while running and (seconds is None or time.perf_counter() - start < seconds):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        frame_start = time.perf_counter()
+        traffic.step()
+
+        camera_x = traffic.xs[0] - WIDTH // 4
+        first = int(camera_x // traffic.width)
+        renderer.set_tiles([(surfaces[traffic.tile_roads[tile % traffic.tiles]],
+                             (round(tile * traffic.width - camera_x), 0))
+                            for tile in (first, first + 1)])
+        renderer.begin()
+        cars = traffic.visible(camera_x)
+        xs = traffic.wrap(traffic.xs[cars] - camera_x)
+        ys, angles = traffic.ys[cars], traffic.angles[cars]
+        ray_angles = angles[:, None] + traffic.ray_offsets
+        reach = np.minimum(traffic.ray_distances[cars], SENSOR_RANGE)
+        ends_x = xs[:, None] + reach * np.cos(ray_angles)
+        ends_y = ys[:, None] + reach * np.sin(ray_angles)
+        for car, x, y, angle, car_ends_x, car_ends_y in zip(
+                cars.tolist(), xs.tolist(), ys.tolist(), angles.tolist(), ends_x.tolist(), ends_y.tolist()):
+            hits = traffic.car_hits[car]
+            for ray, (end_x, end_y) in enumerate(zip(car_ends_x, car_ends_y)):
+                color = (255, 160, 0) if hits[ray] >= 0 else (0, 255, 0)
+                renderer.add(pygame.draw.line(screen, color, (x, y), (end_x, end_y), 1))
+            renderer.add(car_sprites.draw(screen, -math.degrees(angle), (x, y)))
+            if traffic.colliding[car]:
+                renderer.add(pygame.draw.circle(screen, (255, 0, 0), (x, y), CAR_RADIUS, 2))
+        renderer.end()
+        frame_times.append(time.perf_counter() - frame_start)
+        clock.tick(fps)
+    pygame.display.quit()
+    return frame_times
+
+
+def benchmark(counts=(50, 100, 200, 400, 800), steps=200, mode="kinematics"):
+    """
+    Steps per second of the traffic headless, with the spatial hash and with
+    all pairs of cars, and what the drivers and their LTA did.
+    """
+    for n in counts:
+        line = f"{n:5} cars:"
+        for spatial_hash in (True, False):
+            if not spatial_hash and n > 400:
+                break  # n * n pairs: too slow to wait for
+            traffic = Traffic(n, mode, spatial_hash=spatial_hash)
+            contacts = interventions = departures = 0
+            start = time.perf_counter()
+            for _ in range(steps):
+                traffic.step()
+                contacts += len(traffic.collision_pairs[0])
+                interventions += np.count_nonzero(traffic.lta_active)
+                departures += np.count_nonzero(traffic.departed())
+            elapsed = time.perf_counter() - start
+            line += (f"  {'hash' if spatial_hash else 'all pairs'} {elapsed / steps * 1000:6.2f} ms/step "
+                     f"({n * steps / elapsed:9,.0f} car-steps/s)")
+            if spatial_hash:
+                line += (f", {interventions / n / steps:.1%} LTA, {departures / n / steps:.2%} departed, "
+                         f"{contacts} contacts;")
+        print(line)
+
+
+if __name__ == "__main__":
+    # python traffic.py --headless [cars...]   steps per second against the number of cars
+    # python traffic.py [cars] [seconds]       drive them in a window
+    if "--headless" in sys.argv:
+        counts = [int(arg) for arg in sys.argv[1:] if arg != "--headless"]
+        benchmark(counts or (50, 100, 200, 400, 800))
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+        times = view(n, seconds=float(sys.argv[2]) if len(sys.argv) > 2 else None)
+        if times:
+            times = np.sort(times)
+            print(f"{n} cars, {len(times)} frames: median {np.median(times) * 1000:.2f} ms, "
+                  f"95th percentile {times[int(len(times) * 0.95)] * 1000:.2f} ms per frame")